@@ -0,0 +1,18 @@
+from django.contrib import admin, messages
+from models import ApiToken
+
+# Register your models here.
+class ApiTokenAdmin(admin.ModelAdmin):
+    '''New tokens get a random key, which is shown once after saving'''
+    list_display = ('name', 'user', 'created')
+    fields = ('user', 'name')
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            key = obj.set_new_key()
+            messages.warning(
+                request, 'The key for API token "%s" is %s. Make a note of '
+                'it now; it can\'t be shown again.' % (obj.name, key))
+        obj.save()
+
+admin.site.register(ApiToken, ApiTokenAdmin)
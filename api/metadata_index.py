@@ -0,0 +1,281 @@
+"""
+api/metadata_index.py
+
+A persistent SQLite index of the top-level fields of pkginfo, manifest and
+catalog files, so filtered API list requests don't have to read and parse
+every file in the repo
+"""
+import hashlib
+import json
+import logging
+import os
+import plistlib
+import sqlite3
+import threading
+import time
+from xml.parsers.expat import ExpatError
+
+from django.conf import settings
+
+from api.plist_cache import stat_key
+from api.utils import normalize_value_for_filtering, convert_dates_to_strings
+from api.walker import stat_files
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+try:
+    INDEX_PATH = settings.METADATA_INDEX_PATH
+except AttributeError:
+    try:
+        INDEX_PATH = os.path.join(settings.BASE_DIR, 'metadata_index.sqlite3')
+    except AttributeError:
+        INDEX_PATH = None
+
+try:
+    SYNC_INTERVAL = settings.METADATA_INDEX_SYNC_INTERVAL
+except AttributeError:
+    SYNC_INTERVAL = 0
+
+INDEXED_KINDS = ('catalogs', 'manifests', 'pkgsinfo')
+
+# bump this when the schema or the normalization of values changes
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    kind TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (kind, filename));
+CREATE TABLE IF NOT EXISTS fields (
+    kind TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS fields_by_key ON fields (kind, key, value);
+CREATE INDEX IF NOT EXISTS fields_by_item ON fields (kind, filename);
+'''
+
+
+def _json_default(value):
+    '''Encodes plist types json doesn't know about'''
+    if isinstance(value, plistlib.Data):
+        return value.data.encode('base64')
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def api_representation(kind, filename, plist):
+    '''Returns the dictionary plist_api returns for a plist in JSON
+    format'''
+    plist = convert_dates_to_strings(plist)
+    if kind == 'catalogs':
+        # catalogs are list objects, not dicts
+        plist = {'contents': plist}
+    plist['filename'] = filename
+    return plist
+
+
+class MetadataIndex(object):
+    '''SQLite-backed index of plist metadata. The index is brought up to date
+    with the files on disk (by comparing mtimes and sizes) before it is
+    queried, and is updated directly when plists are written through the
+    Plist class'''
+    def __init__(self, path=INDEX_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.last_sync = {}
+        # kind -> digest of the files' names, mtimes and sizes at last sync
+        self.digests = {}
+        self.disabled = not path
+        # serializes syncs within this process; other processes are kept
+        # out by SQLite's own locking
+        self.sync_lock = threading.Lock()
+
+    def _connection(self):
+        '''Returns a sqlite3 connection for the current thread'''
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # filenames are byte strings
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                with connection:
+                    connection.execute('DROP TABLE IF EXISTS items')
+                    connection.execute('DROP TABLE IF EXISTS fields')
+                    connection.execute(
+                        'PRAGMA user_version = %d' % SCHEMA_VERSION)
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def _store(self, connection, kind, filename, cache_key, plist):
+        '''Replaces the rows for a single file'''
+        plist = api_representation(kind, filename, plist)
+        data = json.dumps(plist, default=_json_default)
+        connection.execute(
+            'DELETE FROM fields WHERE kind = ? AND filename = ?',
+            (kind, filename))
+        connection.execute(
+            'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)',
+            (kind, filename, cache_key[0], cache_key[1], data))
+        connection.executemany(
+            'INSERT INTO fields VALUES (?, ?, ?, ?)',
+            [(kind, filename, key, value)
+             for key in plist
+             for value in normalize_value_for_filtering(plist[key])])
+
+    def _remove(self, connection, kind, filename):
+        '''Removes the rows for a single file'''
+        connection.execute(
+            'DELETE FROM fields WHERE kind = ? AND filename = ?',
+            (kind, filename))
+        connection.execute(
+            'DELETE FROM items WHERE kind = ? AND filename = ?',
+            (kind, filename))
+
+    def _index_file(self, connection, kind, filename, plist=None):
+        '''Reads the file at kind/filename and (re)indexes it. plist, if
+        given, is the file's already parsed contents'''
+        filepath = os.path.join(REPO_DIR, kind, os.path.normpath(filename))
+        try:
+            cache_key = stat_key(os.stat(filepath))
+        except OSError:
+            self._remove(connection, kind, filename)
+            return
+        if plist is None:
+            try:
+                plist = plistlib.readPlist(filepath)
+            except (ExpatError, IOError, OSError):
+                # Plist.read treats unparseable files as empty dicts
+                plist = {}
+        self._store(connection, kind, filename, cache_key, plist)
+
+    def sync(self, kind, filenames):
+        '''Brings the index for kind up to date with filenames, the current
+        list of files on disk. Returns a digest of the names, modification
+        times and sizes of the files, which changes whenever any of them
+        does'''
+        if (SYNC_INTERVAL and kind in self.digests and
+                time.time() - self.last_sync.get(kind, 0) < SYNC_INTERVAL):
+            return self.digests[kind]
+        stat_keys = stat_files(os.path.join(REPO_DIR, kind), filenames)
+        digest = hashlib.sha1()
+        for filename, cache_key in stat_keys:
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8')
+            digest.update('%s\0%x-%x\0' % (filename, cache_key[0],
+                                            cache_key[1]))
+        connection = self._connection()
+        indexed = dict(
+            (filename, (mtime_ns, size)) for filename, mtime_ns, size in
+            connection.execute(
+                'SELECT filename, mtime_ns, size FROM items WHERE kind = ?',
+                (kind,)))
+        with connection:
+            for filename, cache_key in stat_keys:
+                if indexed.pop(filename, None) != cache_key:
+                    self._index_file(connection, kind, filename)
+            for filename in indexed:
+                self._remove(connection, kind, filename)
+        self.last_sync[kind] = time.time()
+        self.digests[kind] = digest.hexdigest()
+        return self.digests[kind]
+
+    def validator(self, kind, filenames):
+        '''Brings the index for kind up to date (see sync) and returns the
+        digest of the files, for use in ETags. Returns None if the index
+        can't be used'''
+        if self.disabled or kind not in INDEXED_KINDS:
+            return None
+        try:
+            with self.sync_lock:
+                return self.sync(kind, filenames)
+        except sqlite3.Error, err:
+            LOGGER.error('Metadata index sync failed for %s: %s', kind, err)
+            return None
+
+    def update(self, kind, filename, plist=None):
+        '''Re-indexes a single file after it was created, written or
+        deleted. plist, if given, is the file's new contents, so it doesn't
+        have to be read back'''
+        if self.disabled or kind not in INDEXED_KINDS:
+            return
+        try:
+            connection = self._connection()
+            with connection:
+                self._index_file(connection, kind, filename, plist)
+        except sqlite3.Error, err:
+            LOGGER.error(
+                'Metadata index update failed for %s/%s: %s',
+                kind, filename, err)
+
+    def query(self, kind, filenames, filter_terms, synced=False):
+        '''Returns the list of the items in filenames (in the same order)
+        that match all of filter_terms, a dict of key/substring pairs.
+        Returns None if the index can't be used, in which case the caller
+        should read the files. Pass synced=True if the caller just synced
+        the index for kind'''
+        if self.disabled or kind not in INDEXED_KINDS:
+            return None
+        try:
+            if not synced:
+                with self.sync_lock:
+                    self.sync(kind, filenames)
+            sql = 'SELECT filename FROM items WHERE kind = ?'
+            params = [kind]
+            for key, value in filter_terms.items():
+                sql += (' AND filename IN (SELECT filename FROM fields'
+                        ' WHERE kind = ? AND key = ? AND instr(value, ?) > 0)')
+                params.extend([kind, key, value.lower()])
+            matches = set(
+                row[0] for row in self._connection().execute(sql, params))
+        except sqlite3.Error, err:
+            LOGGER.error('Metadata index query failed for %s: %s', kind, err)
+            return None
+        return [filename for filename in filenames if filename in matches]
+
+    def sort_values(self, kind, key, filenames, synced=False):
+        '''Returns a dictionary mapping the filenames that have key to the
+        smallest of their normalized values for key, for sorting. Returns
+        None if the index can't be used. Pass synced=True if the caller just
+        synced the index for kind'''
+        if self.disabled or kind not in INDEXED_KINDS:
+            return None
+        try:
+            if not synced:
+                with self.sync_lock:
+                    self.sync(kind, filenames)
+            rows = self._connection().execute(
+                'SELECT filename, MIN(value) FROM fields '
+                'WHERE kind = ? AND key = ? GROUP BY filename', (kind, key))
+            return dict((filename, value.decode('utf-8'))
+                        for filename, value in rows)
+        except sqlite3.Error, err:
+            LOGGER.error('Metadata index query failed for %s: %s', kind, err)
+            return None
+
+    def iter_items(self, kind, filenames, batch_size=500):
+        '''Generator that yields (filename, plist) tuples for the indexed
+        items in filenames, in order, where plist is the JSON representation
+        used by plist_api. Rows are fetched in batches so memory use doesn't
+        grow with the number of items'''
+        connection = self._connection()
+        for start in range(0, len(filenames), batch_size):
+            batch = filenames[start:start + batch_size]
+            rows = dict(connection.execute(
+                'SELECT filename, data FROM items WHERE kind = ? AND '
+                'filename IN (%s)' % ', '.join('?' * len(batch)),
+                [kind] + batch))
+            for filename in batch:
+                if filename in rows:
+                    yield filename, json.loads(rows[filename])
+
+
+METADATA_INDEX = MetadataIndex()
@@ -2,16 +2,26 @@
 api/models.py
 """
 from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.db import models
 
+import binascii
 import datetime
+import hashlib
+import threading
 import time
 import os
 import logging
 import plistlib
 from xml.parsers.expat import ExpatError
 
-from munkiwebadmin.utils import MunkiGit
+from munkiwebadmin.utils import GIT_COMMIT_QUEUE, DEFAULT_FILE_MODE
 from process.utils import record_status
+from process.runner import pkginfo_changed
+from api.repo_index import REPO_INDEX
+from api.plist_cache import PLIST_CACHE, stat_key
+from api.metadata_index import METADATA_INDEX
+from api.pkginfo_index import PKGINFO_INDEX
 
 REPO_DIR = settings.MUNKI_REPO_DIR
 
@@ -22,6 +32,65 @@ try:
 except AttributeError:
     GIT = None
 
+# uploaded data is copied to disk in pieces of this many bytes
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+# permissions of uploaded files. Django's temporary upload files are only
+# readable by their owner, so uploads moved into the repo need them set
+UPLOAD_FILE_MODE = settings.FILE_UPLOAD_PERMISSIONS or DEFAULT_FILE_MODE
+
+# partial upload path -> (bytes hashed, SHA-256 hash object), so chunked
+# uploads continued in this process don't have to be read back
+_UPLOAD_DIGESTS = {}
+_UPLOAD_DIGESTS_LOCK = threading.Lock()
+
+
+def _resume_digest(uploadpath, offset):
+    '''Returns a SHA-256 hash object for the first offset bytes of the
+    partial upload at uploadpath. Only reads the file if this process
+    didn't hash them as they were received'''
+    with _UPLOAD_DIGESTS_LOCK:
+        hashed, sha256 = _UPLOAD_DIGESTS.pop(uploadpath, (0, None))
+    if sha256 is not None and hashed == offset:
+        return sha256
+    sha256 = hashlib.sha256()
+    if offset:
+        with open(uploadpath, 'rb') as fileref:
+            remaining = offset
+            while remaining:
+                chunk = fileref.read(min(remaining, UPLOAD_BUFFER_SIZE))
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                remaining -= len(chunk)
+    return sha256
+
+
+def write_atomically(filepath, data):
+    '''Writes data to a temporary file next to filepath and renames it into
+    place, so readers never see a partially written file. The temporary
+    file's name starts with a period, so it isn't listed meanwhile'''
+    temppath = os.path.join(
+        os.path.dirname(filepath), '.%s.%s-%s.tmp' % (
+            os.path.basename(filepath), os.getpid(),
+            threading.current_thread().ident))
+    try:
+        with open(temppath, 'w') as fileref:
+            fileref.write(data)
+        try:
+            # keep the permissions of the file we're replacing
+            os.chmod(temppath, os.stat(filepath).st_mode & 07777)
+        except OSError:
+            pass
+        os.rename(temppath, filepath)
+    except (IOError, OSError):
+        try:
+            os.unlink(temppath)
+        except OSError:
+            pass
+        raise
+
+
 class FileError(Exception):
     '''Class for file errors'''
     pass
@@ -47,6 +116,12 @@ class FileDoesNotExistError(FileError):
     pass
 
 
+class FileRangeError(FileError):
+    '''Error when a chunk of an upload doesn't fit the data received so
+    far'''
+    pass
+
+
 class FileAlreadyExistsError(FileError):
     '''Error when creating a new file at an existing pathname'''
     pass
@@ -54,28 +129,27 @@ class FileAlreadyExistsError(FileError):
 
 class Plist(object):
     '''Pseudo-Django object'''
+    @classmethod
+    def get_fullpath(cls, kind, pathname):
+        '''Returns full filesystem path to requested resource'''
+        return os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
+
     @classmethod
     def list(cls, kind):
         '''Returns a list of available plists'''
-        kind_dir = os.path.join(REPO_DIR, kind)
-        plists = []
-        for dirpath, dirnames, filenames in os.walk(kind_dir):
-            record_status(
-                '%s_list_process' % kind,
-                message='Scanning %s...' % dirpath[len(kind_dir)+1:])
-            # don't recurse into directories that start with a period.
-            dirnames[:] = [name for name in dirnames
-                           if not name.startswith('.')]
-            subdir = dirpath[len(kind_dir):].lstrip(os.path.sep)
-            if os.path.sep == '\\':
-                plists.extend([os.path.join(subdir, name).replace('\\', '/')
-                               for name in filenames
-                               if not name.startswith('.')])
-            else:
-                plists.extend([os.path.join(subdir, name)
-                               for name in filenames
-                               if not name.startswith('.')])
-        return plists
+        processname = '%s_list_process' % kind
+
+        def record_progress(subdir):
+            '''Report each directory as we (re)scan it'''
+            record_status(processname, message='Scanning %s...' % subdir)
+        return REPO_INDEX.list(kind, status_callback=record_progress)
+
+    @classmethod
+    def list_done(cls, kind):
+        '''Tells status streams watching list(kind) that the list request
+        is done'''
+        record_status('%s_list_process' % kind, message='Done', force=True,
+                      exited=True)
 
     @classmethod
     def new(cls, kind, pathname, user, plist_data=None):
@@ -114,12 +188,17 @@ class Plist(object):
                 }
         data = plistlib.writePlistToString(plist)
         try:
-            with open(filepath, 'w') as fileref:
-                fileref.write(data.encode('utf-8'))
+            write_atomically(filepath, data.encode('utf-8'))
+            REPO_INDEX.invalidate(kind, pathname)
+            PLIST_CACHE.invalidate(filepath)
+            METADATA_INDEX.update(kind, pathname)
+            PKGINFO_INDEX.update(kind, pathname)
             createtimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Created %s/%s', createtimestamp, user, kind, pathname)
+            if kind == 'pkgsinfo':
+                pkginfo_changed()
             if user and GIT:
-                MunkiGit().add_file_at_path(filepath, user)
+                GIT_COMMIT_QUEUE.enqueue(filepath, user)
         except (IOError, OSError), err:
             createerrortimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Create failed for %s/%s: %s', createerrortimestamp, user, kind, pathname, err)
@@ -130,21 +209,28 @@ class Plist(object):
     def read(cls, kind, pathname):
         '''Reads a plist file and returns the plist as a dictionary'''
         filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
-        if not os.path.exists(filepath):
+        try:
+            cache_key = stat_key(os.stat(filepath))
+        except OSError:
             raise FileDoesNotExistError('%s/%s not found' % (kind, pathname))
+        plistdata = PLIST_CACHE.get(filepath, cache_key)
+        if plistdata is not None:
+            return plistdata
         try:
             plistdata = plistlib.readPlist(filepath)
-            return plistdata
         except (IOError, OSError), err:
             LOGGER.error('Read failed for %s/%s: %s', kind, pathname, err)
             raise FileReadError(err)
         except (ExpatError, IOError):
             # could not parse, return empty dict
-            return {}
+            plistdata = {}
+        PLIST_CACHE.put(filepath, cache_key, plistdata)
+        return plistdata
 
     @classmethod
-    def write(cls, data, kind, pathname, user):
-        '''Writes a text data to (plist) file'''
+    def write(cls, data, kind, pathname, user, plist=None):
+        '''Writes a text data to (plist) file. plist, if given, is data
+        already parsed, which saves the indexes from reading it back'''
         filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
         plist_parent_dir = os.path.dirname(filepath)
         if not os.path.exists(plist_parent_dir):
@@ -155,12 +241,17 @@ class Plist(object):
                 LOGGER.error('Create failed for %s/%s: %s', kind, pathname, err)
                 raise FileWriteError(err)
         try:
-            with open(filepath, 'w') as fileref:
-                fileref.write(data)
+            write_atomically(filepath, data)
+            REPO_INDEX.invalidate(kind, pathname)
+            PLIST_CACHE.invalidate(filepath)
+            METADATA_INDEX.update(kind, pathname, plist)
+            PKGINFO_INDEX.update(kind, pathname, plist)
             writetimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Wrote %s/%s', writetimestamp, user, kind, pathname)
+            if kind == 'pkgsinfo':
+                pkginfo_changed()
             if user and GIT:
-                MunkiGit().add_file_at_path(filepath, user)
+                GIT_COMMIT_QUEUE.enqueue(filepath, user)
         except (IOError, OSError), err:
             writeerrortimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.error('%s - %s: Write failed for %s/%s: %s', writeerrortimestamp, user, kind, pathname, err)
@@ -175,10 +266,16 @@ class Plist(object):
                 '%s/%s does not exist' % (kind, pathname))
         try:
             os.unlink(filepath)
+            REPO_INDEX.invalidate(kind, pathname)
+            PLIST_CACHE.invalidate(filepath)
+            METADATA_INDEX.update(kind, pathname)
+            PKGINFO_INDEX.update(kind, pathname)
             deletetimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Deleted %s/%s', deletetimestamp, user, kind, pathname)
+            if kind == 'pkgsinfo':
+                pkginfo_changed()
             if user and GIT:
-                MunkiGit().delete_file_at_path(filepath, user)
+                GIT_COMMIT_QUEUE.enqueue(filepath, user)
         except (IOError, OSError), err:
             deleteerrortimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.error('%s - %s: Delete failed for %s/%s: %s', deleteerrortimestamp, user, kind, pathname, err)
@@ -195,21 +292,7 @@ class MunkiFile(object):
     @classmethod
     def list(cls, kind):
         '''Returns a list of available plists'''
-        files_dir = os.path.join(REPO_DIR, kind)
-        files = []
-        for dirpath, dirnames, filenames in os.walk(files_dir):
-            # don't recurse into directories that start with a period.
-            dirnames[:] = [name for name in dirnames if not name.startswith('.')]
-            subdir = dirpath[len(files_dir):].lstrip(os.path.sep)
-            if os.path.sep == '\\':
-                files.extend([os.path.join(subdir, name).replace('\\', '/')
-                              for name in filenames
-                              if not name.startswith('.')])
-            else:
-                files.extend([os.path.join(subdir, name)
-                              for name in filenames
-                              if not name.startswith('.')])
-        return files
+        return REPO_INDEX.list(kind)
 
     @classmethod
     def new(cls, kind, fileupload, pathname, user):
@@ -228,36 +311,163 @@ class MunkiFile(object):
                 LOGGER.error(
                     'Create failed for %s/%s: %s', kind, pathname, err)
                 raise FileWriteError(err)
-        cls.write(kind, fileupload, pathname, user)
+        return cls.write(kind, fileupload, pathname, user)
 
     @classmethod
     def write(cls, kind, fileupload, pathname, user):
-        '''Retreives a file upload and saves it to pathname'''
+        '''Retreives a file upload and saves it to pathname. Returns a tuple
+        of the file's SHA-256 digest and its size. Uploads Django saved to a
+        temporary file and already hashed (see api.upload_handlers) are
+        moved rather than copied; others are hashed while they are copied.
+        The file is moved into place atomically'''
         filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
+        temppath = os.path.join(
+            os.path.dirname(filepath), '.%s.%s-%s.tmp' % (
+                os.path.basename(filepath), os.getpid(),
+                threading.current_thread().ident))
         try:
-            with open(filepath, 'w') as fileref:
-                for chunk in fileupload.chunks():
-                    fileref.write(chunk)
+            digest = getattr(fileupload, 'sha256', None)
+            if digest and hasattr(fileupload, 'temporary_file_path'):
+                file_move_safe(fileupload.temporary_file_path(), temppath,
+                               allow_overwrite=True)
+                size = os.path.getsize(temppath)
+            else:
+                sha256 = hashlib.sha256()
+                size = 0
+                with open(temppath, 'wb') as fileref:
+                    for chunk in fileupload.chunks(UPLOAD_BUFFER_SIZE):
+                        fileref.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                digest = sha256.hexdigest()
+            os.chmod(temppath, UPLOAD_FILE_MODE)
+            os.rename(temppath, filepath)
+            REPO_INDEX.invalidate(kind, pathname)
             writetimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Wrote %s/%s', writetimestamp, user, kind, pathname)
         except (IOError, OSError), err:
+            try:
+                os.unlink(temppath)
+            except OSError:
+                pass
             writeerrortimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Write failed for %s/%s: %s', writeerrortimestamp, user, kind, pathname, err)
             raise FileWriteError(err)
+        return digest, size
 
     @classmethod
     def writedata(cls, kind, filedata, pathname, user):
-        '''Retreives a file upload and saves it to pathname'''
+        '''Retreives a file upload and saves it to pathname. Returns a tuple
+        of the file's SHA-256 digest and its size'''
         filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
         try:
-            with open(filepath, 'w') as fileref:
-                fileref.write(filedata)
+            write_atomically(filepath, filedata)
+            REPO_INDEX.invalidate(kind, pathname)
             writedatatimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Wrote %s/%s', writedatatimestamp, user, kind, pathname)
         except (IOError, OSError), err:
             writedataerrortimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Write failed for %s/%s: %s', writedataerrortimestamp, user, kind, pathname, err)
             raise FileWriteError(err)
+        return hashlib.sha256(filedata).hexdigest(), len(filedata)
+
+    @classmethod
+    def upload_path(cls, kind, pathname):
+        '''Returns the path of the partial upload for pathname. It is a
+        dotfile in the destination directory, so it isn't listed, and can
+        be renamed into place'''
+        filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
+        return os.path.join(os.path.dirname(filepath),
+                            '.%s.upload' % os.path.basename(filepath))
+
+    @classmethod
+    def upload_offset(cls, kind, pathname):
+        '''Returns the number of bytes of the partial upload for pathname
+        received so far'''
+        try:
+            return os.path.getsize(cls.upload_path(kind, pathname))
+        except OSError:
+            return 0
+
+    @classmethod
+    def write_range(cls, kind, stream, pathname, user, offset, length,
+                    total):
+        '''Writes length bytes read from stream to the partial upload for
+        pathname, starting at offset, which must be 0 (to start over) or
+        the number of bytes received so far. Once total bytes have been
+        received, the upload is moved into place. Returns a tuple of the
+        number of bytes received so far and, once the upload is complete,
+        the file's SHA-256 digest (None before). Data is copied and hashed
+        in pieces, and what was received before an interrupted request is
+        kept, so the upload can be resumed from there'''
+        filepath = os.path.join(REPO_DIR, kind, os.path.normpath(pathname))
+        uploadpath = cls.upload_path(kind, pathname)
+        received = cls.upload_offset(kind, pathname)
+        if offset not in (0, received):
+            raise FileRangeError(
+                'Upload of %s/%s must continue at byte %s'
+                % (kind, pathname, received))
+        if offset + length > total:
+            raise FileRangeError(
+                'Chunk ends past the end of the %s byte file' % total)
+        file_parent_dir = os.path.dirname(filepath)
+        try:
+            if not os.path.exists(file_parent_dir):
+                # attempt to create missing intermediate dirs
+                os.makedirs(file_parent_dir)
+            sha256 = _resume_digest(uploadpath, offset)
+            with open(uploadpath, 'r+b' if offset else 'wb') as fileref:
+                fileref.seek(offset)
+                fileref.truncate()
+                remaining = length
+                while remaining:
+                    chunk = stream.read(min(remaining, UPLOAD_BUFFER_SIZE))
+                    if not chunk:
+                        break
+                    fileref.write(chunk)
+                    sha256.update(chunk)
+                    remaining -= len(chunk)
+                fileref.flush()
+                os.fsync(fileref.fileno())
+                received = fileref.tell()
+            if received < total:
+                with _UPLOAD_DIGESTS_LOCK:
+                    _UPLOAD_DIGESTS[uploadpath] = (received, sha256)
+            if remaining:
+                raise FileWriteError(
+                    'Upload of %s/%s interrupted at byte %s'
+                    % (kind, pathname, received))
+            if received == total:
+                os.chmod(uploadpath, UPLOAD_FILE_MODE)
+                os.rename(uploadpath, filepath)
+                REPO_INDEX.invalidate(kind, pathname)
+                writetimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+                LOGGER.info('%s - %s: Wrote %s/%s', writetimestamp, user, kind, pathname)
+        except (IOError, OSError), err:
+            LOGGER.error('Upload failed for %s/%s: %s', kind, pathname, err)
+            raise FileWriteError(err)
+        if received == total:
+            return received, sha256.hexdigest()
+        return received, None
+
+    @classmethod
+    def update_pkginfo(cls, pkg_path, digest, size, user):
+        '''Sets the installer_item_hash and installer_item_size (in KB, as
+        makepkginfo does) of every pkginfo file whose installer item is
+        pkg_path. Returns the list of pkginfo files updated'''
+        size_kb = int(size / 1024)
+        updated = []
+        for pathname in sorted(PKGINFO_INDEX.referrers(pkg_path)):
+            plist = Plist.read('pkgsinfo', pathname)
+            if (plist.get('installer_item_hash') == digest and
+                    plist.get('installer_item_size') == size_kb):
+                continue
+            plist['installer_item_hash'] = digest
+            plist['installer_item_size'] = size_kb
+            Plist.write(plistlib.writePlistToString(plist), 'pkgsinfo',
+                        pathname, user, plist=plist)
+            updated.append(pathname)
+        return updated
 
     @classmethod
     def delete(cls, kind, pathname, user):
@@ -268,6 +478,7 @@ class MunkiFile(object):
                 '%s/%s does not exist' % (kind, pathname))
         try:
             os.unlink(filepath)
+            REPO_INDEX.invalidate(kind, pathname)
             deletedatatimestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
             LOGGER.info('%s - %s: Deleted %s/%s', deletedatatimestamp, user, kind, pathname)
         except (IOError, OSError), err:
@@ -275,3 +486,30 @@ class MunkiFile(object):
             LOGGER.info('%s - %s: Delete failed for %s/%s: %s', deletedataerrortimestamp, user, kind, pathname, err)
             raise FileDeleteError(err)
         
+
+
+class ApiToken(models.Model):
+    '''A token API clients can authenticate with instead of a password.
+    Only a SHA-256 digest of each token is stored'''
+    user = models.ForeignKey(settings.AUTH_USER_MODEL,
+                             on_delete=models.CASCADE)
+    name = models.CharField(max_length=256, blank=True)
+    digest = models.CharField(max_length=64, unique=True, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.name or 'API token', self.user)
+
+    @classmethod
+    def hash_key(cls, key):
+        '''Returns the digest stored for key'''
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha256(key).hexdigest()
+
+    def set_new_key(self):
+        '''Generates a new random key for this token and returns it; it
+        can't be retrieved later'''
+        key = binascii.hexlify(os.urandom(20))
+        self.digest = self.hash_key(key)
+        return key
@@ -0,0 +1,222 @@
+"""
+api/pkginfo_index.py
+
+An in-memory index of the name, version, catalogs and installer item of
+each pkginfo file, and of the pkginfo files referencing each installer item
+"""
+import hashlib
+import logging
+import os
+import plistlib
+import threading
+import time
+from xml.parsers.expat import ExpatError
+
+from django.conf import settings
+
+from api.repo_index import REPO_INDEX
+from api.plist_cache import stat_key
+from api.walker import stat_files
+from munkiwebadmin.executor import EXECUTOR
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+PKGSINFO_PATH = os.path.join(REPO_DIR, 'pkgsinfo')
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+# how often (in seconds) to check the pkginfo files for changes made
+# outside of this process; 0 means on every lookup
+try:
+    SYNC_INTERVAL = settings.PKGINFO_INDEX_SYNC_INTERVAL
+except AttributeError:
+    SYNC_INTERVAL = 0
+
+
+def read_summary(pathname):
+    '''Worker function called by the shared executor. Reads the pkginfo
+    file at pathname (relative to pkgsinfo) and returns a tuple of its
+    installer_item_location, name, version and catalogs, or None if it
+    can't be read'''
+    filepath = os.path.join(PKGSINFO_PATH, os.path.normpath(pathname))
+    try:
+        pkginfo = plistlib.readPlist(filepath)
+    except (ExpatError, IOError, OSError):
+        return None
+    return summarize(pkginfo)
+
+
+def summarize(pkginfo):
+    '''Returns the summary of a parsed pkginfo (see read_summary), or None
+    if it isn't a dictionary'''
+    try:
+        return (pkginfo.get('installer_item_location') or None,
+                pkginfo.get('name', 'NO_NAME'),
+                pkginfo.get('version', 'NO_VERSION'),
+                pkginfo.get('catalogs', []))
+    except AttributeError:
+        # not a dictionary
+        return None
+
+
+class PkginfoIndex(object):
+    '''Maps each pkginfo file to a summary of it (see read_summary), and
+    each installer item (relative to pkgs) to the set of pkginfo files
+    referencing it. Built from the files once, kept up to date by update()
+    when pkginfo files are written through the Plist class, and re-synced
+    with the files on disk (by comparing mtimes and sizes) before lookups.
+    Syncing stats every pkginfo file, so operations making many lookups
+    should call sync() once and pass sync=False to the lookups'''
+    def __init__(self):
+        # pkginfo pathname -> (stat key, summary)
+        self.entries = {}
+        # pkginfo pathnames in the order they were listed
+        self.pathnames = []
+        # installer item location -> set of pkginfo pathnames
+        self.refs = {}
+        self.last_sync = 0
+        # digest of pathnames and their stat keys; None when out of date
+        self.digest = None
+        self.lock = threading.Lock()
+
+    def _set(self, pathname, entry):
+        '''Replaces the entry for pathname (removes it if entry is None),
+        maintaining the reverse mapping'''
+        self.digest = None
+        old_entry = self.entries.pop(pathname, None)
+        if old_entry is not None and old_entry[1] and old_entry[1][0]:
+            pkg_path = old_entry[1][0]
+            referrers = self.refs.get(pkg_path)
+            if referrers is not None:
+                referrers.discard(pathname)
+                if not referrers:
+                    del self.refs[pkg_path]
+        if entry is not None:
+            self.entries[pathname] = entry
+            if entry[1] and entry[1][0]:
+                self.refs.setdefault(entry[1][0], set()).add(pathname)
+
+    def _index_file(self, pathname, pkginfo=None):
+        '''Reads the file at pathname and (re)indexes it. pkginfo, if given,
+        is the file's already parsed contents'''
+        filepath = os.path.join(PKGSINFO_PATH, os.path.normpath(pathname))
+        try:
+            cache_key = stat_key(os.stat(filepath))
+        except OSError:
+            self._set(pathname, None)
+            return
+        if pkginfo is None:
+            summary = read_summary(pathname)
+        else:
+            summary = summarize(pkginfo)
+        self._set(pathname, (cache_key, summary))
+
+    def _sync(self, status_callback=None):
+        '''Brings the index up to date with the files on disk. Changed and
+        new files are read using the shared executor'''
+        if SYNC_INTERVAL and time.time() - self.last_sync < SYNC_INTERVAL:
+            return
+        pathnames = REPO_INDEX.list('pkgsinfo')
+        for pathname in set(self.entries) - set(pathnames):
+            self._set(pathname, None)
+        stat_keys = stat_files(PKGSINFO_PATH, pathnames)
+        if len(stat_keys) < len(pathnames):
+            # files removed since they were listed
+            present = set(pathname for pathname, _ in stat_keys)
+            pathnames = [pathname for pathname in pathnames
+                         if pathname in present]
+            for pathname in set(self.entries) - present:
+                self._set(pathname, None)
+        changed = []
+        for pathname, cache_key in stat_keys:
+            entry = self.entries.get(pathname)
+            if entry is None or entry[0] != cache_key:
+                changed.append((pathname, cache_key))
+        if changed and status_callback:
+            status_callback('Reading %s changed files' % len(changed))
+        summaries = EXECUTOR.imap(
+            read_summary, [pathname for pathname, _ in changed])
+        for (pathname, cache_key), summary in zip(changed, summaries):
+            self._set(pathname, (cache_key, summary))
+        if pathnames != self.pathnames:
+            self.digest = None
+        self.pathnames = pathnames
+        self.last_sync = time.time()
+
+    def update(self, kind, pathname, plist=None):
+        '''Re-indexes a single file after it was created, written or
+        deleted. plist, if given, is the file's new contents'''
+        if kind != 'pkgsinfo':
+            return
+        with self.lock:
+            self._index_file(pathname, plist)
+            if pathname in self.entries:
+                if pathname not in self.pathnames:
+                    self.pathnames.append(pathname)
+            elif pathname in self.pathnames:
+                self.pathnames.remove(pathname)
+            self.digest = None
+
+    def sync(self):
+        '''Brings the index up to date with the files on disk'''
+        with self.lock:
+            self._sync()
+
+    def validator(self, sync=True, status_callback=None):
+        '''Returns a digest of the names, modification times and sizes of
+        the pkginfo files, for use in ETags. It is computed from the
+        index, so it costs no more than a sync. If sync is False, the index
+        isn't synced first'''
+        with self.lock:
+            if sync:
+                self._sync(status_callback)
+            if self.digest is None:
+                digest = hashlib.sha1()
+                for pathname in self.pathnames:
+                    entry = self.entries.get(pathname)
+                    digest.update('%s\0%r\0' % (
+                        pathname, entry[0] if entry else None))
+                self.digest = digest.hexdigest()
+            return self.digest
+
+    def installer_item_location(self, pathname, sync=True):
+        '''Returns the installer item referenced by the pkginfo file at
+        pathname, or None. If sync is False, the index isn't synced
+        first'''
+        with self.lock:
+            if sync:
+                self._sync()
+            entry = self.entries.get(pathname)
+            return entry[1][0] if entry and entry[1] else None
+
+    def referrers(self, pkg_path, sync=True):
+        '''Returns the set of pkginfo files referencing pkg_path. If sync is
+        False, the index isn't synced first'''
+        with self.lock:
+            if sync:
+                self._sync()
+            return set(self.refs.get(pkg_path, ()))
+
+    def ref_count(self, pkg_path, sync=True):
+        '''Returns the number of pkginfo files referencing pkg_path. If sync
+        is False, the index isn't synced first'''
+        with self.lock:
+            if sync:
+                self._sync()
+            return len(self.refs.get(pkg_path, ()))
+
+    def summaries(self, status_callback=None, sync=True):
+        '''Returns a list of (pathname, summary) tuples for the readable
+        pkginfo files, in the order they are listed. If sync is False, the
+        index isn't synced first'''
+        with self.lock:
+            if sync:
+                self._sync(status_callback)
+            summaries = []
+            for pathname in self.pathnames:
+                entry = self.entries.get(pathname)
+                if entry and entry[1]:
+                    summaries.append((pathname, entry[1]))
+            return summaries
+
+
+PKGINFO_INDEX = PkginfoIndex()
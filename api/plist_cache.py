@@ -0,0 +1,104 @@
+"""
+api/plist_cache.py
+
+A bounded LRU cache of parsed plists, validated against the file's
+modification time and size
+"""
+import plistlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    MAX_BYTES = settings.PLIST_CACHE_MAX_BYTES
+except AttributeError:
+    MAX_BYTES = 64 * 1024 * 1024
+
+
+def stat_key(stat_result):
+    '''Returns a (mtime in nanoseconds, size) tuple for a stat result.
+    Always derived from st_mtime: a scandir stat result has st_mtime_ns
+    where os.stat on Python 2 doesn't, and keys for the same file must
+    match whichever way it was stat'ed'''
+    return (int(stat_result.st_mtime * 1000000000), stat_result.st_size)
+
+
+def copy_plist(value):
+    '''Returns a copy of a plist structure that can be modified without
+    affecting the original. Much cheaper than copy.deepcopy since we only
+    need to handle plist types'''
+    if isinstance(value, dict):
+        return dict((key, copy_plist(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [copy_plist(item) for item in value]
+    if isinstance(value, plistlib.Data):
+        return plistlib.Data(value.data)
+    # strings, numbers, booleans and datetimes are immutable
+    return value
+
+
+class PlistCache(object):
+    '''LRU cache of parsed plists keyed by path. The memory budget is
+    approximated by the on-disk size of the cached files'''
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filepath, key):
+        '''Returns a copy of the cached plist for filepath if it is still
+        valid for key (see stat_key), otherwise None'''
+        with self.lock:
+            entry = self.entries.pop(filepath, None)
+            if entry is None or entry[0] != key:
+                if entry is not None:
+                    self.total_bytes -= entry[0][1]
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self.entries[filepath] = entry
+            self.hits += 1
+            plist = entry[1]
+        return copy_plist(plist)
+
+    def put(self, filepath, key, plist):
+        '''Caches a copy of plist for filepath'''
+        size = key[1]
+        if size > self.max_bytes:
+            return
+        plist = copy_plist(plist)
+        with self.lock:
+            old_entry = self.entries.pop(filepath, None)
+            if old_entry is not None:
+                self.total_bytes -= old_entry[0][1]
+            self.entries[filepath] = (key, plist)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and self.entries:
+                _, (old_key, _) = self.entries.popitem(last=False)
+                self.total_bytes -= old_key[1]
+
+    def invalidate(self, filepath):
+        '''Removes any cached plist for filepath'''
+        with self.lock:
+            entry = self.entries.pop(filepath, None)
+            if entry is not None:
+                self.total_bytes -= entry[0][1]
+
+    def stats(self):
+        '''Returns a dictionary of cache counters'''
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': (float(self.hits) / lookups
+                                 if lookups else 0.0),
+                    'entries': len(self.entries),
+                    'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
+
+
+PLIST_CACHE = PlistCache()
@@ -0,0 +1,277 @@
+"""
+api/repo_index.py
+
+A process-wide, incrementally refreshed index of the relative paths of the
+files in the Munki repo subdirectories (pkgsinfo, manifests, pkgs, etc)
+"""
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from api.walker import scan_dir
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+try:
+    USE_INOTIFY = settings.REPO_INDEX_USE_INOTIFY
+except AttributeError:
+    USE_INOTIFY = False
+
+# directories modified this recently are re-listed on the next refresh, since
+# a change within the same mtime tick (one second or worse on some
+# filesystems) would not change the directory's mtime again
+UNSETTLED_SECONDS = 2
+
+
+class _DirEntry(object):
+    '''Cached listing of a single directory'''
+    def __init__(self, mtime, filenames, subdirs, unsettled):
+        self.mtime = mtime
+        self.filenames = filenames
+        self.subdirs = subdirs
+        self.unsettled = unsettled
+
+
+class _KindIndex(object):
+    '''Index of the files in a single repo subdirectory'''
+    def __init__(self, kind):
+        self.kind = kind
+        self.kind_dir = os.path.join(REPO_DIR, kind)
+        self.dirs = {}
+        self.dirty = set()
+        self.watched = False
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _scan_dir(self, subdir, status_callback=None):
+        '''Lists a single directory; returns a _DirEntry or None if the
+        directory is not there'''
+        dirpath = os.path.join(self.kind_dir, subdir)
+        if status_callback:
+            status_callback(subdir)
+        try:
+            mtime = os.stat(dirpath).st_mtime
+            filenames, subdirs = scan_dir(dirpath)
+        except OSError:
+            return None
+        unsettled = time.time() - mtime < UNSETTLED_SECONDS
+        return _DirEntry(mtime, filenames, subdirs, unsettled)
+
+    def _load(self, subdir, status_callback=None):
+        '''(Re)lists subdir and any of its subdirectories that are new or
+        were not yet indexed; returns the number of directories listed'''
+        entry = self._scan_dir(subdir, status_callback)
+        if entry is None:
+            self._forget(subdir)
+            return 1
+        old_entry = self.dirs.get(subdir)
+        if old_entry:
+            for name in set(old_entry.subdirs) - set(entry.subdirs):
+                self._forget(os.path.join(subdir, name))
+        self.dirs[subdir] = entry
+        count = 1
+        for name in entry.subdirs:
+            child = os.path.join(subdir, name)
+            if child not in self.dirs:
+                count += self._load(child, status_callback)
+        return count
+
+    def _forget(self, subdir):
+        '''Drops subdir and everything below it from the index'''
+        entry = self.dirs.pop(subdir, None)
+        if entry:
+            for name in entry.subdirs:
+                self._forget(os.path.join(subdir, name))
+
+    def refresh(self, status_callback=None):
+        '''Brings the index up to date. Returns a tuple of (was_full_scan,
+        number of directories re-listed)'''
+        if not self.loaded:
+            self.dirs = {}
+            self.dirty = set()
+            count = self._load('', status_callback)
+            self.loaded = True
+            return True, count
+        count = 0
+        if self.watched:
+            # inotify tells us which directories changed
+            candidates = self.dirty
+            self.dirty = set()
+            candidates.update(
+                subdir for subdir, entry in self.dirs.items()
+                if entry.unsettled)
+        else:
+            candidates = set()
+            for subdir, entry in self.dirs.items():
+                if entry.unsettled:
+                    candidates.add(subdir)
+                    continue
+                try:
+                    mtime = os.stat(
+                        os.path.join(self.kind_dir, subdir)).st_mtime
+                except OSError:
+                    mtime = None
+                if mtime != entry.mtime:
+                    candidates.add(subdir)
+            candidates.update(self.dirty)
+            self.dirty = set()
+        # parent directories first so removed subtrees are dropped before
+        # we try to list their children
+        for subdir in sorted(candidates, key=lambda d: d.count(os.path.sep)):
+            if subdir == '' or os.path.dirname(subdir) in self.dirs:
+                count += self._load(subdir, status_callback)
+        return False, count
+
+    def paths(self):
+        '''Returns the indexed relative paths in os.walk order'''
+        paths = []
+        self._collect('', paths)
+        return paths
+
+    def _collect(self, subdir, paths):
+        '''Appends the files in subdir, then those in its subdirectories'''
+        entry = self.dirs.get(subdir)
+        if entry is None:
+            return
+        if os.path.sep == '\\':
+            paths.extend([os.path.join(subdir, name).replace('\\', '/')
+                          for name in entry.filenames])
+        else:
+            paths.extend([os.path.join(subdir, name)
+                          for name in entry.filenames])
+        for name in entry.subdirs:
+            self._collect(os.path.join(subdir, name), paths)
+
+
+class _EventHandler(object):
+    '''Marks the directories named in inotify events as dirty'''
+    def __init__(self, repo_index):
+        self.repo_index = repo_index
+
+    def __call__(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            # we lost events; start over
+            self.repo_index.mark_all_unloaded()
+        else:
+            self.repo_index.mark_dirty_path(event.path)
+
+
+class RepoIndex(object):
+    '''Process-wide cache of the file listings of repo subdirectories.
+    Directories are re-listed only when their mtime changes, or when inotify
+    (via the optional pyinotify module) reports a change'''
+    def __init__(self):
+        self.kinds = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.notifier = None
+        self.watch_manager = None
+
+    def _kind_index(self, kind):
+        '''Returns the _KindIndex for kind, creating it if needed'''
+        with self.lock:
+            if kind not in self.kinds:
+                self.kinds[kind] = _KindIndex(kind)
+            return self.kinds[kind]
+
+    def _watch(self, kind_index):
+        '''Starts watching the directory tree for kind_index with inotify'''
+        if not (pyinotify and USE_INOTIFY) or kind_index.watched:
+            return
+        try:
+            with self.lock:
+                if self.notifier is None:
+                    self.watch_manager = pyinotify.WatchManager()
+                    self.notifier = pyinotify.ThreadedNotifier(
+                        self.watch_manager)
+                    self.notifier.daemon = True
+                    self.notifier.start()
+            mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                    pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                    pyinotify.IN_Q_OVERFLOW)
+            self.watch_manager.add_watch(
+                kind_index.kind_dir, mask, proc_fun=_EventHandler(self),
+                rec=True, auto_add=True, quiet=False)
+            kind_index.watched = True
+        except Exception, err:
+            LOGGER.warning(
+                'Could not watch %s with inotify: %s', kind_index.kind_dir,
+                err)
+
+    def mark_dirty_path(self, dirpath):
+        '''Marks the directory at dirpath (a full path) as needing to be
+        re-listed'''
+        with self.lock:
+            kind_indexes = self.kinds.values()
+        for kind_index in kind_indexes:
+            kind_dir = kind_index.kind_dir
+            if dirpath == kind_dir:
+                subdir = ''
+            elif dirpath.startswith(kind_dir + os.path.sep):
+                subdir = dirpath[len(kind_dir)+1:]
+            else:
+                continue
+            with kind_index.lock:
+                kind_index.dirty.add(subdir)
+
+    def mark_all_unloaded(self):
+        '''Forces a full rescan of every kind on the next request'''
+        with self.lock:
+            kind_indexes = self.kinds.values()
+        for kind_index in kind_indexes:
+            with kind_index.lock:
+                kind_index.loaded = False
+
+    def invalidate(self, kind, pathname):
+        '''Tells the index that the file at kind/pathname was created or
+        removed'''
+        kind_dir = os.path.join(REPO_DIR, kind)
+        parent = os.path.dirname(
+            os.path.join(kind_dir, os.path.normpath(pathname)))
+        # intermediate directories may have been created as well
+        while parent.startswith(kind_dir):
+            self.mark_dirty_path(parent)
+            parent = os.path.dirname(parent)
+
+    def list(self, kind, status_callback=None):
+        '''Returns a list of the relative paths of the files in kind.
+        status_callback, if given, is called with the relative path of each
+        directory as it is listed'''
+        kind_index = self._kind_index(kind)
+        self._watch(kind_index)
+        with kind_index.lock:
+            full_scan, count = kind_index.refresh(status_callback)
+            paths = kind_index.paths()
+        with self.lock:
+            if full_scan:
+                self.misses += 1
+            elif count:
+                self.refreshes += 1
+            else:
+                self.hits += 1
+        return paths
+
+    def stats(self):
+        '''Returns a dictionary of cache counters'''
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'refreshes': self.refreshes,
+                    'inotify': self.notifier is not None,
+                    'directories': sum(len(kind_index.dirs)
+                                       for kind_index in self.kinds.values())}
+
+
+REPO_INDEX = RepoIndex()
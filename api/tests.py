@@ -0,0 +1,520 @@
+import base64
+import datetime
+import hashlib
+import json
+import os
+import plistlib
+import shutil
+import tempfile
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.files.uploadedfile import SimpleUploadedFile, \
+    TemporaryUploadedFile
+from django.http import HttpResponse
+from django.http.request import RawPostDataException
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils.http import http_date
+
+from api import metadata_index, models, views, walker
+from api.models import ApiToken, MunkiFile
+from munkiwebadmin import django_basic_auth, utils
+
+
+class DateFilterTest(SimpleTestCase):
+    '''Filtering on a date matches the same items whether or not the
+    metadata index is used'''
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.repo_dir, 'pkgsinfo'))
+        plistlib.writePlist(
+            {'name': 'Firefox', 'force_install_after_date':
+                 datetime.datetime(2016, 1, 2, 3, 4, 5)},
+            os.path.join(self.repo_dir, 'pkgsinfo', 'Firefox'))
+        self.saved = (models.REPO_DIR, metadata_index.REPO_DIR)
+        models.REPO_DIR = metadata_index.REPO_DIR = self.repo_dir
+        self.index = metadata_index.MetadataIndex(
+            os.path.join(self.repo_dir, 'index.sqlite3'))
+
+    def tearDown(self):
+        models.REPO_DIR, metadata_index.REPO_DIR = self.saved
+        shutil.rmtree(self.repo_dir)
+
+    def matches(self, value):
+        '''Returns whether the item matched from the index, and from the
+        files for JSON and for XML responses'''
+        terms = {'force_install_after_date': value}
+        return (
+            self.index.query('pkgsinfo', ['Firefox'], terms) == ['Firefox'],
+            views.read_list_item(
+                ('pkgsinfo', 'Firefox', terms, [], 'json')) is not None,
+            views.read_list_item(
+                ('pkgsinfo', 'Firefox', terms, [], 'xml_plist')) is not None)
+
+    def test_iso_date_matches_everywhere(self):
+        self.assertEqual(self.matches('2016-01-02T03:04'),
+                         (True, True, True))
+
+    def test_space_separated_date_matches_nowhere(self):
+        self.assertEqual(self.matches('2016-01-02 03:04'),
+                         (False, False, False))
+
+
+class WalkerTest(SimpleTestCase):
+    '''list_files gets the stat results from the directory listing'''
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, 'subdir'))
+        for name in ['one', 'two', '.hidden']:
+            with open(os.path.join(self.dirpath, name), 'w') as fileref:
+                fileref.write(name)
+        self.saved = (walker.scandir, os.stat)
+
+    def tearDown(self):
+        walker.scandir, os.stat = self.saved
+        shutil.rmtree(self.dirpath)
+
+    def expected(self):
+        return sorted(
+            (name, models.stat_key(os.stat(os.path.join(self.dirpath, name))))
+            for name in ['one', 'two'])
+
+    def test_list_files(self):
+        expected = self.expected()
+        stat_calls = []
+
+        def counting_stat(*args):
+            stat_calls.append(args)
+            return self.saved[1](*args)
+        os.stat = counting_stat
+        self.assertEqual(sorted(walker.list_files(self.dirpath)), expected)
+        if walker.scandir is not None:
+            self.assertEqual(stat_calls, [])
+
+    def test_list_files_without_scandir(self):
+        walker.scandir = None
+        self.assertEqual(sorted(walker.list_files(self.dirpath)),
+                         self.expected())
+
+
+class CursorTest(SimpleTestCase):
+    '''Paging cursors round trip, and bad ones raise ValueError'''
+    def test_round_trip(self):
+        cursor = views.encode_cursor('-version', u'1.0', u'apps/Firefox')
+        self.assertEqual(views.decode_cursor(cursor, '-version'),
+                         (u'1.0', u'apps/Firefox'))
+
+    def test_cursor_is_url_safe(self):
+        cursor = views.encode_cursor('filename', '', u'\xff\xfe?/+')
+        self.assertFalse(set(cursor) & set('+/'))
+
+    def test_wrong_sort_order(self):
+        cursor = views.encode_cursor('filename', '', 'apps/Firefox')
+        with self.assertRaises(ValueError):
+            views.decode_cursor(cursor, '-filename')
+
+    def test_malformed_cursors(self):
+        for cursor in ('', 'not base64!', 'abc', u'\xe9',
+                       base64.urlsafe_b64encode('not json')):
+            with self.assertRaises(ValueError):
+                views.decode_cursor(cursor, 'filename')
+
+    def test_tampered_cursors(self):
+        for value in (None, 5, 'abc', {}, ['filename', ''],
+                      ['filename', '', 'a', 'b'], ['filename', '', None],
+                      ['filename', '', ['apps/Firefox']]):
+            cursor = base64.urlsafe_b64encode(json.dumps(value))
+            with self.assertRaises(ValueError):
+                views.decode_cursor(cursor, 'filename')
+
+    def test_non_ascii_filename(self):
+        cursor = views.encode_cursor('filename', '', 'caf\xc3\xa9')
+        _, filename = views.decode_cursor(cursor, 'filename')
+        self.assertEqual(filename, 'caf\xc3\xa9')
+        self.assertIsInstance(filename, str)
+
+    def test_paged_list_with_non_ascii_filenames(self):
+        repo_dir = tempfile.mkdtemp()
+        saved_repo_dir = models.REPO_DIR
+        models.REPO_DIR = repo_dir
+        try:
+            os.mkdir(os.path.join(repo_dir, 'manifests'))
+            names = ['caf\xc3\xa9', 'na\xc3\xafve', 'r\xc3\xa9sum\xc3\xa9']
+            for name in names:
+                plistlib.writePlist({'catalogs': []}, os.path.join(
+                    repo_dir, 'manifests', name))
+            pages = []
+            cursor = ''
+            while True:
+                response = views.paged_plist_list(
+                    None, 'manifests',
+                    {'api_limit': ['1'], 'api_cursor': [cursor]},
+                    ['filename'], 'json', item_list=list(names))
+                self.assertEqual(response.status_code, 200)
+                pages.extend(item['filename']
+                             for item in json.loads(response.content))
+                if not response.has_header('X-Next-Cursor'):
+                    break
+                cursor = response['X-Next-Cursor']
+            self.assertEqual(pages, [name.decode('utf-8') for name in names])
+        finally:
+            models.REPO_DIR = saved_repo_dir
+            shutil.rmtree(repo_dir)
+
+    def test_paged_list_rejects_bad_cursor(self):
+        response = views.paged_plist_list(
+            None, 'pkgsinfo', {'api_cursor': ['garbage']}, ['filename'],
+            'json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['exception_type'],
+                         'BadRequest')
+
+
+class CredentialCacheTest(TestCase):
+    '''Verified credentials are cached as user ids, and users are read
+    again on every request'''
+    def setUp(self):
+        self.user = User.objects.create_user('apiuser', password='secret')
+        token = ApiToken(user=self.user)
+        self.key = token.set_new_key()
+        token.save()
+        self.saved_ttl = django_basic_auth.BASIC_AUTH_CACHE.ttl
+        django_basic_auth.BASIC_AUTH_CACHE.ttl = 60
+
+    def tearDown(self):
+        django_basic_auth.BASIC_AUTH_CACHE.ttl = self.saved_ttl
+        django_basic_auth.clear_credential_caches()
+
+    def test_token_cache_keeps_user_id(self):
+        self.assertEqual(django_basic_auth.token_user(self.key), self.user)
+        self.assertEqual(django_basic_auth.TOKEN_CACHE.get(self.key),
+                         self.user.pk)
+
+    def test_deactivated_user_is_rejected(self):
+        django_basic_auth.token_user(self.key)
+        django_basic_auth.basicauth_user('apiuser', 'secret')
+        # as if deactivated by another process: no signal is sent
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(django_basic_auth.token_user(self.key))
+        self.assertFalse(
+            django_basic_auth.basicauth_user('apiuser', 'secret').is_active)
+
+    def test_cached_basic_auth_user_has_backend(self):
+        django_basic_auth.basicauth_user('apiuser', 'secret')
+        user = django_basic_auth.basicauth_user('apiuser', 'secret')
+        self.assertEqual(user, self.user)
+        self.assertEqual(user.backend,
+                         'django.contrib.auth.backends.ModelBackend')
+
+    def test_user_save_clears_caches(self):
+        django_basic_auth.token_user(self.key)
+        django_basic_auth.basicauth_user('apiuser', 'secret')
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertIsNone(django_basic_auth.TOKEN_CACHE.get(self.key))
+        self.assertIsNone(
+            django_basic_auth.basicauth_user('apiuser', 'secret'))
+
+    def test_last_login_update_keeps_caches(self):
+        django_basic_auth.token_user(self.key)
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(django_basic_auth.TOKEN_CACHE.get(self.key),
+                         self.user.pk)
+
+    def test_deleted_token_is_rejected(self):
+        django_basic_auth.token_user(self.key)
+        ApiToken.objects.filter(user=self.user).delete()
+        self.assertIsNone(django_basic_auth.token_user(self.key))
+
+
+class ViewOrBasicauthTest(TestCase):
+    '''Header credentials run the view as their user, without a session;
+    errors in the view are not turned into 401s'''
+    def setUp(self):
+        self.user = User.objects.create_user('apiuser', password='secret')
+        token = ApiToken(user=self.user)
+        self.key = token.set_new_key()
+        token.save()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        django_basic_auth.clear_credential_caches()
+
+    def request(self, authorization):
+        request = self.factory.get('/api/manifests',
+                                   HTTP_AUTHORIZATION=authorization)
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        return request
+
+    def basic(self, password='secret'):
+        return 'Basic ' + base64.b64encode('apiuser:' + password)
+
+    def call(self, request, view):
+        return django_basic_auth.logged_in_or_basicauth()(view)(request)
+
+    def test_basic_auth_starts_no_session(self):
+        request = self.request(self.basic())
+        response = self.call(
+            request, lambda request: HttpResponse(request.user.username))
+        self.assertEqual(response.content, 'apiuser')
+        self.assertEqual(request.user, self.user)
+        self.assertEqual(request.session.keys(), [])
+        self.assertFalse(Session.objects.exists())
+
+    def test_wrong_password(self):
+        response = self.call(self.request(self.basic('wrong')),
+                             lambda request: HttpResponse())
+        self.assertEqual(response.status_code, 401)
+
+    def test_view_errors_are_not_401s(self):
+        def failing_view(request):
+            raise ValueError('view failed')
+        for authorization in (self.basic(), 'Token ' + self.key):
+            self.assertRaises(ValueError, self.call,
+                              self.request(authorization), failing_view)
+
+
+class BatchOperationTest(SimpleTestCase):
+    '''Malformed batch operations fail with a 400 of their own'''
+    def assertBadRequest(self, operation, detail):
+        result = views.batch_operation(None, operation)
+        self.assertEqual(result['status'], 400)
+        self.assertEqual(result['result']['detail'], detail)
+
+    def test_bad_kind(self):
+        for operation in (None, [], {}, {'kind': 'pkgs'}):
+            self.assertBadRequest(
+                operation,
+                'kind must be one of manifests, pkgsinfo or catalogs')
+
+    def test_query_must_be_object(self):
+        for query in (['a'], 'a=b', 5):
+            self.assertBadRequest({'kind': 'manifests', 'query': query},
+                                  'query must be an object')
+
+    def test_filename_must_be_string(self):
+        self.assertBadRequest({'kind': 'manifests', 'filename': ['a']},
+                              'filename must be a string')
+
+    def test_filename_must_stay_in_repo(self):
+        for filename in ('/etc/passwd', '../../etc/passwd', 'a/../../b',
+                         '..', u'site/..'):
+            self.assertBadRequest(
+                {'kind': 'manifests', 'filename': filename},
+                'filename must be a relative path without ..')
+
+
+class UploadTest(SimpleTestCase):
+    '''Uploads in chunks must arrive in order, and uploaded files get the
+    usual permissions'''
+    data = '0123456789abcdefghijABCDEFGHIJ'
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.repo_dir, 'pkgs'))
+        self.saved_repo_dir = models.REPO_DIR
+        models.REPO_DIR = self.repo_dir
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        models.REPO_DIR = self.saved_repo_dir
+        shutil.rmtree(self.repo_dir)
+
+    def put(self, data, content_range=None):
+        '''Returns the response to a PUT of data to pkgs/apps/item.dmg'''
+        extra = {}
+        if content_range:
+            extra['HTTP_CONTENT_RANGE'] = content_range
+        request = self.factory.put('/api/pkgs/apps/item.dmg', data,
+                                   content_type='application/octet-stream',
+                                   **extra)
+        request.user = User(username='uploader')
+        return views.put_file_range(request, 'pkgs', 'apps/item.dmg')
+
+    def test_malformed_content_range(self):
+        for content_range in ('bytes 0-9', 'bytes=0-9/30', 'items 0-9/30',
+                              'bytes 0-/30', 'bytes -9/30'):
+            response = self.put(self.data[:10], content_range)
+            self.assertEqual(response.status_code, 400)
+
+    def test_content_range_must_match_length(self):
+        response = self.put(self.data[:10], 'bytes 0-19/30')
+        self.assertEqual(response.status_code, 400)
+
+    def test_chunks_in_order(self):
+        response = self.put(self.data[:10], 'bytes 0-9/30')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Range'], 'bytes=0-9')
+        self.put(self.data[10:20], 'bytes 10-19/30')
+        response = self.put(self.data[20:], 'bytes 20-29/30')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+        filepath = os.path.join(self.repo_dir, 'pkgs', 'apps', 'item.dmg')
+        with open(filepath) as fileref:
+            self.assertEqual(fileref.read(), self.data)
+        self.assertEqual(os.stat(filepath).st_mode & 07777,
+                         models.UPLOAD_FILE_MODE)
+
+    def test_gap_between_chunks(self):
+        self.put(self.data[:10], 'bytes 0-9/30')
+        response = self.put(self.data[20:], 'bytes 20-29/30')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */30')
+        self.assertEqual(json.loads(response.content)['offset'], 10)
+
+    def test_chunk_past_end(self):
+        response = self.put(self.data[:10], 'bytes 0-9/5')
+        self.assertEqual(response.status_code, 416)
+
+    def test_status_query(self):
+        self.put(self.data[:10], 'bytes 0-9/30')
+        response = self.put('', 'bytes */30')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(json.loads(response.content)['offset'], 10)
+        self.assertEqual(response['Range'], 'bytes=0-9')
+
+    def override(self, data, **extra):
+        '''Returns the request and the response to a POST to
+        pkgs/apps/item.dmg overridden as a PUT'''
+        request = self.factory.post('/api/pkgs/apps/item.dmg', data,
+                                    HTTP_X_METHODOVERRIDE='PUT', **extra)
+        request.user = User(username='uploader', is_superuser=True)
+        return request, views.file_api(request, 'pkgs', 'apps/item.dmg')
+
+    def assert_uploaded(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['sha256'],
+                         hashlib.sha256(self.data).hexdigest())
+        filepath = os.path.join(self.repo_dir, 'pkgs', 'apps', 'item.dmg')
+        with open(filepath) as fileref:
+            self.assertEqual(fileref.read(), self.data)
+
+    def test_override_put_streams_body(self):
+        request, response = self.override(
+            self.data, content_type='application/octet-stream')
+        self.assert_uploaded(response)
+        # the body was streamed, not read into memory
+        self.assertRaises(RawPostDataException, lambda: request.body)
+
+    def test_override_put_form(self):
+        request, response = self.override(
+            {'filedata': SimpleUploadedFile('item.dmg', self.data)})
+        self.assert_uploaded(response)
+        self.assertRaises(RawPostDataException, lambda: request.body)
+
+    def test_moved_upload_permissions(self):
+        upload = TemporaryUploadedFile(
+            'item.dmg', 'application/octet-stream', len(self.data), None)
+        upload.write(self.data)
+        upload.flush()
+        upload.sha256 = hashlib.sha256(self.data).hexdigest()
+        self.assertEqual(
+            os.stat(upload.temporary_file_path()).st_mode & 0777, 0600)
+        self.assertEqual(
+            MunkiFile.write('pkgs', upload, 'item.dmg', None),
+            (upload.sha256, len(self.data)))
+        # the temporary file is gone now
+        upload.close()
+        filepath = os.path.join(self.repo_dir, 'pkgs', 'item.dmg')
+        self.assertEqual(os.stat(filepath).st_mode & 07777,
+                         models.UPLOAD_FILE_MODE)
+
+
+class ByteRangeTest(SimpleTestCase):
+    '''Range headers are parsed as RFC 7233 says, for a single range'''
+    def test_ranges(self):
+        for header, expected in (('bytes=0-9', (0, 9)),
+                                 ('bytes= 10 - 19 ', (10, 19)),
+                                 ('bytes=90-', (90, 99)),
+                                 ('bytes=50-500', (50, 99)),
+                                 ('bytes=99-99', (99, 99))):
+            self.assertEqual(utils.parse_byte_range(header, 100), expected)
+
+    def test_suffix_ranges(self):
+        self.assertEqual(utils.parse_byte_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(utils.parse_byte_range('bytes=-500', 100), (0, 99))
+
+    def test_unsatisfiable_ranges(self):
+        for header, size in (('bytes=100-', 100), ('bytes=100-200', 100),
+                             ('bytes=-0', 100), ('bytes=-10', 0),
+                             ('bytes=0-', 0)):
+            with self.assertRaises(ValueError):
+                utils.parse_byte_range(header, size)
+
+    def test_ignored_ranges(self):
+        # the whole file is sent for these
+        for header in (None, '', 'bytes=', 'bytes=-', 'bytes=a-b',
+                       'items=0-9', 'bytes=10-5', 'bytes=0-9,20-29',
+                       'bytes=0-50, 25-75', 'bytes=0-9,'):
+            self.assertIsNone(utils.parse_byte_range(header, 100))
+
+    def test_if_range(self):
+        factory = RequestFactory()
+        last_modified = 1475000000
+        date = http_date(last_modified)
+        for if_range, expected in ((None, True),
+                                   ('"abc-1"', True),
+                                   ('"abc-2"', False),
+                                   ('W/"abc-1"', False),
+                                   (date, True),
+                                   (http_date(last_modified - 1), False),
+                                   ('yesterday', False)):
+            extra = {'HTTP_IF_RANGE': if_range} if if_range else {}
+            request = factory.get('/api/pkgs/item.dmg', **extra)
+            self.assertEqual(
+                utils.if_range_matches(request, 'abc-1', last_modified),
+                expected, if_range)
+        request = factory.get('/api/pkgs/item.dmg', HTTP_IF_RANGE=date)
+        self.assertFalse(utils.if_range_matches(request, 'abc-1', None))
+
+
+class FileDownloadTest(SimpleTestCase):
+    '''Downloads honour a single Range, and If-Range'''
+    data = '0123456789' * 10
+
+    def setUp(self):
+        fileno, self.fullpath = tempfile.mkstemp()
+        os.write(fileno, self.data)
+        os.close(fileno)
+        self.stat_result = os.stat(self.fullpath)
+        self.etag = utils.stat_etag(self.stat_result)
+
+    def tearDown(self):
+        os.unlink(self.fullpath)
+
+    def get(self, **extra):
+        '''Returns the response to a GET of the file'''
+        request = RequestFactory().get('/api/pkgs/item.dmg', **extra)
+        return views.file_download_response(
+            request, 'pkgs', 'item.dmg', self.fullpath, self.stat_result,
+            self.etag)
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=-15')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 85-99/100')
+        self.assertEqual(response['Content-Length'], '15')
+        self.assertEqual(''.join(response.streaming_content),
+                         self.data[85:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+    def test_stale_if_range_sends_whole_file(self):
+        response = self.get(HTTP_RANGE='bytes=0-9',
+                            HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.get(HTTP_RANGE='bytes=0-9',
+                            HTTP_IF_RANGE='"%s"' % self.etag)
+        self.assertEqual(response.status_code, 206)
@@ -0,0 +1,53 @@
+"""
+api/upload_handlers.py
+
+Django upload handlers that compute the SHA-256 digest of each uploaded file
+as it is received, so it doesn't have to be read again afterwards
+"""
+import hashlib
+
+from django.core.files.uploadhandler import MemoryFileUploadHandler, \
+                                            TemporaryFileUploadHandler
+
+
+class HashingMixin(object):
+    '''Hashes the data the handler keeps, and sets the sha256 attribute
+    (a hex digest) of the file objects it returns'''
+    sha256 = None
+
+    def new_file(self, *args, **kwargs):
+        # before calling the superclass, which may raise StopFutureHandlers
+        self.sha256 = hashlib.sha256()
+        super(HashingMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        result = super(HashingMixin, self).receive_data_chunk(raw_data, start)
+        if result is None:
+            # the data wasn't passed on to the next handler
+            self.sha256.update(raw_data)
+        return result
+
+    def file_complete(self, file_size):
+        fileobj = super(HashingMixin, self).file_complete(file_size)
+        if fileobj is not None:
+            fileobj.sha256 = self.sha256.hexdigest()
+        return fileobj
+
+
+class HashingMemoryFileUploadHandler(HashingMixin, MemoryFileUploadHandler):
+    '''MemoryFileUploadHandler that hashes the uploads it keeps'''
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingMixin,
+                                        TemporaryFileUploadHandler):
+    '''TemporaryFileUploadHandler that hashes the uploads it keeps'''
+    pass
+
+
+def hashing_upload_handlers(request):
+    '''Returns Django's default upload handlers, hashing. Must be set as
+    request.upload_handlers before request.POST or request.FILES is
+    accessed'''
+    return [HashingMemoryFileUploadHandler(request),
+            HashingTemporaryFileUploadHandler(request)]
@@ -2,6 +2,8 @@ from django.conf.urls import url
 import api.views
 
 urlpatterns = [
+    url(r'^_stats$', api.views.stats_api),
+    url(r'^_batch$', api.views.batch_api),
     url(r'^(?P<kind>catalogs$)', api.views.plist_api),
     url(r'^(?P<kind>catalogs)/(?P<filepath>.*$)', api.views.plist_api),
     url(r'^(?P<kind>manifests$)', api.views.plist_api),
@@ -0,0 +1,45 @@
+"""
+api/utils.py
+
+helpers shared by the API views and the metadata index
+"""
+import datetime
+
+
+def _normalize_item(value):
+    '''Converts a single value to a lowercase string. Dates are in ISO 8601
+    format, as in JSON responses'''
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return unicode(value).lower()
+
+
+def normalize_value_for_filtering(value):
+    '''Converts value to a list of strings. Both the metadata index and the
+    filtering of plists read from disk use this, so a filter matches the
+    same items either way'''
+    if isinstance(value, (int, float, bool, basestring, dict,
+                          datetime.datetime)):
+        return [_normalize_item(value)]
+    if isinstance(value, list):
+        return [_normalize_item(item) for item in value]
+    return []
+
+
+def convert_dates_to_strings(plist):
+    '''Converts all date objects in a plist to strings. Enables encoding into
+    JSON'''
+    if isinstance(plist, dict):
+        for key, value in plist.items():
+            if isinstance(value, datetime.datetime):
+                plist[key] = value.isoformat()
+            if isinstance(value, (list, dict)):
+                plist[key] = convert_dates_to_strings(value)
+        return plist
+    if isinstance(plist, list):
+        for value in plist:
+            if isinstance(value, datetime.datetime):
+                value = value.isoformat()
+            if isinstance(value, (list, dict)):
+                value = convert_dates_to_strings(value)
+        return plist
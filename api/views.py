@@ -1,58 +1,64 @@
 """
 api/views.py
 """
+from django.conf import settings
 from django.http import HttpResponse
 from django.http import QueryDict
 from django.http import FileResponse
+from django.http import StreamingHttpResponse
 #from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.wsgi import WSGIRequest
+from django.utils.cache import patch_vary_headers
 
 
 from api.models import Plist, MunkiFile
+from api.repo_index import REPO_INDEX
+from api.plist_cache import PLIST_CACHE
+from api.metadata_index import METADATA_INDEX
 from api.models import FileError, FileWriteError, FileReadError, \
-                       FileAlreadyExistsError, \
+                       FileAlreadyExistsError, FileRangeError, \
                        FileDoesNotExistError, FileDeleteError
+from api.upload_handlers import hashing_upload_handlers
+from api.utils import normalize_value_for_filtering, \
+                      convert_dates_to_strings
 
 from munkiwebadmin.django_basic_auth import logged_in_or_basicauth
+from munkiwebadmin.executor import EXECUTOR
+from munkiwebadmin.utils import stat_etag, paths_validators, names_etag, \
+                                not_modified_response, set_validators, \
+                                parse_byte_range, if_range_matches, \
+                                GIT_COMMIT_QUEUE
 
+import base64
 import datetime
+import itertools
 import json
 import logging
 import os
 import mimetypes
 import plistlib
 import re
+import urllib
+from StringIO import StringIO
+from xml.parsers.expat import ExpatError
 
 LOGGER = logging.getLogger('munkiwebadmin')
 
+# set to 'X-Sendfile' (Apache with mod_xsendfile, lighttpd) or
+# 'X-Accel-Redirect' (nginx) to have the front-end web server send the
+# contents of files downloaded through the API
+try:
+    FILE_API_SENDFILE = settings.FILE_API_SENDFILE
+except AttributeError:
+    FILE_API_SENDFILE = None
 
-def normalize_value_for_filtering(value):
-    '''Converts value to a list of strings'''
-    if isinstance(value, (int, float, bool, basestring, dict)):
-        return [str(value).lower()]
-    if isinstance(value, list):
-        return [str(item).lower() for item in value]
-    return []
-
-
-def convert_dates_to_strings(plist):
-    '''Converts all date objects in a plist to strings. Enables encoding into
-    JSON'''
-    if isinstance(plist, dict):
-        for key, value in plist.items():
-            if isinstance(value, datetime.datetime):
-                plist[key] = value.isoformat()
-            if isinstance(value, (list, dict)):
-                plist[key] = convert_dates_to_strings(value)
-        return plist
-    if isinstance(plist, list):
-        for value in plist:
-            if isinstance(value, datetime.datetime):
-                value = value.isoformat()
-            if isinstance(value, (list, dict)):
-                value = convert_dates_to_strings(value)
-        return plist
+# for X-Accel-Redirect: the internal nginx location serving MUNKI_REPO_DIR
+try:
+    FILE_API_ACCEL_REDIRECT_PREFIX = settings.FILE_API_ACCEL_REDIRECT_PREFIX
+except AttributeError:
+    FILE_API_ACCEL_REDIRECT_PREFIX = '/munki_repo_internal/'
 
 
 def convert_strings_to_dates(jdata):
@@ -78,6 +84,249 @@ def convert_strings_to_dates(jdata):
         return jdata
 
 
+def iter_plist_list(kind, filter_terms, api_fields, response_type,
+                    item_list=None, prefiltered=False, synced=False):
+    '''Generator that yields (filename, plist) tuples for the items of a
+    plist_api list request. Each item is read, filtered and projected only
+    when it is needed, so callers can stream the results or stop early.
+    If prefiltered is True, item_list has already been filtered by the
+    metadata index; if synced is True, the metadata index is up to date'''
+    if item_list is None:
+        item_list = Plist.list(kind)
+    if (api_fields == ['filename']
+            and filter_terms.keys() in ([], ['filename'])):
+        # don't read each manifest if all we want is filenames
+        for item_name in item_list:
+            if 'filename' in filter_terms.keys():
+                if filter_terms['filename'].lower() not in item_name:
+                    continue
+            yield item_name, {'filename': item_name}
+        return
+    if not prefiltered:
+        # let the metadata index do the filtering if we can
+        matching_names = METADATA_INDEX.query(
+            kind, item_list, filter_terms, synced=synced)
+        if matching_names is not None:
+            item_list = matching_names
+            filter_terms = {}
+            prefiltered = True
+    if prefiltered and response_type == 'json':
+        for item_name, plist in METADATA_INDEX.iter_items(kind, item_list):
+            if api_fields:
+                # filter to just the requested fields
+                plist = {key: plist[key] for key in plist.keys()
+                         if key in api_fields}
+            yield item_name, plist
+        return
+    filter_terms = dict(filter_terms.items())
+    for result in EXECUTOR.imap(
+            read_list_item,
+            ((kind, item_name, filter_terms, api_fields, response_type)
+             for item_name in item_list)):
+        if result:
+            yield result
+
+
+def read_list_item(args):
+    '''Worker function for the bulk executor: reads one item for a list
+    request and filters and projects it. Returns a (filename, plist) tuple,
+    or None if the item doesn't match the filters'''
+    kind, item_name, filter_terms, api_fields, response_type = args
+    try:
+        plist = Plist.read(kind, item_name)
+    except FileDoesNotExistError:
+        # removed since we listed it
+        return None
+    if response_type == 'json':
+        plist = convert_dates_to_strings(plist)
+    if kind == 'catalogs':
+        # catalogs are list objects, not dicts
+        plist = {'contents': plist}
+    plist['filename'] = item_name
+    for key, value in filter_terms.items():
+        if key not in plist:
+            return None
+        plist_value = normalize_value_for_filtering(plist[key])
+        match = next(
+            (item for item in plist_value
+             if value.lower() in item.lower()), None)
+        if not match:
+            return None
+    if api_fields:
+        # filter to just the requested fields
+        plist = {key: plist[key] for key in plist.keys()
+                 if key in api_fields}
+    return item_name, plist
+
+
+def encode_cursor(sort, sort_value, filename):
+    '''Returns an opaque token pointing just past the given item'''
+    return base64.urlsafe_b64encode(json.dumps([sort, sort_value, filename]))
+
+
+def decode_cursor(cursor, sort):
+    '''Returns the (sort_value, filename) tuple encoded in cursor. Raises
+    ValueError if the cursor is malformed or was made for a different sort
+    order'''
+    try:
+        cursor_sort, sort_value, filename = json.loads(
+            base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(filename, basestring):
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort:
+        raise ValueError('Cursor does not match sort order %s' % sort)
+    # repo filenames are UTF-8 byte strings; comparing them with unicode
+    # fails for non-ASCII names
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return sort_value, filename
+
+
+def sorted_plist_list(kind, item_list, sort_key, synced=False):
+    '''Returns item_list sorted by (value of sort_key, filename) as a list
+    of (sort_value, filename) tuples. Sorting by filename needs no file
+    reads; other keys are looked up in the metadata index if possible'''
+    if sort_key == 'filename':
+        return sorted([('', item_name) for item_name in item_list],
+                      key=lambda item: item[1])
+    sort_values = METADATA_INDEX.sort_values(
+        kind, sort_key, item_list, synced=synced)
+    if sort_values is None:
+        sort_values = {}
+        for item_name in item_list:
+            plist = Plist.read(kind, item_name)
+            if isinstance(plist, dict) and sort_key in plist:
+                values = normalize_value_for_filtering(plist[sort_key])
+                if values:
+                    sort_values[item_name] = min(values)
+    return sorted([(sort_values.get(item_name, ''), item_name)
+                   for item_name in item_list])
+
+
+def paged_plist_list(request, kind, filter_terms, api_fields, response_type,
+                     item_list=None, synced=False):
+    '''Returns a single page of a plist_api list request, as selected by
+    the api_limit, api_cursor and api_sort parameters. The total count (when
+    it can be determined without reading every file) and a cursor for the
+    next page are returned in the X-Total-Count and X-Next-Cursor
+    headers. item_list and synced are as for iter_plist_list'''
+    sort = filter_terms.pop('api_sort', ['filename'])[-1] or 'filename'
+    cursor = filter_terms.pop('api_cursor', [''])[-1]
+    limit = filter_terms.pop('api_limit', [''])[-1]
+    try:
+        if limit:
+            if not limit.isdigit() or int(limit) < 1:
+                raise ValueError('api_limit must be a positive integer')
+            limit = int(limit)
+        else:
+            limit = None
+        sort_key = sort.lstrip('-')
+        descending = sort.startswith('-')
+        after = decode_cursor(cursor, sort) if cursor else None
+    except ValueError, err:
+        return HttpResponse(
+            json.dumps({'result': 'failed',
+                        'exception_type': 'BadRequest',
+                        'detail': str(err)}),
+            content_type='application/json', status=400)
+
+    if item_list is None:
+        item_list = Plist.list(kind)
+    total = None
+    prefiltered = False
+    if not filter_terms:
+        total = len(item_list)
+    elif (api_fields != ['filename']
+          or filter_terms.keys() != ['filename']):
+        matching_names = METADATA_INDEX.query(
+            kind, item_list, filter_terms, synced=synced)
+        if matching_names is not None:
+            item_list = matching_names
+            filter_terms = {}
+            prefiltered = True
+            total = len(item_list)
+    ordered = sorted_plist_list(kind, item_list, sort_key, synced=synced)
+    if descending:
+        ordered.reverse()
+    if after is not None:
+        after = tuple(after)
+        if descending:
+            ordered = [item for item in ordered if item < after]
+        else:
+            ordered = [item for item in ordered if item > after]
+    sort_values = dict((item_name, sort_value)
+                       for sort_value, item_name in ordered)
+    items = iter_plist_list(
+        kind, filter_terms, api_fields, response_type,
+        item_list=[item_name for _, item_name in ordered],
+        prefiltered=prefiltered, synced=synced)
+    if limit is not None:
+        # read one extra item so we know if there is another page
+        items = itertools.islice(items, limit + 1)
+    page = list(items)
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        last_name = page[-1][0]
+        next_cursor = encode_cursor(sort, sort_values[last_name], last_name)
+    response = [plist for _, plist in page]
+    if response_type == 'json':
+        http_response = HttpResponse(json.dumps(response) + '\n',
+                                     content_type='application/json')
+    else:
+        http_response = HttpResponse(plistlib.writePlistToString(response),
+                                     content_type='application/xml')
+    if total is not None:
+        http_response['X-Total-Count'] = str(total)
+    if next_cursor:
+        http_response['X-Next-Cursor'] = next_cursor
+    return http_response
+
+
+def stream_json_array(items):
+    '''Generator that encodes items as a JSON array one element at a time.
+    The output is identical to json.dumps(list(items)) plus a newline'''
+    separator = '['
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ', '
+    if separator == '[':
+        yield '[]\n'
+    else:
+        yield ']\n'
+
+
+def stream_plist_array(items):
+    '''Generator that encodes items as an XML plist array one element at a
+    time. The output is identical to
+    plistlib.writePlistToString(list(items))'''
+    buf = StringIO()
+    writer = plistlib.PlistWriter(buf)
+    writer.writeln('<plist version="1.0">')
+    writer.beginElement('array')
+    for item in items:
+        writer.writeValue(item)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    writer.endElement('array')
+    writer.writeln('</plist>')
+    yield buf.getvalue()
+
+
+@logged_in_or_basicauth()
+def stats_api(request):
+    '''Returns counters for the in-process caches and indexes'''
+    LOGGER.debug("Got API request for stats")
+    response = {'repo_index': REPO_INDEX.stats(),
+                'plist_cache': PLIST_CACHE.stats(),
+                'git_commit_queue': GIT_COMMIT_QUEUE.stats()}
+    return HttpResponse(json.dumps(response) + '\n',
+                        content_type='application/json')
+
+
 @csrf_exempt
 @logged_in_or_basicauth()
 def plist_api(request, kind, filepath=None):
@@ -95,6 +344,20 @@ def plist_api(request, kind, filepath=None):
     if request.method == 'GET':
         LOGGER.debug("Got API GET request for %s", kind)
         if filepath:
+            etag = last_modified = None
+            try:
+                stat_result = os.stat(Plist.get_fullpath(kind, filepath))
+            except OSError:
+                # Plist.read will report the error
+                pass
+            else:
+                etag = stat_etag(stat_result, variant=response_type)
+                last_modified = stat_result.st_mtime
+                not_modified = not_modified_response(
+                    request, etag, last_modified)
+                if not_modified:
+                    patch_vary_headers(not_modified, ('Accept',))
+                    return not_modified
             try:
                 response = Plist.read(kind, filepath)
             except FileDoesNotExistError, err:
@@ -112,57 +375,80 @@ def plist_api(request, kind, filepath=None):
             if response_type == 'json':
                 response = convert_dates_to_strings(response)
         else:
-            filter_terms = request.GET.copy()
-            if '_' in filter_terms.keys():
-                del filter_terms['_']
-            if 'api_fields' in filter_terms.keys():
-                api_fields = filter_terms['api_fields'].split(',')
-                del filter_terms['api_fields']
-            else:
-                api_fields = None
-            item_list = Plist.list(kind)
-            response = []
-            for item_name in item_list:
-                if (api_fields == ['filename']
-                        and filter_terms.keys() in ([], ['filename'])):
-                    # don't read each manifest if all we want is filenames
-                    plist = {'filename': item_name}
-                    if 'filename' in filter_terms.keys():
-                        if filter_terms['filename'].lower() not in item_name:
-                            continue
-                    response.append(plist)
+            try:
+                filter_terms = request.GET.copy()
+                if '_' in filter_terms.keys():
+                    del filter_terms['_']
+                # the response depends on every file of this kind and on the
+                # query, so the ETag does too. Syncing the metadata index stats
+                # every file anyway, so it provides the digest of the files and
+                # the listing below doesn't sync again
+                item_list = Plist.list(kind)
+                variant = response_type + '?' + filter_terms.urlencode()
+                digest = METADATA_INDEX.validator(kind, item_list)
+                synced = digest is not None
+                if synced:
+                    etag = names_etag([digest], variant=variant)
                 else:
-                    plist = Plist.read(kind, item_name)
+                    etag, _ = paths_validators(
+                        [Plist.get_fullpath(kind, item_name)
+                         for item_name in item_list], variant=variant)
+                last_modified = None
+                not_modified = not_modified_response(request, etag)
+                if not_modified:
+                    patch_vary_headers(not_modified, ('Accept',))
+                    return not_modified
+                if 'api_fields' in filter_terms.keys():
+                    api_fields = filter_terms['api_fields'].split(',')
+                    del filter_terms['api_fields']
+                else:
+                    api_fields = None
+                if ('api_limit' in filter_terms.keys()
+                        or 'api_cursor' in filter_terms.keys()
+                        or 'api_sort' in filter_terms.keys()):
+                    if 'api_stream' in filter_terms.keys():
+                        # pages are small; no need to stream them
+                        del filter_terms['api_stream']
+                    http_response = paged_plist_list(
+                        request, kind, filter_terms, api_fields, response_type,
+                        item_list=item_list, synced=synced)
+                    if http_response.status_code == 200:
+                        set_validators(http_response, etag)
+                    patch_vary_headers(http_response, ('Accept',))
+                    return http_response
+                stream = False
+                if 'api_stream' in filter_terms.keys():
+                    stream = (filter_terms['api_stream'].lower()
+                              in ('1', 'true'))
+                    del filter_terms['api_stream']
+                items = (plist for _, plist in iter_plist_list(
+                    kind, filter_terms, api_fields, response_type,
+                    item_list=item_list, synced=synced))
+                if stream:
                     if response_type == 'json':
-                        plist = convert_dates_to_strings(plist)
-                    if kind == 'catalogs':
-                        # catalogs are list objects, not dicts
-                        plist = {'contents': plist}
-                    plist['filename'] = item_name
-                    matches_filters = True
-                    for key, value in filter_terms.items():
-                        if key not in plist:
-                            matches_filters = False
-                            continue
-                        plist_value = normalize_value_for_filtering(plist[key])
-                        match = next(
-                            (item for item in plist_value
-                             if value.lower() in item.lower()), None)
-                        if not match:
-                            matches_filters = False
-                            continue
-                    if matches_filters:
-                        if api_fields:
-                            # filter to just the requested fields
-                            plist = {key: plist[key] for key in plist.keys()
-                                     if key in api_fields}
-                        response.append(plist)
+                        http_response = StreamingHttpResponse(
+                            stream_json_array(items),
+                            content_type='application/json')
+                    else:
+                        http_response = StreamingHttpResponse(
+                            stream_plist_array(items),
+                            content_type='application/xml')
+                    set_validators(http_response, etag)
+                    patch_vary_headers(http_response, ('Accept',))
+                    return http_response
+                response = list(items)
+            finally:
+                Plist.list_done(kind)
         if response_type == 'json':
-            return HttpResponse(json.dumps(response) + '\n',
-                                content_type='application/json')
+            http_response = HttpResponse(json.dumps(response) + '\n',
+                                         content_type='application/json')
         else:
-            return HttpResponse(plistlib.writePlistToString(response),
-                                content_type='application/xml')
+            http_response = HttpResponse(
+                plistlib.writePlistToString(response),
+                content_type='application/xml')
+        set_validators(http_response, etag, last_modified)
+        patch_vary_headers(http_response, ('Accept',))
+        return http_response
 
     if request.META.has_key('HTTP_X_METHODOVERRIDE'):
         # support browsers/libs that don't directly support the other verbs
@@ -401,6 +687,307 @@ def plist_api(request, kind, filepath=None):
             return HttpResponse(status=204)
 
 
+def batch_subrequest(request, operation):
+    '''Returns a request for a single operation of a batch_api request,
+    made by request.user'''
+    method = str(operation.get('method', 'GET')).upper()
+    body = ''
+    if 'data' in operation:
+        body = json.dumps(operation['data'])
+    query = QueryDict('', mutable=True)
+    for key, value in (operation.get('query') or {}).items():
+        query[key] = value
+    path = '/api/%s' % operation['kind']
+    if operation.get('filename'):
+        path += '/' + operation['filename']
+    sub_request = WSGIRequest({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path.encode('utf-8'),
+        'QUERY_STRING': query.urlencode(),
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'SERVER_NAME': request.META.get('SERVER_NAME', 'localhost'),
+        'SERVER_PORT': request.META.get('SERVER_PORT', '80'),
+        'wsgi.input': StringIO(body),
+    })
+    sub_request.user = request.user
+    return sub_request
+
+
+def batch_operation(request, operation):
+    '''Performs a single operation of a batch_api request with plist_api,
+    so the same permission checks apply. Returns a dictionary with the
+    status code and (decoded) result'''
+    detail = None
+    if (not isinstance(operation, dict) or
+            operation.get('kind') not in ['manifests', 'pkgsinfo',
+                                          'catalogs']):
+        detail = 'kind must be one of manifests, pkgsinfo or catalogs'
+    elif not isinstance(operation.get('query') or {}, dict):
+        detail = 'query must be an object'
+    elif not isinstance(operation.get('filename') or '', basestring):
+        detail = 'filename must be a string'
+    elif operation.get('filename') and (
+            operation['filename'].startswith('/') or
+            '..' in operation['filename'].split('/')):
+        # the filename must stay inside the repo
+        detail = 'filename must be a relative path without ..'
+    if detail:
+        return {'status': 400,
+                'result': {'result': 'failed',
+                           'exception_type': 'BadRequest',
+                           'detail': detail}}
+    try:
+        response = plist_api(
+            batch_subrequest(request, operation), operation['kind'],
+            operation.get('filename') or None)
+    except PermissionDenied:
+        return {'status': 403,
+                'result': {'result': 'failed',
+                           'exception_type': 'PermissionDenied',
+                           'detail': 'Permission denied'}}
+    except FileDoesNotExistError, err:
+        return {'status': 404,
+                'result': {'result': 'failed',
+                           'exception_type': str(type(err)),
+                           'detail': str(err)}}
+    except (ValueError, TypeError, ExpatError), err:
+        return {'status': 400,
+                'result': {'result': 'failed',
+                           'exception_type': 'BadRequest',
+                           'detail': str(err)}}
+    if response.streaming:
+        content = ''.join(response.streaming_content)
+    else:
+        content = response.content
+    result = None
+    if content:
+        try:
+            result = json.loads(content)
+        except ValueError:
+            result = content
+    return {'status': response.status_code, 'result': result}
+
+
+@csrf_exempt
+@logged_in_or_basicauth()
+def batch_api(request):
+    '''Performs a list of operations on manifests, pkgsinfo and catalogs in
+    one request. The request body is a JSON list of operations like
+    {"method": "PUT", "kind": "manifests", "filename": "site_default",
+    "data": {...}}; GET operations for lists can pass filters in "query".
+    Returns a list with the status code and result of each operation. Any
+    changes made are committed to git together'''
+    if request.method != 'POST':
+        return HttpResponse(
+            json.dumps({'result': 'failed',
+                        'exception_type': 'WrongHTTPMethodType',
+                        'detail': 'Batch requests must be POSTed'}),
+            content_type='application/json', status=405)
+    try:
+        operations = json.loads(request.body)
+        if not isinstance(operations, list):
+            raise ValueError('Request body must be a list of operations')
+    except ValueError, err:
+        return HttpResponse(
+            json.dumps({'result': 'failed',
+                        'exception_type': 'BadRequest',
+                        'detail': str(err)}),
+            content_type='application/json', status=400)
+    LOGGER.debug("Got API batch request with %s operations", len(operations))
+    with GIT_COMMIT_QUEUE.hold():
+        results = [batch_operation(request, operation)
+                   for operation in operations]
+    return HttpResponse(json.dumps(results) + '\n',
+                        content_type='application/json')
+
+
+def upload_response(request, kind, filename, digest, size, update_pkginfo):
+    '''Returns the response to a completed upload: the file's name, its
+    SHA-256 digest and size. If update_pkginfo is True, the pkginfo files
+    referencing the uploaded pkg are updated with them, and listed too'''
+    result = {'filename': filename, 'sha256': digest, 'size': size}
+    if update_pkginfo:
+        try:
+            # commit the pkginfo changes together
+            with GIT_COMMIT_QUEUE.hold():
+                result['pkgsinfo_updated'] = MunkiFile.update_pkginfo(
+                    os.path.normpath(filename), digest, size, request.user)
+        except FileError, err:
+            result.update({'result': 'failed',
+                           'exception_type': str(type(err)),
+                           'detail': str(err)})
+            return HttpResponse(json.dumps(result),
+                                content_type='application/json', status=403)
+    return HttpResponse(json.dumps(result),
+                        content_type='application/json', status=200)
+
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (?:(\d+)-(\d+)|\*)/(\d+)$')
+
+
+def put_file_range(request, kind, filepath, update_pkginfo=False):
+    '''Handles a PUT of a file for file_api. The request body is streamed
+    to disk, never held in memory. A request with a Content-Range header
+    (bytes first-last/total) uploads one chunk of the file; chunks must be
+    sent in order, and the file is moved into place once the last one is
+    received. A Content-Range of bytes */total with an empty body asks how
+    much of an interrupted upload was received, so it can be resumed. The
+    response to an incomplete upload has status 202, a Range header and the
+    offset to continue at; a completed one is answered by upload_response'''
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    content_range = request.META.get('HTTP_CONTENT_RANGE')
+    if content_range:
+        match = CONTENT_RANGE_RE.match(content_range.strip())
+        if not match:
+            return HttpResponse(
+                json.dumps({'result': 'failed',
+                            'exception_type': 'BadRequest',
+                            'detail': 'Malformed Content-Range header'}),
+                content_type='application/json', status=400)
+        total = int(match.group(3))
+        if match.group(1) is None:
+            # status query
+            offset = None
+        else:
+            offset = int(match.group(1))
+            if int(match.group(2)) - offset + 1 != length:
+                return HttpResponse(
+                    json.dumps({'result': 'failed',
+                                'exception_type': 'BadRequest',
+                                'detail': 'Content-Range does not match '
+                                          'Content-Length'}),
+                    content_type='application/json', status=400)
+    elif length:
+        offset, total = 0, length
+    else:
+        return HttpResponse(
+            json.dumps({'result': 'failed',
+                        'exception_type': 'BadRequest',
+                        'detail': 'Missing filename or filedata'}),
+            content_type='application/json', status=400)
+
+    if offset is None:
+        received = MunkiFile.upload_offset(kind, filepath)
+    else:
+        try:
+            received, digest = MunkiFile.write_range(
+                kind, request, filepath, request.user, offset, length, total)
+        except FileRangeError, err:
+            response = HttpResponse(
+                json.dumps({'result': 'failed',
+                            'exception_type': str(type(err)),
+                            'detail': str(err),
+                            'offset': MunkiFile.upload_offset(
+                                kind, filepath)}),
+                content_type='application/json', status=416)
+            response['Content-Range'] = 'bytes */%s' % total
+            return response
+        except FileError, err:
+            return HttpResponse(
+                json.dumps({'result': 'failed',
+                            'exception_type': str(type(err)),
+                            'detail': str(err)}),
+                content_type='application/json', status=403)
+        if received == total:
+            return upload_response(
+                request, kind, filepath, digest, total, update_pkginfo)
+    response = HttpResponse(
+        json.dumps({'filename': filepath, 'offset': received,
+                    'size': total}),
+        content_type='application/json', status=202)
+    if received:
+        response['Range'] = 'bytes=0-%s' % (received - 1)
+    return response
+
+
+def wants_pkginfo_update(request, kind, value):
+    '''Returns True if value (of the update_pkginfo parameter) asks for the
+    pkginfo files of an uploaded pkg to be updated. Raises PermissionDenied
+    if the user can't change pkginfo files'''
+    if kind != 'pkgs' or (value or '').lower() not in ('1', 'true'):
+        return False
+    if not request.user.has_perm('pkgsinfo.change_pkginfofile'):
+        raise PermissionDenied
+    return True
+
+
+class FileRange(object):
+    '''A read-only file-like object for length bytes of fileref, starting
+    at offset. It deliberately has no fileno(), so WSGI servers don't try to
+    sendfile() the whole underlying file'''
+    def __init__(self, fileref, offset, length):
+        self.fileref = fileref
+        self.fileref.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        '''Reads up to size bytes (all of the remaining ones if size is
+        negative)'''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileref.read(size) if size else ''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        '''Closes the underlying file'''
+        self.fileref.close()
+
+
+def file_download_response(request, kind, filepath, fullpath, stat_result,
+                           etag):
+    '''Returns the response to a GET of the file at fullpath. A single
+    byte range requested with a Range header (and a matching If-Range
+    header, if any) gets a 206 response with only those bytes. If
+    FILE_API_SENDFILE is set, the front-end web server is asked to send the
+    file instead, and handles Range requests itself'''
+    content_type = mimetypes.guess_type(fullpath)[0]
+    if FILE_API_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        if FILE_API_SENDFILE.lower() == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = urllib.quote(
+                FILE_API_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' +
+                os.path.normpath(
+                    os.path.join(kind, filepath)).encode('utf-8'))
+        else:
+            if isinstance(fullpath, unicode):
+                fullpath = fullpath.encode('utf-8')
+            response[FILE_API_SENDFILE] = fullpath
+        return response
+
+    size = stat_result.st_size
+    byte_range = None
+    if request.META.get('HTTP_RANGE') and if_range_matches(
+            request, etag, stat_result.st_mtime):
+        try:
+            byte_range = parse_byte_range(request.META['HTTP_RANGE'], size)
+        except ValueError:
+            response = HttpResponse(
+                json.dumps({'result': 'failed',
+                            'exception_type': 'RangeNotSatisfiable',
+                            'detail': 'File is %s bytes long' % size}),
+                content_type='application/json', status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+    fileref = open(fullpath, 'rb')
+    if byte_range is None:
+        response = FileResponse(fileref, content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        first, last = byte_range
+        response = FileResponse(
+            FileRange(fileref, first, last - first + 1),
+            content_type=content_type, status=206)
+        response['Content-Length'] = last - first + 1
+        response['Content-Range'] = 'bytes %s-%s/%s' % (first, last, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
 @csrf_exempt
 @logged_in_or_basicauth()
 def file_api(request, kind, filepath=None):
@@ -423,12 +1010,19 @@ def file_api(request, kind, filepath=None):
                                 'detail': '%s does not exist' % filepath}),
                     content_type='application/json', status=404)
             try:
-                response = FileResponse(
-                    open(fullpath, 'rb'),
-                    content_type=mimetypes.guess_type(fullpath)[0])
-                response['Content-Length'] = os.path.getsize(fullpath)
-                response['Content-Disposition'] = (
-                    'attachment; filename="%s"' % os.path.basename(filepath))
+                stat_result = os.stat(fullpath)
+                etag = stat_etag(stat_result)
+                not_modified = not_modified_response(
+                    request, etag, stat_result.st_mtime)
+                if not_modified:
+                    return not_modified
+                response = file_download_response(
+                    request, kind, filepath, fullpath, stat_result, etag)
+                if response.status_code != 416:
+                    response['Content-Disposition'] = (
+                        'attachment; filename="%s"'
+                        % os.path.basename(filepath))
+                set_validators(response, etag, stat_result.st_mtime)
                 return response
             except (IOError, OSError), err:
                 return HttpResponse(
@@ -438,39 +1032,68 @@ def file_api(request, kind, filepath=None):
                     content_type='application/json', status=403)
         else:
             response = MunkiFile.list(kind)
-            if response_type == 'json':
-                return HttpResponse(json.dumps(response) + '\n',
-                                    content_type='application/json')
+            # the listing only changes when files are added or removed
+            etag = names_etag(response, variant=response_type)
+            not_modified = not_modified_response(request, etag)
+            if not_modified:
+                patch_vary_headers(not_modified, ('Accept',))
+                return not_modified
+            if request.GET.get('api_stream', '').lower() in ('1', 'true'):
+                if response_type == 'json':
+                    http_response = StreamingHttpResponse(
+                        stream_json_array(response),
+                        content_type='application/json')
+                else:
+                    http_response = StreamingHttpResponse(
+                        stream_plist_array(response),
+                        content_type='application/xml')
+            elif response_type == 'json':
+                http_response = HttpResponse(json.dumps(response) + '\n',
+                                             content_type='application/json')
             else:
-                return HttpResponse(plistlib.writePlistToString(response),
-                                    content_type='application/xml')
+                http_response = HttpResponse(
+                    plistlib.writePlistToString(response),
+                    content_type='application/xml')
+            set_validators(http_response, etag)
+            patch_vary_headers(http_response, ('Accept',))
+            return http_response
 
     if request.META.has_key('HTTP_X_METHODOVERRIDE'):
-        # support browsers/libs that don't directly support the other verbs
-        http_method = request.META['HTTP_X_METHODOVERRIDE']
-        if http_method.lower() == 'put':
-            request.method = 'PUT'
-            request.META['REQUEST_METHOD'] = 'PUT'
-            request.PUT = QueryDict(request.body)
-        if http_method.lower() == 'delete':
-            request.method = 'DELETE'
-            request.META['REQUEST_METHOD'] = 'DELETE'
-            request.DELETE = QueryDict(request.body)
-        if http_method.lower() == 'patch':
-            request.method = 'PATCH'
-            request.META['REQUEST_METHOD'] = 'PATCH'
-            request.PATCH = QueryDict(request.body)
+        # support browsers/libs that don't directly support the other verbs.
+        # The body may be a whole file, so it is never read into memory:
+        # it is streamed to disk by put_file_range, or by the upload
+        # handlers if it is a form
+        http_method = request.META['HTTP_X_METHODOVERRIDE'].upper()
+        if http_method in ('PUT', 'DELETE', 'PATCH'):
+            if (http_method == 'PUT' and request.method == 'POST'
+                    and request.META.get('CONTENT_TYPE', '').startswith(
+                        'multipart/form-data')):
+                # parse the form while the request is still a POST
+                request.upload_handlers = hashing_upload_handlers(request)
+                request.POST
+            request.method = http_method
+            request.META['REQUEST_METHOD'] = http_method
+
+    if request.method == 'PUT' and filepath and not request.FILES:
+        LOGGER.debug("Got API PUT request for %s", kind)
+        if not request.user.has_perm('pkgsinfo.create_pkginfofile'):
+            raise PermissionDenied
+        update_pkginfo = wants_pkginfo_update(
+            request, kind, request.GET.get('update_pkginfo'))
+        return put_file_range(request, kind, filepath, update_pkginfo)
 
     if request.method in ('POST', 'PUT'):
         LOGGER.debug("Got API %s request for %s", request.method, kind)
         if not request.user.has_perm('pkgsinfo.create_pkginfofile'):
             raise PermissionDenied
         if request.method == 'POST':
-            filename = request.POST.get('filename') or filepath
-            filedata = request.FILES.get('filedata')
-        else:
-            filename = filepath
-            filedata = request.body
+            # hash uploads as they are received
+            request.upload_handlers = hashing_upload_handlers(request)
+        # a PUT only has a form if it was sent as a POST
+        update_pkginfo = wants_pkginfo_update(
+            request, kind, request.POST.get('update_pkginfo'))
+        filename = request.POST.get('filename') or filepath
+        filedata = request.FILES.get('filedata')
         LOGGER.debug("Filename is %s" % filename)
         if not (filename and filedata):
             # malformed request
@@ -480,10 +1103,8 @@ def file_api(request, kind, filepath=None):
                             'detail': 'Missing filename or filedata'}),
                 content_type='application/json', status=400)
         try:
-            if request.method == 'POST':
-                MunkiFile.new(kind, filedata, filename, request.user)
-            else:
-                MunkiFile.writedata(kind, filedata, filename, request.user)
+            digest, size = MunkiFile.new(
+                kind, filedata, filename, request.user)
         except FileError, err:
             return HttpResponse(
                 json.dumps({'result': 'failed',
@@ -491,9 +1112,8 @@ def file_api(request, kind, filepath=None):
                             'detail': str(err)}),
                 content_type='application/json', status=403)
         else:
-            return HttpResponse(
-                json.dumps({'filename': filename}),
-                content_type='application/json', status=200)
+            return upload_response(
+                request, kind, filename, digest, size, update_pkginfo)
 
     if request.method == 'PATCH':
         LOGGER.debug("Got API PATCH request for %s", kind)
@@ -0,0 +1,128 @@
+"""
+api/walker.py
+
+Shared directory listing for the Munki repo subdirectories. Uses scandir
+(os.scandir, or the scandir module on Python 2) when available, so whether
+an entry is a file or a directory comes from the directory listing instead
+of from a stat call per entry
+"""
+import functools
+import os
+
+from api.plist_cache import stat_key
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+def _entries(dirpath):
+    '''Returns a list of (name, is_dir, fullpath, stat) tuples for the
+    entries in dirpath; stat is a function that returns the (os.stat)
+    result for the entry, which scandir may already have. Dotfiles and
+    directories starting with a period are skipped, and like os.walk,
+    symlinked directories are treated as neither files nor directories
+    (is_dir is None). Raises OSError if dirpath can't be listed'''
+    entries = []
+    if scandir is None:
+        for name in os.listdir(dirpath):
+            if name.startswith('.'):
+                continue
+            fullpath = os.path.join(dirpath, name)
+            if os.path.isdir(fullpath):
+                is_dir = None if os.path.islink(fullpath) else True
+            else:
+                is_dir = False
+            entries.append(
+                (name, is_dir, fullpath, functools.partial(os.stat, fullpath)))
+        return entries
+    for entry in scandir(dirpath):
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            is_dir = None if entry.is_symlink() else True
+        else:
+            is_dir = False
+        entries.append((entry.name, is_dir, entry.path, entry.stat))
+    return entries
+
+
+def scan_dir(dirpath):
+    '''Lists a single directory. Returns a tuple of the names of the files
+    and the names of the subdirectories in it. Raises OSError if dirpath
+    can't be listed'''
+    filenames = []
+    subdirs = []
+    for name, is_dir, _, _ in _entries(dirpath):
+        if is_dir:
+            subdirs.append(name)
+        elif is_dir is False:
+            filenames.append(name)
+    return filenames, subdirs
+
+
+def walk_files(top, followlinks=False):
+    '''Returns the paths (relative to top) of the files below top, in the
+    order of an os.walk with the names in each directory sorted, so the
+    order doesn't depend on the filesystem. Dot names are skipped. If
+    followlinks is True, symlinked directories are walked too, except for
+    links back to a directory being walked'''
+    paths = []
+
+    def walk(dirpath, prefix, ancestors):
+        '''Adds the files below dirpath'''
+        try:
+            entries = sorted(_entries(dirpath), key=lambda entry: entry[0])
+        except OSError:
+            return
+        subdirs = []
+        for name, is_dir, fullpath, _ in entries:
+            if is_dir is False:
+                paths.append(prefix + name)
+            elif is_dir or (followlinks and os.path.isdir(fullpath)):
+                subdirs.append((name, fullpath))
+        for name, fullpath in subdirs:
+            realpath = os.path.realpath(fullpath)
+            if realpath not in ancestors:
+                walk(fullpath, prefix + name + '/', ancestors | {realpath})
+
+    walk(top, '', frozenset([os.path.realpath(top)]))
+    return paths
+
+
+def list_files(dirpath):
+    '''Returns a list of (name, stat key) tuples for the files in a single
+    directory, in directory order; see plist_cache.stat_key. Returns an
+    empty list if dirpath can't be listed'''
+    try:
+        entries = _entries(dirpath)
+    except OSError:
+        return []
+    files = []
+    for name, is_dir, _, stat in entries:
+        if is_dir is not False:
+            continue
+        try:
+            files.append((name, stat_key(stat())))
+        except OSError:
+            # removed since it was listed
+            pass
+    return files
+
+
+def stat_files(top, relpaths):
+    '''Returns a list of (relative path, stat key) tuples for the files at
+    relpaths (as listed by the repo index) below top. Files that are gone
+    are left out'''
+    stat_keys = []
+    for relpath in relpaths:
+        try:
+            stat_keys.append((relpath, stat_key(
+                os.stat(os.path.join(top, os.path.normpath(relpath))))))
+        except OSError:
+            pass
+    return stat_keys
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+benchmarks/catalog_rebuild.py
+
+Measures the built-in catalog builder on a generated repo: a cold build,
+a rebuild with nothing changed and a rebuild after one pkginfo file
+changed. With --makecatalogs, munki's makecatalogs is timed on the same
+repo for comparison.
+
+Usage: python benchmarks/catalog_rebuild.py [--items N] [--makecatalogs PATH]
+"""
+import argparse
+import os
+import plistlib
+import subprocess
+
+from common import setup, timed, report
+
+
+def make_repo(repo_dir, count):
+    '''Writes count pkginfo files (and their installer items) spread over
+    a few catalogs'''
+    for index in range(count):
+        name = 'Item%s' % (index // 4)
+        version = '1.%s' % (index % 4)
+        subdir = 'dir%s' % (index % 50)
+        location = '%s/%s-%s.dmg' % (subdir, name, version)
+        pkginfo = {
+            'name': name, 'version': version,
+            'catalogs': ['production'] if index % 3 else ['testing'],
+            'installer_item_location': location,
+            'installer_item_size': index,
+            'description': 'Benchmark item %s' % index,
+            'receipts': [{'packageid': 'com.example.%s' % name,
+                          'version': version}],
+        }
+        pkginfo_dir = os.path.join(repo_dir, 'pkgsinfo', subdir)
+        pkgs_dir = os.path.join(repo_dir, 'pkgs', subdir)
+        for directory in (pkginfo_dir, pkgs_dir):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        plistlib.writePlist(pkginfo, os.path.join(
+            pkginfo_dir, '%s-%s.plist' % (name, version)))
+        open(os.path.join(repo_dir, 'pkgs', location), 'w').close()
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--items', type=int, default=20000,
+                        help='number of pkginfo files (default 20000)')
+    parser.add_argument('--makecatalogs', metavar='PATH',
+                        help='path to munki\'s makecatalogs')
+    options = parser.parse_args()
+
+    repo_dir = setup()
+    from catalogs.builder import CatalogBuilder
+
+    make_repo(repo_dir, options.items)
+    catalog_builder = CatalogBuilder()
+    errors, seconds = timed(catalog_builder.build)
+    if errors:
+        print '%s errors, first: %s' % (len(errors), errors[0])
+    report('cold build', seconds, options.items)
+    _, seconds = timed(catalog_builder.build)
+    report('rebuild, nothing changed', seconds, options.items)
+
+    changed_path = os.path.join(
+        repo_dir, 'pkgsinfo', 'dir0', 'Item0-1.0.plist')
+    pkginfo = plistlib.readPlist(changed_path)
+    pkginfo['catalogs'].append('staging')
+    plistlib.writePlist(pkginfo, changed_path)
+    _, seconds = timed(catalog_builder.build)
+    report('rebuild, one file changed', seconds, options.items)
+
+    if options.makecatalogs:
+        with open(os.devnull, 'w') as devnull:
+            _, seconds = timed(subprocess.call,
+                               [options.makecatalogs, repo_dir],
+                               stdout=devnull, stderr=devnull)
+        report('makecatalogs', seconds, options.items)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+benchmarks/common.py
+
+Shared setup for the benchmark scripts. Django is configured from
+settings_template.py, with MUNKI_REPO_DIR pointing at a scratch directory
+and an in-memory database, so benchmarks never touch a real repo
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BASE_DIR not in sys.path:
+    sys.path.insert(0, BASE_DIR)
+
+REPO_KINDS = ('catalogs', 'icons', 'manifests', 'pkgs', 'pkgsinfo')
+
+
+def setup(create_tables=False, **overrides):
+    '''Configures Django with a fresh scratch repo and sets it up. Settings
+    in overrides replace those of the template. If create_tables is True,
+    the database tables are created. Returns the path of the scratch repo,
+    which is removed when the script exits'''
+    import atexit
+    from django.conf import settings
+    from munkiwebadmin import settings_template
+
+    scratch_dir = tempfile.mkdtemp(prefix='mwa_benchmark_')
+    atexit.register(shutil.rmtree, scratch_dir, True)
+    repo_dir = os.path.join(scratch_dir, 'repo')
+    for kind in REPO_KINDS:
+        os.makedirs(os.path.join(repo_dir, kind))
+
+    config = dict((name, getattr(settings_template, name))
+                  for name in dir(settings_template) if name.isupper())
+    config.update({
+        'INSTALLED_APPS': [app for app in config['INSTALLED_APPS']
+                           if app != 'django_wsgiserver'],
+        'DATABASES': {'default': {'ENGINE': 'django.db.backends.sqlite3',
+                                  'NAME': ':memory:'}},
+        'MUNKI_REPO_DIR': repo_dir,
+        'MEDIA_ROOT': os.path.join(repo_dir, 'icons'),
+        'METADATA_INDEX_PATH': os.path.join(scratch_dir, 'index.sqlite3'),
+        'ALLOWED_HOSTS': ['*'],
+        'DEBUG': False,
+    })
+    config['LOGGING']['loggers']['munkiwebadmin']['level'] = 'ERROR'
+    config.update(overrides)
+    settings.configure(**config)
+
+    import django
+    django.setup()
+    if create_tables:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0, interactive=False)
+    return repo_dir
+
+
+def timed(function, *args, **kwargs):
+    '''Calls function; returns a tuple of its result and the elapsed
+    time'''
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - start
+
+
+def report(label, seconds, count=None, unit='items'):
+    '''Prints a line of results'''
+    line = '%-40s %8.3fs' % (label, seconds)
+    if count is not None:
+        line += '  %10.0f %s/s' % (count / seconds if seconds else 0, unit)
+    print line
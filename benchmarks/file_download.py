@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+benchmarks/file_download.py
+
+Measures downloads of a large pkg through the file API: the whole file,
+resuming the last tenth with a Range request, a Range request with a stale
+If-Range (which gets the whole file) and a response handed to the
+front-end web server with X-Accel-Redirect.
+
+Usage: python benchmarks/file_download.py [--megabytes N]
+"""
+import argparse
+import os
+
+from common import setup, timed, report
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--megabytes', type=int, default=256,
+                        help='size of the pkg in MB (default 256)')
+    options = parser.parse_args()
+
+    repo_dir = setup(create_tables=True)
+    from django.contrib.auth.models import User
+    from django.test import Client
+    from api import views
+
+    size = options.megabytes * 1024 * 1024
+    with open(os.path.join(repo_dir, 'pkgs', 'large.dmg'), 'wb') as fileref:
+        for _ in range(options.megabytes):
+            fileref.write(os.urandom(1024 * 1024))
+    User.objects.create_superuser('benchmark', '', 'benchmark')
+    client = Client()
+    client.login(username='benchmark', password='benchmark')
+
+    def download(**extra):
+        '''Downloads the pkg; returns the number of bytes received'''
+        response = client.get('/api/pkgs/large.dmg', **extra)
+        received = 0
+        for chunk in response.streaming_content:
+            received += len(chunk)
+        response.close()
+        return received
+
+    for label, extra in (
+            ('whole file', {}),
+            ('resume last 10%', {'HTTP_RANGE': 'bytes=%s-' % (size * 9 / 10)}),
+            ('stale If-Range', {'HTTP_RANGE': 'bytes=%s-' % (size * 9 / 10),
+                                'HTTP_IF_RANGE': '"stale"'})):
+        received, seconds = timed(download, **extra)
+        report('%s (%s MB)' % (label, received / 1024 / 1024), seconds,
+               received / 1024.0 / 1024, 'MB')
+
+    views.FILE_API_SENDFILE = 'X-Accel-Redirect'
+    response, seconds = timed(client.get, '/api/pkgs/large.dmg')
+    report('X-Accel-Redirect (%s)' % response['X-Accel-Redirect'], seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+benchmarks/git_commits.py
+
+Measures git commits per second for each available git backend: every
+commit stages, inspects and commits a single changed pkginfo file, as the
+GitCommitQueue does for a single edit.
+
+Usage: python benchmarks/git_commits.py [--commits N]
+"""
+import argparse
+import os
+import subprocess
+
+from common import setup, timed, report
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--commits', type=int, default=100,
+                        help='number of commits per backend (default 100)')
+    options = parser.parse_args()
+
+    repo_dir = setup()
+    from django.contrib.auth.models import User
+    from munkiwebadmin import git_backends, utils
+
+    git = git_backends.GIT or 'git'
+    for args in (['init', '-q'], ['config', 'user.name', 'benchmark'],
+                 ['config', 'user.email', 'benchmark@example.com']):
+        subprocess.check_call([git] + args, cwd=repo_dir)
+    committer = User(username='benchmark')
+    author_name, author_info = utils.git_author(committer)
+    pkginfo_path = os.path.join(repo_dir, 'pkgsinfo', 'Firefox-1.0')
+
+    backends = [('subprocess', git_backends.SubprocessBackend)]
+    if git_backends.HAVE_DULWICH:
+        backends.append(('dulwich', git_backends.DulwichBackend))
+    else:
+        print 'dulwich is not installed; skipping the dulwich backend'
+    queue = utils.GitCommitQueue()
+    for name, backend_class in backends:
+        backend = backend_class()
+        backend.cmd = git
+        utils.GIT_BACKEND = backend
+
+        def commit_edits():
+            '''Edits and commits the pkginfo file options.commits times'''
+            for count in range(options.commits):
+                with open(pkginfo_path, 'w') as fileref:
+                    fileref.write('%s %s\n' % (name, count))
+                toplevel = backend.toplevel(repo_dir)
+                queue._commit_paths(
+                    toplevel, [pkginfo_path], author_name, author_info)
+
+        _, seconds = timed(commit_edits)
+        report('%s backend' % name, seconds, options.commits, 'commits')
+
+
+if __name__ == '__main__':
+    main()
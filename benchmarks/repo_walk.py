@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+benchmarks/repo_walk.py
+
+Counts the stat calls made, and measures the time taken, to walk a
+generated repo directory with api.walker, listing with scandir (when
+installed) and with the os.listdir fallback that stats every entry.
+
+Usage: python benchmarks/repo_walk.py [--dirs N] [--files N]
+"""
+import argparse
+import os
+
+from common import setup, timed, report
+
+
+class StatCounter(object):
+    '''Counts calls to os.stat and os.lstat while active'''
+    def __init__(self):
+        self.count = 0
+        self.saved = None
+
+    def __enter__(self):
+        self.count = 0
+        self.saved = (os.stat, os.lstat)
+
+        def counted(function):
+            '''Wraps function to count its calls'''
+            def wrapper(*args, **kwargs):
+                '''Counts the call'''
+                self.count += 1
+                return function(*args, **kwargs)
+            return wrapper
+
+        os.stat, os.lstat = counted(os.stat), counted(os.lstat)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.stat, os.lstat = self.saved
+
+
+def make_tree(top, dirs, files):
+    '''Creates dirs directories of files empty files each below top'''
+    for dir_index in range(dirs):
+        dirpath = os.path.join(top, 'dir%s' % dir_index)
+        os.makedirs(dirpath)
+        for file_index in range(files):
+            open(os.path.join(
+                dirpath, 'item%s.plist' % file_index), 'w').close()
+
+
+def walk(walker, top):
+    '''Walks top with walker.scan_dir; returns the number of files'''
+    count = 0
+    todo = [top]
+    while todo:
+        dirpath = todo.pop()
+        filenames, subdirs = walker.scan_dir(dirpath)
+        count += len(filenames)
+        todo.extend(os.path.join(dirpath, name) for name in subdirs)
+    return count
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--dirs', type=int, default=500,
+                        help='number of directories (default 500)')
+    parser.add_argument('--files', type=int, default=100,
+                        help='files per directory (default 100)')
+    options = parser.parse_args()
+
+    repo_dir = setup()
+    from api import walker
+
+    top = os.path.join(repo_dir, 'pkgsinfo')
+    make_tree(top, options.dirs, options.files)
+    modes = [('listdir + isdir/islink', None)]
+    if walker.scandir is not None:
+        modes.append(('scandir', walker.scandir))
+    else:
+        print 'scandir is not available; skipping the scandir walk'
+    saved_scandir = walker.scandir
+    try:
+        for label, scandir in modes:
+            walker.scandir = scandir
+            with StatCounter() as counter:
+                count, seconds = timed(walk, walker, top)
+            report('%s (%s stat calls)' % (label, counter.count),
+                   seconds, count, 'files')
+    finally:
+        walker.scandir = saved_scandir
+
+
+if __name__ == '__main__':
+    main()
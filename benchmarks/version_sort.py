@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+benchmarks/version_sort.py
+
+Measures sorting version strings newest first, as Pkginfo.data does: with
+the cmp function that built two LooseVersion objects per comparison, and
+with version_key, both with an empty key cache and once it is warm.
+
+Usage: python benchmarks/version_sort.py [--versions N]
+"""
+import argparse
+import random
+from distutils.version import LooseVersion
+
+from common import setup, timed, report
+
+
+def make_versions(count):
+    '''Returns count random version strings in Munki's usual shapes'''
+    rand = random.Random(0)
+    versions = []
+    for _ in range(count):
+        components = [str(rand.randint(0, 20))
+                      for _ in range(rand.randint(1, 4))]
+        version = '.'.join(components)
+        if rand.random() < 0.1:
+            version += rand.choice(['a1', 'b2', 'rc1', '-beta'])
+        versions.append(version)
+    return versions
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--versions', type=int, default=50000,
+                        help='number of versions to sort (default 50000)')
+    options = parser.parse_args()
+
+    setup()
+    from munkiwebadmin import utils
+
+    versions = make_versions(options.versions)
+
+    def compare_versions(a, b):
+        '''The comparison Pkginfo.data used to sort with'''
+        return cmp(LooseVersion(b), LooseVersion(a))
+
+    _, seconds = timed(sorted, versions, compare_versions)
+    report('LooseVersion cmp sort', seconds, options.versions, 'versions')
+    utils.VERSION_KEY_CACHE.clear()
+    _, seconds = timed(sorted, versions, key=utils.version_key, reverse=True)
+    report('version_key sort, cold cache', seconds, options.versions,
+           'versions')
+    _, seconds = timed(sorted, versions, key=utils.version_key, reverse=True)
+    report('version_key sort, warm cache', seconds, options.versions,
+           'versions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+"""
+catalogs/builder.py
+
+An in-process, incremental replacement for makecatalogs
+"""
+import logging
+import os
+import plistlib
+import tempfile
+import threading
+from StringIO import StringIO
+
+from django.conf import settings
+
+from api.repo_index import REPO_INDEX
+from api.plist_cache import stat_key
+from api.walker import scan_dir, stat_files, walk_files
+from munkiwebadmin.utils import DEFAULT_FILE_MODE
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+PKGSINFO_PATH = os.path.join(REPO_DIR, 'pkgsinfo')
+CATALOGS_PATH = os.path.join(REPO_DIR, 'catalogs')
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+# an empty catalog, split where the items go
+CATALOG_HEADER, CATALOG_FOOTER = plistlib.writePlistToString([]).split(
+    '<array>\n')
+CATALOG_HEADER += '<array>\n'
+
+
+def catalog_data(fragments):
+    '''Returns the serialized catalog made of fragments, each the
+    serialization of a single item. The result is identical to
+    plistlib.writePlistToString(items)'''
+    return ''.join([CATALOG_HEADER] + fragments + [CATALOG_FOOTER])
+
+
+def serialize_item(item):
+    '''Returns the serialization of item as an element of a catalog'''
+    fileref = StringIO()
+    writer = plistlib.PlistWriter(fileref, indentLevel=1, writeHeader=0)
+    writer.writeValue(item)
+    return fileref.getvalue()
+
+
+class Contribution(object):
+    '''What a single pkginfo file contributes to the catalogs'''
+    def __init__(self, pathname, cache_key, pkginfo):
+        self.pathname = pathname
+        self.cache_key = cache_key
+        self.catalogs = pkginfo.get('catalogs', [])
+        # the checks makecatalogs makes, in its order: ('error', message)
+        # excludes the item, ('exists', location, what) excludes it unless
+        # the item at location exists in pkgs
+        self.checks = []
+        if 'name' not in pkginfo:
+            self.checks.append(
+                ('error', 'WARNING: file %s is missing name' % pathname))
+        do_pkg_check = True
+        installer_type = pkginfo.get('installer_type')
+        if installer_type in ['nopkg', 'apple_update_metadata']:
+            do_pkg_check = False
+        if pkginfo.get('PackageCompleteURL') or pkginfo.get('PackageURL'):
+            do_pkg_check = False
+        if do_pkg_check:
+            if 'installer_item_location' not in pkginfo:
+                self.checks.append(
+                    ('error', 'WARNING: file %s is missing '
+                              'installer_item_location' % pathname))
+            else:
+                self._check_location(
+                    pkginfo['installer_item_location'], 'installer')
+            if (pkginfo.get('uninstall_method') == 'AdobeCCPUninstaller'
+                    and 'uninstaller_item_location' not in pkginfo):
+                self.checks.append(
+                    ('error', 'WARNING: file %s is missing '
+                              'uninstaller_item_location' % pathname))
+            if 'uninstaller_item_location' in pkginfo:
+                self._check_location(
+                    pkginfo['uninstaller_item_location'], 'uninstaller')
+        # don't copy admin notes to catalogs
+        if pkginfo.get('notes'):
+            del pkginfo['notes']
+        # strip out any keys that start with "_"
+        for key in pkginfo.keys():
+            if key.startswith('_'):
+                del pkginfo[key]
+        self.fragment = serialize_item(pkginfo)
+
+    def _check_location(self, location, what):
+        '''Adds the checks for an installer or uninstaller item
+        location'''
+        if isinstance(location, basestring):
+            self.checks.append(('exists', location, what))
+        else:
+            self.checks.append(
+                ('error', 'WARNING: invalid %s_item_location in info file %s'
+                 % (what, self.pathname)))
+
+    def problems(self):
+        '''Returns a list of reasons the item can't be added to catalogs.
+        Like makecatalogs, only the first is reported'''
+        for check in self.checks:
+            if check[0] == 'error':
+                return [check[1]]
+            location, what = check[1:]
+            if not os.path.exists(os.path.join(REPO_DIR, 'pkgs', location)):
+                return ['WARNING: Info file %s refers to missing %s item: %s'
+                        % (self.pathname, what, location)]
+        return []
+
+
+class CatalogBuilder(object):
+    '''Builds catalogs from the pkginfo files like makecatalogs does, but
+    keeps each file's contribution between builds, so only changed pkginfo
+    files are read and only catalogs whose contents changed are
+    rewritten'''
+    def __init__(self):
+        self.contributions = {}
+        # catalog name -> (signature of contents, stat key of written file)
+        self.written = {}
+        self.lock = threading.Lock()
+
+    def _contribution(self, pathname, cache_key, errors):
+        '''Returns the (possibly cached) contribution of a pkginfo file, or
+        None if it can't be read'''
+        filepath = os.path.join(PKGSINFO_PATH, pathname)
+        contribution = self.contributions.get(pathname)
+        if contribution is None or contribution.cache_key != cache_key:
+            try:
+                pkginfo = plistlib.readPlist(filepath)
+            except IOError, err:
+                errors.append('IO error for %s: %s' % (filepath, err))
+                return None
+            except Exception, err:
+                errors.append(
+                    'Unexpected error for %s: %s' % (filepath, err))
+                return None
+            try:
+                contribution = Contribution(pathname, cache_key, pkginfo)
+            except Exception, err:
+                errors.append(
+                    'Unexpected error for %s: %s' % (filepath, err))
+                return None
+            self.contributions[pathname] = contribution
+        return contribution
+
+    def _write_catalog(self, name, fragments):
+        '''Writes a catalog file atomically; returns the new file's stat
+        key'''
+        catalogpath = os.path.join(CATALOGS_PATH, name)
+        # a unique name, in case makecatalogs or another process is
+        # writing the same catalog
+        filedesc, temppath = tempfile.mkstemp(
+            prefix='.%s.' % name, suffix='.tmp', dir=CATALOGS_PATH)
+        try:
+            with os.fdopen(filedesc, 'w') as fileref:
+                fileref.write(catalog_data(fragments))
+            os.chmod(temppath, DEFAULT_FILE_MODE)
+            os.rename(temppath, catalogpath)
+        except (IOError, OSError):
+            try:
+                os.unlink(temppath)
+            except OSError:
+                pass
+            raise
+        REPO_INDEX.invalidate('catalogs', name)
+        return stat_key(os.stat(catalogpath))
+
+    def build(self, status_callback=None):
+        '''Builds the catalogs. Returns a list of errors and warnings; if it
+        isn't empty, makecatalogs would have exited with a non-zero code.
+        status_callback, if given, is called with progress messages'''
+        def record(message):
+            '''Passes a progress message to status_callback'''
+            if status_callback:
+                status_callback(message)
+
+        with self.lock:
+            errors = []
+            # like makecatalogs, follow symlinked directories; sorted, so
+            # the order of items in the catalogs is stable
+            pathnames = walk_files(PKGSINFO_PATH, followlinks=True)
+            # forget about files that are gone
+            for pathname in set(self.contributions) - set(pathnames):
+                del self.contributions[pathname]
+
+            catalogs = {'all': []}
+            signatures = {'all': []}
+            for pathname, cache_key in stat_files(PKGSINFO_PATH, pathnames):
+                contribution = self._contribution(pathname, cache_key, errors)
+                if contribution is None:
+                    continue
+                problems = contribution.problems()
+                if problems:
+                    # skip this pkginfo
+                    errors.extend(problems)
+                    continue
+                signature = (pathname, contribution.cache_key)
+                catalogs['all'].append(contribution.fragment)
+                signatures['all'].append(signature)
+                for catalogname in contribution.catalogs:
+                    if not catalogname:
+                        errors.append(
+                            'WARNING: Info file %s has an empty catalog name!'
+                            % pathname)
+                        continue
+                    catalogs.setdefault(catalogname, []).append(
+                        contribution.fragment)
+                    signatures.setdefault(catalogname, []).append(signature)
+                    record('Adding %s to %s...' % (pathname, catalogname))
+
+            if not os.path.exists(CATALOGS_PATH):
+                os.mkdir(CATALOGS_PATH)
+            # clear out old catalogs
+            for name in scan_dir(CATALOGS_PATH)[0]:
+                if name not in catalogs:
+                    os.remove(os.path.join(CATALOGS_PATH, name))
+                    REPO_INDEX.invalidate('catalogs', name)
+                    self.written.pop(name, None)
+
+            # write the catalogs whose contents changed
+            for name in sorted(catalogs):
+                catalogpath = os.path.join(CATALOGS_PATH, name)
+                try:
+                    current_key = stat_key(os.stat(catalogpath))
+                except OSError:
+                    current_key = None
+                if self.written.get(name) == (signatures[name], current_key):
+                    continue
+                self.written[name] = (
+                    signatures[name],
+                    self._write_catalog(name, catalogs[name]))
+                record('Created catalog %s...' % catalogpath)
+
+            for error in errors:
+                LOGGER.warning(error)
+            return errors
+
+
+CATALOG_BUILDER = CatalogBuilder()
@@ -3,13 +3,26 @@ catalogs/models.py
 
 """
 #from django.db import models
+import json
 import os
 import plistlib
+import threading
 from xml.parsers.expat import ExpatError
 
 from django.conf import settings
 
+from api.walker import list_files
+from api.pkginfo_index import PKGINFO_INDEX
+
 REPO_DIR = settings.MUNKI_REPO_DIR
+CATALOGS_PATH = os.path.join(REPO_DIR, 'catalogs')
+
+# validate and count the items in catalogs by looking at their text instead
+# of parsing them when listing catalogs
+try:
+    SNIFF_CATALOGS = settings.CATALOG_LIST_SNIFF
+except AttributeError:
+    SNIFF_CATALOGS = False
 
 
 def trim_version_string(version_string):
@@ -37,22 +50,14 @@ class Catalog(object):
     def list(cls):
         '''Returns a list of available catalogs, which is a list
         of catalog names (strings)'''
-        catalogs_path = os.path.join(REPO_DIR, 'catalogs')
-        catalogs = []
-        for name in os.listdir(catalogs_path):
-            if name.startswith("._") or name == ".DS_Store" or name == 'all':
-                # don't process these
-                continue
-            try:
-                # attempt to read the plist so we know it's valid
-                _ = plistlib.readPlist(
-                    os.path.join(catalogs_path, name))
-            except (ExpatError, IOError):
-                # skip items that aren't valid plists
-                pass
-            else:
-                catalogs.append(name)
-        return catalogs
+        return [name for name, _ in CATALOG_CACHE.summaries()]
+
+    @classmethod
+    def list_detail(cls):
+        '''Returns a list of dictionaries with the name, number of items
+        and size in bytes of each available catalog'''
+        return [{'name': name, 'items': entry.count, 'size': entry.key[1]}
+                for name, entry in CATALOG_CACHE.summaries()]
 
     @classmethod
     def next_catalog_contents(cls):
@@ -92,50 +97,152 @@ class Catalog(object):
     def catalog_info(cls):
         '''Returns a dictionary containing types of install items
         used by autocomplete and manifest validation'''
-        catalog_info = {}
-        categories_set = set()
-        developers_set = set()
-        for catalog, catalog_items in cls.next_catalog_contents():
-            suggested_set = set()
-            update_set = set()
-            versioned_set = set()
-            if catalog_items:
-                suggested_names = list(set(
-                    [item['name'] for item in catalog_items
-                     if not item.get('update_for')]))
-                suggested_set.update(suggested_names)
-                update_names = list(set(
-                    [item['name'] for item in catalog_items
-                     if item.get('update_for')]))
-                update_set.update(update_names)
-                item_names_with_versions = list(set(
-                    [item['name'] + '-' +
-                     trim_version_string(item['version'])
-                     for item in catalog_items]))
-                versioned_set.update(item_names_with_versions)
-                catalog_info[catalog] = {}
-                catalog_info[catalog]['suggested'] = list(suggested_set)
-                catalog_info[catalog]['updates'] = list(update_set)
-                catalog_info[catalog]['with_version'] = list(versioned_set)
-                categories_set.update(
-                    {item['category'] for item in catalog_items
-                     if item.get('category')})
-                developers_set.update(
-                    {item['developer'] for item in catalog_items
-                     if item.get('developer')})
-        catalog_info['._categories'] = list(categories_set)
-        catalog_info['._developers'] = list(developers_set)
-        return catalog_info
+        return json.loads(cls.catalog_info_json())
+
+    @classmethod
+    def catalog_info_json(cls):
+        '''Returns the catalog_info dictionary serialized as JSON. Only
+        catalogs that changed since the last call are re-read'''
+        return CATALOG_CACHE.catalog_info_json()
 
     @classmethod
-    def get_pkg_ref_count(cls, pkg_path):
+    def get_pkg_ref_count(cls, pkg_path, sync=True):
         '''Returns the number of pkginfo items containing a reference to
-        pkg_path'''
-        matching_count = 0
-        catalog_items = Catalog.detail('all')
+        pkg_path. If sync is False, the pkginfo index isn't synced first'''
+        return PKGINFO_INDEX.ref_count(pkg_path, sync=sync)
+
+
+def compute_catalog_info(catalog_items):
+    '''Returns a (dictionary, categories, developers) tuple of the install
+    items in a single catalog'''
+    suggested_set = set()
+    update_set = set()
+    versioned_set = set()
+    suggested_names = list(set(
+        [item['name'] for item in catalog_items
+         if not item.get('update_for')]))
+    suggested_set.update(suggested_names)
+    update_names = list(set(
+        [item['name'] for item in catalog_items
+         if item.get('update_for')]))
+    update_set.update(update_names)
+    item_names_with_versions = list(set(
+        [item['name'] + '-' +
+         trim_version_string(item['version'])
+         for item in catalog_items]))
+    versioned_set.update(item_names_with_versions)
+    info = {}
+    info['suggested'] = list(suggested_set)
+    info['updates'] = list(update_set)
+    info['with_version'] = list(versioned_set)
+    categories = {item['category'] for item in catalog_items
+                  if item.get('category')}
+    developers = {item['developer'] for item in catalog_items
+                  if item.get('developer')}
+    return info, categories, developers
+
+
+class CatalogEntry(object):
+    '''What is known about a catalog file with a given (mtime, size)'''
+    def __init__(self, key):
+        self.key = key
+        # None until the file has been sniffed or parsed
+        self.valid = None
+        self.count = None
+        # set once the file has been parsed
+        self.parsed = False
+        self.info = None
+
+    def parse(self, catalog_path):
+        '''Reads the catalog to validate it, count its items and compute its
+        catalog_info'''
+        self.parsed = True
+        try:
+            catalog_items = plistlib.readPlist(catalog_path)
+        except (ExpatError, IOError):
+            # not a valid plist
+            self.valid = False
+            return
+        self.valid = True
+        self.count = len(catalog_items)
         if catalog_items:
-            matches = [item for item in catalog_items
-                       if item.get('installer_item_location') == pkg_path]
-            matching_count = len(matches)
-        return matching_count
-                     
\ No newline at end of file
+            self.info = compute_catalog_info(catalog_items)
+
+    def sniff(self, catalog_path):
+        '''Checks that the catalog looks like a plist and counts its items
+        without parsing it. This relies on the formatting makecatalogs
+        uses'''
+        try:
+            with open(catalog_path) as fileref:
+                data = fileref.read()
+        except IOError:
+            self.valid = False
+            return
+        self.valid = (data.startswith('<?xml') and '<plist' in data[:512]
+                      and data.rstrip().endswith('</plist>'))
+        if self.valid:
+            self.count = data.count('\n\t<dict>\n')
+
+
+class CatalogCache(object):
+    '''Keeps what is known about each catalog file, keyed by its (mtime,
+    size), so each catalog is read at most once per change, and the JSON
+    serialization of the combined catalog_info'''
+    def __init__(self, sniff=SNIFF_CATALOGS):
+        self.sniff = sniff
+        # catalog name -> CatalogEntry
+        self.entries = {}
+        self.json_key = None
+        self.json_data = None
+        self.lock = threading.Lock()
+
+    def _refresh(self, parse=False):
+        '''Brings the entries up to date with the catalogs directory and
+        returns a list of (name, entry) tuples in directory order. If parse
+        is False, catalogs may be sniffed instead of parsed'''
+        current = []
+        for name, key in list_files(CATALOGS_PATH):
+            if name == 'all':
+                # don't process this
+                continue
+            catalog_path = os.path.join(CATALOGS_PATH, name)
+            entry = self.entries.get(name)
+            if entry is None or entry.key != key:
+                entry = CatalogEntry(key)
+            if parse or not self.sniff:
+                if not entry.parsed:
+                    entry.parse(catalog_path)
+            elif entry.valid is None:
+                entry.sniff(catalog_path)
+            current.append((name, entry))
+        self.entries = dict(current)
+        return current
+
+    def summaries(self):
+        '''Returns a list of (name, entry) tuples for the valid catalogs'''
+        with self.lock:
+            return [(name, entry) for name, entry in self._refresh()
+                    if entry.valid]
+
+    def catalog_info_json(self):
+        '''Returns the combined catalog_info as JSON'''
+        with self.lock:
+            current = self._refresh(parse=True)
+            key = tuple(sorted((name, entry.key) for name, entry in current))
+            if key != self.json_key:
+                catalog_info = {}
+                categories_set = set()
+                developers_set = set()
+                for name, entry in current:
+                    if entry.info:
+                        catalog_info[name] = entry.info[0]
+                        categories_set.update(entry.info[1])
+                        developers_set.update(entry.info[2])
+                catalog_info['._categories'] = list(categories_set)
+                catalog_info['._developers'] = list(developers_set)
+                self.json_data = json.dumps(catalog_info)
+                self.json_key = key
+            return self.json_data
+
+
+CATALOG_CACHE = CatalogCache()
@@ -1,3 +1,173 @@
-from django.test import TestCase
+import datetime
+import os
+import plistlib
+import shutil
+import tempfile
 
-# Create your tests here.
\ No newline at end of file
+from django.test import SimpleTestCase
+
+from catalogs import builder
+from munkiwebadmin.utils import DEFAULT_FILE_MODE
+
+ITEMS = [
+    {'name': 'Firefox', 'version': '1.0', 'catalogs': ['testing'],
+     'installer_item_location': 'apps/Firefox-1.0.dmg',
+     'installer_item_size': 1024, 'uninstallable': True,
+     'receipts': [{'packageid': 'org.mozilla.firefox', 'version': '1.0'}],
+     'description': u'Caf\xe9 <&> "quotes"\nsecond line'},
+    {'name': 'Empty', 'version': '2', 'catalogs': [],
+     'blocking_applications': [], 'installs': [{}],
+     'installer_type': 'nopkg'},
+    {'name': 'Dated', 'version': '3',
+     'force_install_after_date': datetime.datetime(2016, 1, 2, 3, 4, 5),
+     'icon_data': plistlib.Data('\x00\x01binary'), 'minimum_os': 10.5},
+]
+
+
+class CatalogDataTest(SimpleTestCase):
+    '''Catalogs written by the builder must be byte for byte what
+    makecatalogs (plistlib) writes'''
+    def test_matches_write_plist_to_string(self):
+        fragments = [builder.serialize_item(dict(item)) for item in ITEMS]
+        self.assertEqual(builder.catalog_data(fragments),
+                         plistlib.writePlistToString(ITEMS))
+
+    def test_empty_catalog(self):
+        self.assertEqual(builder.catalog_data([]),
+                         plistlib.writePlistToString([]))
+
+    def test_single_item(self):
+        fragments = [builder.serialize_item(dict(ITEMS[0]))]
+        self.assertEqual(builder.catalog_data(fragments),
+                         plistlib.writePlistToString(ITEMS[:1]))
+
+
+class ContributionTest(SimpleTestCase):
+    '''The checks made on each pkginfo file follow makecatalogs'''
+    def problems(self, pkginfo):
+        return builder.Contribution(
+            'apps/item', (0, 0), pkginfo).problems()
+
+    def test_missing_name(self):
+        self.assertEqual(
+            self.problems({'installer_type': 'nopkg'}),
+            ['WARNING: file apps/item is missing name'])
+
+    def test_nopkg_needs_no_installer_item(self):
+        self.assertEqual(
+            self.problems({'name': 'Item', 'installer_type': 'nopkg'}), [])
+
+    def test_package_url_needs_no_installer_item(self):
+        self.assertEqual(
+            self.problems({'name': 'Item', 'PackageURL': 'http://x/y'}), [])
+
+    def test_missing_installer_item_location(self):
+        self.assertEqual(
+            self.problems({'name': 'Item'}),
+            ['WARNING: file apps/item is missing installer_item_location'])
+
+    def test_invalid_installer_item_location(self):
+        self.assertEqual(
+            self.problems({'name': 'Item', 'installer_item_location': 5}),
+            ['WARNING: invalid installer_item_location in info file '
+             'apps/item'])
+
+    def test_missing_installer_item(self):
+        self.assertEqual(
+            self.problems({'name': 'Item', 'installer_item_location':
+                           'no/such/item-7f3a.dmg'}),
+            ['WARNING: Info file apps/item refers to missing installer '
+             'item: no/such/item-7f3a.dmg'])
+
+    def test_missing_uninstaller_item_location(self):
+        contribution = builder.Contribution(
+            'apps/item', (0, 0),
+            {'name': 'Item', 'installer_item_location': 'apps/item.dmg',
+             'uninstall_method': 'AdobeCCPUninstaller'})
+        self.assertEqual(
+            contribution.checks,
+            [('exists', 'apps/item.dmg', 'installer'),
+             ('error', 'WARNING: file apps/item is missing '
+                       'uninstaller_item_location')])
+
+    def test_uninstaller_checks_need_pkg_check(self):
+        self.assertEqual(
+            self.problems({'name': 'Item', 'installer_type': 'nopkg',
+                           'uninstall_method': 'AdobeCCPUninstaller'}),
+            [])
+
+    def test_only_first_problem_is_reported(self):
+        self.assertEqual(len(self.problems({})), 1)
+
+    def test_notes_and_private_keys_are_stripped(self):
+        contribution = builder.Contribution(
+            'apps/item', (0, 0),
+            {'name': 'Item', 'notes': 'admin only', '_metadata': {},
+             'catalogs': ['testing']})
+        self.assertEqual(contribution.fragment, builder.serialize_item(
+            {'name': 'Item', 'catalogs': ['testing']}))
+
+
+class WriteCatalogTest(SimpleTestCase):
+    '''Catalogs are written through a unique temporary file'''
+    def setUp(self):
+        self.catalogs_path = tempfile.mkdtemp()
+        self.saved_path = builder.CATALOGS_PATH
+        builder.CATALOGS_PATH = self.catalogs_path
+
+    def tearDown(self):
+        builder.CATALOGS_PATH = self.saved_path
+        shutil.rmtree(self.catalogs_path)
+
+    def test_write_catalog(self):
+        fragments = [builder.serialize_item(dict(item)) for item in ITEMS]
+        builder.CatalogBuilder()._write_catalog('testing', fragments)
+        self.assertEqual(os.listdir(self.catalogs_path), ['testing'])
+        catalogpath = os.path.join(self.catalogs_path, 'testing')
+        with open(catalogpath) as fileref:
+            self.assertEqual(fileref.read(),
+                             plistlib.writePlistToString(ITEMS))
+        self.assertEqual(os.stat(catalogpath).st_mode & 07777,
+                         DEFAULT_FILE_MODE)
+
+
+class BuildTest(SimpleTestCase):
+    '''Like makecatalogs, the build follows symlinked directories; the
+    items are in a stable (sorted) order'''
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.outside = tempfile.mkdtemp()
+        self.saved = (builder.REPO_DIR, builder.PKGSINFO_PATH,
+                      builder.CATALOGS_PATH)
+        builder.REPO_DIR = self.repo
+        builder.PKGSINFO_PATH = os.path.join(self.repo, 'pkgsinfo')
+        builder.CATALOGS_PATH = os.path.join(self.repo, 'catalogs')
+        for pathname in ['b/Beta', 'a/Zulu', 'a/Alpha', 'Top']:
+            self.write_item(builder.PKGSINFO_PATH, pathname)
+        self.write_item(self.outside, 'Linked')
+        os.symlink(self.outside,
+                   os.path.join(builder.PKGSINFO_PATH, 'c'))
+        # a link back up the tree must not loop
+        os.symlink(builder.PKGSINFO_PATH,
+                   os.path.join(builder.PKGSINFO_PATH, 'b', 'loop'))
+
+    def tearDown(self):
+        (builder.REPO_DIR, builder.PKGSINFO_PATH,
+         builder.CATALOGS_PATH) = self.saved
+        shutil.rmtree(self.repo)
+        shutil.rmtree(self.outside)
+
+    def write_item(self, top, pathname):
+        filepath = os.path.join(top, pathname)
+        if not os.path.isdir(os.path.dirname(filepath)):
+            os.makedirs(os.path.dirname(filepath))
+        plistlib.writePlist(
+            {'name': os.path.basename(pathname), 'installer_type': 'nopkg',
+             'catalogs': ['testing']}, filepath)
+
+    def test_build(self):
+        self.assertEqual(builder.CatalogBuilder().build(), [])
+        catalog = plistlib.readPlist(
+            os.path.join(builder.CATALOGS_PATH, 'testing'))
+        self.assertEqual([item['name'] for item in catalog],
+                         ['Top', 'Alpha', 'Zulu', 'Beta', 'Linked'])
@@ -3,28 +3,73 @@ catalogs//views.py
 """
 
 from django.http import HttpResponse
+from django.conf import settings
 from catalogs.models import Catalog
+from api.pkginfo_index import PKGINFO_INDEX
+from munkiwebadmin.utils import paths_validators, names_etag, \
+                                not_modified_response, set_validators
 import json
 import logging
+import os
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+CATALOGS_PATH = os.path.join(REPO_DIR, 'catalogs')
 
 LOGGER = logging.getLogger('munkiwebadmin')
 
+
+def catalogs_validators(variant=''):
+    '''Returns an (ETag, Last-Modified) tuple for responses built from the
+    files in the catalogs directory'''
+    try:
+        names = sorted(os.listdir(CATALOGS_PATH))
+    except OSError:
+        names = []
+    # include the directory itself so removals update Last-Modified
+    return paths_validators(
+        [CATALOGS_PATH] + [os.path.join(CATALOGS_PATH, name)
+                           for name in names], variant)
+
+
 def catalog_view(request):
-    '''Returns list of catalog names in JSON format'''
-    catalog_list = Catalog.list()
+    '''Returns list of catalog names in JSON format. With ?detail=1, returns
+    a list of dictionaries with the name, number of items and size of each
+    catalog instead'''
+    detail = request.GET.get('detail') in ('1', 'true')
+    etag, last_modified = catalogs_validators('detail' if detail else '')
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified:
+        return not_modified
+    if detail:
+        catalog_list = Catalog.list_detail()
+    else:
+        catalog_list = Catalog.list()
     LOGGER.debug("Got request for catalog names")
-    return HttpResponse(json.dumps(catalog_list),
-                        content_type='application/json')
+    response = HttpResponse(json.dumps(catalog_list),
+                            content_type='application/json')
+    return set_validators(response, etag, last_modified)
 
 def json_catalog_data(request):
     '''Returns complied and sorted catalog data in JSON format'''
     LOGGER.debug("Got request for catalog data")
-    return HttpResponse(json.dumps(Catalog.catalog_info()),
-                        content_type='application/json')
+    etag, last_modified = catalogs_validators()
+    not_modified = not_modified_response(request, etag, last_modified)
+    if not_modified:
+        return not_modified
+    response = HttpResponse(Catalog.catalog_info_json(),
+                            content_type='application/json')
+    return set_validators(response, etag, last_modified)
 
 def get_pkg_ref_count(request, pkg_path):
-    '''Returns the number of pkginfo files referencing a given pkg_path'''
+    '''Returns the number of pkginfo files referencing a given pkg_path.
+    The count comes from the pkginfo index, so the ETag is derived from the
+    index's validator'''
     LOGGER.debug("Got request for pkg ref count for %s", pkg_path)
-    return HttpResponse(json.dumps(Catalog.get_pkg_ref_count(pkg_path)),
-                        content_type='application/json')
-                              
\ No newline at end of file
+    etag = names_etag([pkg_path, PKGINFO_INDEX.validator()])
+    not_modified = not_modified_response(request, etag)
+    if not_modified:
+        return not_modified
+    response = HttpResponse(
+        json.dumps(Catalog.get_pkg_ref_count(pkg_path, sync=False)),
+        content_type='application/json')
+    return set_validators(response, etag)
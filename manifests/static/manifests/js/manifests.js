@@ -118,7 +118,6 @@ function initManifestsTable() {
                     return filter_terms;
                 }
             },
-            cache: false,
             dataSrc: function ( json ) {
                 var data_rows = [];
                 var column_rows = [];
@@ -134,7 +133,7 @@ function initManifestsTable() {
                 return column_rows;
             },
             complete: function(jqXHR, textStatus) {
-                window.clearInterval(poll_loop);
+                stop_status_monitor();
                 $('#process_progress').modal('hide');
             },
             global: false,
@@ -165,9 +164,8 @@ function initManifestsTable() {
 function monitor_manifest_list() {
     $('#process_progress_title_text').text('Getting manifest data...')
     $('#process_progress_status_text').text('Processing...')
-    poll_loop = setInterval(function() {
-            update_status('/manifests/__get_manifest_list_status');
-        }, 1000);
+    monitor_status('/manifests/__manifest_list_status_stream',
+                   '/manifests/__get_manifest_list_status');
 }
 
 
@@ -4,5 +4,6 @@ import manifests.views
 urlpatterns = [
     url(r'^$', manifests.views.index, name='manifests'),
     url(r'^__get_manifest_list_status$', manifests.views.status),
+    url(r'^__manifest_list_status_stream$', manifests.views.status_stream),
     url(r'^(?P<manifest_path>.*$)', manifests.views.index)
 ]
\ No newline at end of file
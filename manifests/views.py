@@ -6,7 +6,7 @@ from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 
 from api.models import Plist, FileDoesNotExistError, FileReadError
-from process.models import Process
+from process.utils import get_status, status_stream_response
 
 import json
 import logging
@@ -19,18 +19,23 @@ def status(request):
     '''Returns status of long-running process'''
     LOGGER.debug('got status request for manifests_list_process')
     status_response = {}
-    processes = Process.objects.filter(name='manifests_list_process')
-    if processes:
-        # display status from one of the active processes
-        # (hopefully there is only one!)
-        process = processes[0]
-        status_response['statustext'] = process.statustext
+    process_status = get_status('manifests_list_process')
+    if process_status:
+        status_response['statustext'] = process_status['statustext']
     else:
         status_response['statustext'] = 'Processing'
     return HttpResponse(json.dumps(status_response),
                         content_type='application/json')
 
 
+def status_stream(request):
+    '''Streams status messages for the process generating the manifests
+    list as Server-Sent Events'''
+    LOGGER.debug('got status stream request for manifests_list_process')
+    return status_stream_response(
+        lambda: get_status('manifests_list_process'), wait_for_change=True)
+
+
 @login_required
 def index(request, manifest_path=None):
     '''Returns manifest list or detail'''
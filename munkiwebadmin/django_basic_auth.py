@@ -2,9 +2,150 @@
 # and https://djangosnippets.org/snippets/243/
 
 import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
 
+from django.conf import settings
 from django.http import HttpResponse
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, get_user_model, load_backend
+from django.db.models.signals import post_delete, post_save
+
+from api.models import ApiToken
+
+# how long (in seconds) a verified API token is trusted before it is
+# looked up again; tokens deleted in another process keep working in this
+# one for up to this long
+try:
+    API_TOKEN_CACHE_TTL = settings.API_TOKEN_CACHE_TTL
+except AttributeError:
+    API_TOKEN_CACHE_TTL = 60
+
+# how long (in seconds) verified Basic auth credentials are remembered, so
+# the password isn't hashed again on every request. 0 disables the cache
+try:
+    BASIC_AUTH_CACHE_TTL = settings.BASIC_AUTH_CACHE_TTL
+except AttributeError:
+    BASIC_AUTH_CACHE_TTL = 0
+
+
+class CredentialCache(object):
+    """
+    In-memory cache of the ids of the users that credentials were verified
+    for. The credentials themselves are not kept: entries are keyed by an
+    HMAC of them with a random per-process key.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.secret = os.urandom(32)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _key(self, credentials):
+        return hmac.new(self.secret, credentials, hashlib.sha256).digest()
+
+    def get(self, credentials):
+        """Returns the cached value for credentials, or None"""
+        if not self.ttl:
+            return None
+        key = self._key(credentials)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[key]
+                return None
+            return entry[0]
+
+    def put(self, credentials, value):
+        """Remembers value (identifying a user) for credentials"""
+        if not self.ttl:
+            return
+        key = self._key(credentials)
+        now = time.time()
+        with self.lock:
+            if len(self.entries) > 10000:
+                # drop expired entries
+                for old_key, entry in self.entries.items():
+                    if entry[1] < now:
+                        del self.entries[old_key]
+            self.entries[key] = (value, now + self.ttl)
+
+    def clear(self):
+        """Forgets all credentials"""
+        with self.lock:
+            self.entries.clear()
+
+
+TOKEN_CACHE = CredentialCache(API_TOKEN_CACHE_TTL)
+BASIC_AUTH_CACHE = CredentialCache(BASIC_AUTH_CACHE_TTL)
+
+
+def clear_credential_caches(update_fields=None, **kwargs):
+    """
+    Signal handler: users and tokens that change may no longer match the
+    cached credentials, so forget them all. Logging in only updates
+    last_login, which doesn't matter.
+    """
+    if update_fields and set(update_fields) <= set(['last_login']):
+        return
+    TOKEN_CACHE.clear()
+    BASIC_AUTH_CACHE.clear()
+
+for sender in (settings.AUTH_USER_MODEL, ApiToken):
+    post_save.connect(clear_credential_caches, sender=sender,
+                      dispatch_uid='clear_credential_caches')
+    post_delete.connect(clear_credential_caches, sender=sender,
+                        dispatch_uid='clear_credential_caches')
+
+
+def token_user(key):
+    """
+    Returns the active user the API token key belongs to, or None. Only
+    the user id is cached, so the user is read on every request.
+    """
+    user_id = TOKEN_CACHE.get(key)
+    if user_id is None:
+        try:
+            token = ApiToken.objects.select_related('user').get(
+                digest=ApiToken.hash_key(key))
+        except ApiToken.DoesNotExist:
+            return None
+        user = token.user
+        TOKEN_CACHE.put(key, user.pk)
+    else:
+        try:
+            user = get_user_model().objects.get(pk=user_id)
+        except get_user_model().DoesNotExist:
+            return None
+    if not user.is_active:
+        return None
+    return user
+
+
+def basicauth_user(uname, passwd):
+    """
+    Returns the user authenticated by uname and passwd, or None. Uses
+    BASIC_AUTH_CACHE when BASIC_AUTH_CACHE_TTL is set; it keeps only the
+    user id and authentication backend, so the user is read on every
+    request.
+    """
+    credentials = (u'%s:%s' % (uname, passwd)).encode('utf-8')
+    cached = BASIC_AUTH_CACHE.get(credentials)
+    if cached is not None:
+        user_id, backend_path = cached
+        user = load_backend(backend_path).get_user(user_id)
+        if user is not None:
+            # like a user returned by authenticate()
+            user.backend = backend_path
+        return user
+    user = authenticate(username=uname, password=passwd)
+    if user is not None:
+        BASIC_AUTH_CACHE.put(credentials, (user.pk, user.backend))
+    return user
 
 #############################################################################
 #
@@ -28,23 +169,29 @@ def view_or_basicauth(view, request, test_func, realm="", *args, **kwargs):
             'HTTP_X_AUTHORIZATION' in request.META):
         auth = (request.META.get('HTTP_AUTHORIZATION') or
                 request.META.get('HTTP_X_AUTHORIZATION')).split()
+        user = None
         if len(auth) == 2:
-            # NOTE: We only support basic authentication for now.
-            #
-            if auth[0].lower() == "basic":
+            # API tokens: no password hashing
+            if auth[0].lower() in ("token", "bearer"):
+                try:
+                    user = token_user(auth[1])
+                except Exception:
+                    # any error here, let's fall through to a 401
+                    pass
+            elif auth[0].lower() == "basic":
                 try:
                     uname, passwd = base64.b64decode(
                         auth[1]).decode('utf-8').split(':', 1)
-                    user = authenticate(username=uname, password=passwd)
-                    if user is not None:
-                        if user.is_active:
-                            login(request, user)
-                            request.user = user
-                            if test_func(request.user):
-                                return view(request, *args, **kwargs)
+                    user = basicauth_user(uname, passwd)
                 except Exception:
                     # any error here, let's fall through to a 401
                     pass
+        # the credentials come with every request, so no session is
+        # started for them
+        if user is not None and user.is_active and test_func(user):
+            request.user = user
+            # errors in the view are not authentication failures
+            return view(request, *args, **kwargs)
 
     # Either they did not provide an authorization header or
     # something in the authorization attempt failed. Send a 401
@@ -62,8 +209,9 @@ def logged_in_or_basicauth(realm=""):
     A simple decorator that requires a user to be logged in. If they are not
     logged in the request is examined for a 'authorization' header.
 
-    If the header is present it is tested for basic authentication and
-    the user is logged in with the provided credentials.
+    If the header is present it is tested for basic (or API token)
+    authentication and the view is run as the user the credentials belong
+    to, without starting a session.
 
     If the header is not present a http 401 is sent back to the
     requestor to provide credentials.
@@ -0,0 +1,113 @@
+"""
+munkiwebadmin/executor.py
+
+A shared worker pool for bulk read/parse/filter work over many repo files
+"""
+import itertools
+import logging
+import os
+import threading
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+# 'thread' suits I/O-bound work (like reading from a network filesystem);
+# 'process' suits CPU-bound work (like parsing large XML plists)
+try:
+    MODE = settings.BULK_EXECUTOR_MODE
+except AttributeError:
+    MODE = 'thread'
+
+try:
+    WORKERS = settings.BULK_EXECUTOR_WORKERS
+except AttributeError:
+    WORKERS = 4
+
+try:
+    CHUNKSIZE = settings.BULK_EXECUTOR_CHUNKSIZE
+except AttributeError:
+    CHUNKSIZE = 16
+
+
+def _closing_connections(func):
+    '''Wraps func to close the database connections it opened. Django
+    opens a connection per thread and only closes those of request
+    threads, so pool threads must close theirs'''
+    def task(item):
+        '''Runs func on item'''
+        try:
+            return func(item)
+        finally:
+            connections.close_all()
+    return task
+
+
+class BulkExecutor(object):
+    '''Runs a function over many items using a lazily created pool of
+    threads or processes. Results are always returned in the order of the
+    items. Functions (and their arguments and results) must be picklable in
+    process mode, so use module-level functions'''
+    def __init__(self, mode=MODE, workers=WORKERS, chunksize=CHUNKSIZE):
+        if mode not in ('thread', 'process'):
+            LOGGER.error('Unknown BULK_EXECUTOR_MODE %s; using threads', mode)
+            mode = 'thread'
+        self.mode = mode
+        self.workers = workers
+        self.chunksize = chunksize
+        self.pool = None
+        self.pool_pid = None
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        '''Returns the pool, creating it if needed. A pool inherited from a
+        parent process (as when a WSGI server forks its workers) is not
+        usable, so it is replaced'''
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                if self.mode == 'process':
+                    self.pool = Pool(processes=self.workers)
+                else:
+                    self.pool = ThreadPool(processes=self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def imap(self, func, items, chunksize=None):
+        '''Generator that yields func(item) for each item, in order. Items
+        are dispatched one window of workers * chunksize items at a time, so
+        a caller that stops early doesn't leave the pool busy with work
+        nobody will use'''
+        chunksize = chunksize or self.chunksize
+        if self.workers <= 1:
+            for result in itertools.imap(func, items):
+                yield result
+            return
+        items = iter(items)
+        window = self.workers * chunksize
+        while True:
+            batch = list(itertools.islice(items, window))
+            if not batch:
+                return
+            if len(batch) <= chunksize:
+                # not worth handing off to the pool
+                results = [func(item) for item in batch]
+            elif self.mode == 'thread':
+                results = self._pool().map(
+                    _closing_connections(func), batch, chunksize)
+            else:
+                results = self._pool().map(func, batch, chunksize)
+            for result in results:
+                yield result
+
+    def map(self, func, items, chunksize=None):
+        '''Returns a list of func(item) for each item, in order'''
+        return list(self.imap(func, items, chunksize))
+
+
+EXECUTOR = BulkExecutor()
+# changes to repo files must be made in this process, since they update its
+# indexes and git commit queue, so they always run in threads
+WRITE_EXECUTOR = BulkExecutor(mode='thread', chunksize=1)
@@ -0,0 +1,306 @@
+"""
+munkiwebadmin/git_backends.py
+
+Backends used to find, stage and commit changes to the git repo the Munki
+repo lives in
+"""
+import logging
+import os
+import subprocess
+
+from django.conf import settings
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+try:
+    GIT = settings.GIT_PATH
+except AttributeError:
+    GIT = None
+
+# 'subprocess' runs the git binary; 'dulwich' works on the repo in-process
+try:
+    BACKEND = settings.GIT_BACKEND
+except AttributeError:
+    BACKEND = 'subprocess'
+
+try:
+    from dulwich.errors import NotGitRepository
+    from dulwich.ignore import IgnoreFilterManager
+    from dulwich.object_store import commit_tree_changes
+    from dulwich.objects import Tree
+    from dulwich.repo import Repo
+    HAVE_DULWICH = True
+except ImportError:
+    HAVE_DULWICH = False
+
+ACTIONS = {'A': 'created', 'M': 'modified', 'D': 'deleted'}
+
+
+class GitError(Exception):
+    '''Error staging or committing changes'''
+    pass
+
+
+def _stat_key(path):
+    '''Returns (mtime, size) for path, or None if it doesn't exist'''
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_mtime, stat_result.st_size)
+
+
+class GitBackend(object):
+    '''Base class for git backends. Caches the work tree root of each
+    directory and whether each path is ignored; ignore results are reused
+    until one of the .gitignore files that could affect them (or the repo's
+    info/exclude file) changes'''
+    def __init__(self):
+        self.toplevels = {}
+        self.ignore_cache = {}
+
+    def toplevel(self, directory):
+        '''Returns the (real) path to the root of the work tree containing
+        directory, or None if it isn't in a git repo'''
+        toplevel = self.toplevels.get(directory)
+        if toplevel is None:
+            toplevel = self._find_toplevel(directory)
+            if toplevel is not None:
+                self.toplevels[directory] = toplevel
+        return toplevel
+
+    def relpath(self, toplevel, a_path):
+        '''Returns a_path relative to the root of its work tree'''
+        return os.path.relpath(os.path.realpath(a_path), toplevel)
+
+    def ignored(self, toplevel, paths):
+        '''Returns the set of the paths that git ignores'''
+        result = set()
+        unknown = {}
+        for a_path in paths:
+            signature = self._ignore_signature(toplevel, a_path)
+            cached = self.ignore_cache.get(a_path)
+            if cached is not None and cached[0] == signature:
+                if cached[1]:
+                    result.add(a_path)
+            else:
+                unknown[a_path] = signature
+        if unknown:
+            ignored = self._check_ignore(toplevel, list(unknown))
+            for a_path, signature in unknown.items():
+                self.ignore_cache[a_path] = (signature, a_path in ignored)
+            result.update(ignored)
+        return result
+
+    def _ignore_signature(self, toplevel, a_path):
+        '''Returns the stat keys of the files that determine whether a_path
+        is ignored'''
+        sources = [os.path.join(toplevel, '.git', 'info', 'exclude')]
+        directory = os.path.dirname(os.path.realpath(a_path))
+        while True:
+            sources.append(os.path.join(directory, '.gitignore'))
+            parent = os.path.dirname(directory)
+            if directory == toplevel or parent == directory:
+                break
+            directory = parent
+        return tuple(_stat_key(source) for source in sources)
+
+    def _find_toplevel(self, directory):
+        '''Returns the root of the work tree containing directory, or
+        None'''
+        raise NotImplementedError
+
+    def _check_ignore(self, toplevel, paths):
+        '''Returns the set of the paths that git ignores, uncached'''
+        raise NotImplementedError
+
+    def stage(self, toplevel, paths):
+        '''Stages paths: those that exist are added, the others are
+        removed'''
+        raise NotImplementedError
+
+    def staged_changes(self, toplevel, paths):
+        '''Returns a dictionary mapping those of paths that have staged
+        changes to the action: created, modified or deleted'''
+        raise NotImplementedError
+
+    def commit(self, toplevel, log_msg, author_info, paths):
+        '''Commits the staged changes to paths'''
+        raise NotImplementedError
+
+
+class SubprocessBackend(GitBackend):
+    '''Runs the git binary, batching paths into as few invocations as
+    possible'''
+    cmd = GIT
+
+    def run_git(self, cwd, args):
+        '''Runs git in cwd; returns an (output, error, returncode) tuple'''
+        proc = subprocess.Popen([self.cmd] + args,
+                                shell=False,
+                                bufsize=-1,
+                                cwd=cwd,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (output, error) = proc.communicate()
+        return output, error, proc.returncode
+
+    def _find_toplevel(self, directory):
+        try:
+            output, _, returncode = self.run_git(
+                directory, ['rev-parse', '--show-toplevel'])
+        except OSError:
+            # directory doesn't exist
+            return None
+        if returncode != 0:
+            return None
+        return output.strip()
+
+    def _check_ignore(self, toplevel, paths):
+        output, _, _ = self.run_git(toplevel, ['check-ignore', '--'] + paths)
+        return set(output.splitlines()) & set(paths)
+
+    def stage(self, toplevel, paths):
+        existing = [a_path for a_path in paths if os.path.exists(a_path)]
+        missing = [a_path for a_path in paths if not os.path.exists(a_path)]
+        if existing:
+            _, error, returncode = self.run_git(
+                toplevel, ['add', '--'] + existing)
+            if returncode != 0:
+                raise GitError(error)
+        if missing:
+            _, error, returncode = self.run_git(
+                toplevel,
+                ['rm', '-q', '--cached', '--ignore-unmatch', '--'] + missing)
+            if returncode != 0:
+                raise GitError(error)
+
+    def staged_changes(self, toplevel, paths):
+        output, error, returncode = self.run_git(
+            toplevel, ['diff', '--cached', '--name-status', '--no-renames',
+                       '-z', '--'] + paths)
+        if returncode != 0:
+            raise GitError(error)
+        fields = output.split('\0')
+        statuses = dict(zip(fields[1::2], fields[0::2]))
+        changes = {}
+        for a_path in paths:
+            status = statuses.get(self.relpath(toplevel, a_path))
+            if status in ACTIONS:
+                changes[a_path] = ACTIONS[status]
+        return changes
+
+    def commit(self, toplevel, log_msg, author_info, paths):
+        _, error, returncode = self.run_git(
+            toplevel,
+            ['commit', '-m', log_msg, '--author', author_info, '--'] + paths)
+        if returncode != 0:
+            raise GitError(error)
+
+
+class DulwichBackend(GitBackend):
+    '''Works on the repo in-process using dulwich, so no processes are
+    forked'''
+    def __init__(self):
+        super(DulwichBackend, self).__init__()
+        self.repos = {}
+
+    def _repo(self, toplevel):
+        '''Returns a (cached) dulwich Repo for the work tree at toplevel'''
+        repo = self.repos.get(toplevel)
+        if repo is None:
+            repo = self.repos[toplevel] = Repo(toplevel)
+        return repo
+
+    def _find_toplevel(self, directory):
+        directory = os.path.realpath(directory)
+        while True:
+            try:
+                Repo(directory)
+                return directory
+            except NotGitRepository:
+                parent = os.path.dirname(directory)
+                if parent == directory:
+                    return None
+                directory = parent
+
+    def _check_ignore(self, toplevel, paths):
+        manager = IgnoreFilterManager.from_repo(self._repo(toplevel))
+        return set(a_path for a_path in paths
+                   if manager.is_ignored(self.relpath(toplevel, a_path)))
+
+    def stage(self, toplevel, paths):
+        # Repo.stage removes paths that no longer exist from the index
+        try:
+            self._repo(toplevel).stage(
+                [self.relpath(toplevel, a_path) for a_path in paths])
+        except (IOError, OSError, KeyError, ValueError), err:
+            raise GitError(err)
+
+    def staged_changes(self, toplevel, paths):
+        repo = self._repo(toplevel)
+        try:
+            tree_id = repo['HEAD'].tree
+        except KeyError:
+            # no commits yet
+            tree_id = None
+        wanted = dict((self.relpath(toplevel, a_path), a_path)
+                      for a_path in paths)
+        changes = {}
+        for (old_path, new_path), _, _ in repo.open_index().changes_from_tree(
+                repo.object_store, tree_id):
+            if old_path is None:
+                action, tree_path = 'created', new_path
+            elif new_path is None:
+                action, tree_path = 'deleted', old_path
+            else:
+                action, tree_path = 'modified', new_path
+            if tree_path in wanted:
+                changes[wanted[tree_path]] = action
+        return changes
+
+    def commit(self, toplevel, log_msg, author_info, paths):
+        # commit HEAD's tree with only paths updated from the index, so
+        # other staged changes aren't swept into this commit
+        repo = self._repo(toplevel)
+        try:
+            index = repo.open_index()
+            try:
+                tree = repo[repo['HEAD'].tree]
+            except KeyError:
+                # no commits yet
+                tree = Tree()
+            changes = []
+            for a_path in paths:
+                tree_path = self.relpath(toplevel, a_path)
+                if tree_path in index:
+                    entry = index[tree_path]
+                    changes.append((tree_path, entry.mode, entry.sha))
+                    continue
+                try:
+                    tree.lookup_path(repo.__getitem__, tree_path)
+                except KeyError:
+                    # neither staged nor committed
+                    continue
+                changes.append((tree_path, None, None))
+            tree = commit_tree_changes(repo.object_store, tree, changes)
+            repo.do_commit(log_msg, author=author_info, tree=tree.id)
+        except Exception, err:
+            raise GitError(err)
+
+
+def get_backend(name=BACKEND):
+    '''Returns a backend instance for name, falling back to the git binary
+    if the backend isn't available'''
+    if name == 'dulwich':
+        if HAVE_DULWICH:
+            return DulwichBackend()
+        LOGGER.error('GIT_BACKEND is dulwich, but dulwich is not installed; '
+                     'using the git binary')
+    elif name != 'subprocess':
+        LOGGER.error('Unknown GIT_BACKEND %s; using the git binary', name)
+    return SubprocessBackend()
+
+
+GIT_BACKEND = get_backend()
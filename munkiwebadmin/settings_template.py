@@ -241,8 +241,122 @@ ICONS_URL = MEDIA_URL
 # path to the makecatalogs binary
 MAKECATALOGS_PATH = '/usr/local/munki/makecatalogs'
 
+# set USE_NATIVE_MAKECATALOGS to True to build catalogs in-process instead
+# of running makecatalogs. Only the pkginfo files and catalogs that changed
+# since the last build are read and written. The output and the checks
+# made on pkginfo files follow makecatalogs, but makecatalogs remains the
+# reference implementation. With the built-in builder, saving or deleting
+# pkginfo files in MunkiWebAdmin also queues a rebuild.
+#USE_NATIVE_MAKECATALOGS = True
+
 # provide the path to the git binary if you want MunkiWebAdmin to add and commit
 # manifest edits to a git repo
 # if GITPATH is undefined or None MunkiWebAdmin will not attempt to do a git add
 # or commit
 #GIT_PATH = '/usr/bin/git'
+
+# MunkiWebAdmin keeps an in-memory index of the files in the repo and only
+# re-lists directories whose modification time has changed. If pyinotify is
+# installed, set REPO_INDEX_USE_INOTIFY to True to let inotify report
+# changes instead. Don't enable this if MUNKI_REPO_DIR is on a network
+# filesystem, since changes made by other hosts are not reported.
+#REPO_INDEX_USE_INOTIFY = True
+
+# Parsed plists are kept in an in-memory LRU cache. PLIST_CACHE_MAX_BYTES
+# limits the total (on-disk) size of the cached files, per process. Set it
+# to 0 to disable the cache.
+#PLIST_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Filtered API list requests are answered from an SQLite index of the
+# top-level keys of each pkginfo, manifest and catalog. The index is kept
+# next to the Django database by default; set METADATA_INDEX_PATH to None to
+# disable it. Before each query the index is checked against the
+# modification times of the files in the repo; to check at most every N
+# seconds, set METADATA_INDEX_SYNC_INTERVAL.
+#METADATA_INDEX_PATH = os.path.join(BASE_DIR, 'metadata_index.sqlite3')
+#METADATA_INDEX_SYNC_INTERVAL = 0
+
+# Bulk work over many repo files (reading and filtering plists for API list
+# requests, assembling the pkgsinfo list) is spread over a shared pool.
+# BULK_EXECUTOR_MODE is 'thread' (best when waiting on disk or network
+# I/O) or 'process' (best when parsing large plists is the bottleneck).
+#BULK_EXECUTOR_MODE = 'thread'
+#BULK_EXECUTOR_WORKERS = 4
+#BULK_EXECUTOR_CHUNKSIZE = 16
+
+# When GIT_PATH is set, changes are committed by a background queue so
+# requests don't wait on git. Changes made within GIT_COMMIT_DELAY seconds
+# of each other (and all the changes made by a mass edit or delete) are
+# committed together, one commit per author.
+#GIT_COMMIT_DELAY = 2
+
+# GIT_BACKEND selects how MunkiWebAdmin talks to git: 'subprocess' runs the
+# git binary at GIT_PATH; 'dulwich' works on the repo in-process (requires
+# the dulwich package, and GIT_PATH must still be set to enable commits).
+#GIT_BACKEND = 'subprocess'
+
+# Listing catalogs parses each catalog file once per change to check that
+# it is valid. Set CATALOG_LIST_SNIFF to True to check (and count items)
+# by looking at the text of the file instead, which is much faster for
+# large catalogs written by makecatalogs.
+#CATALOG_LIST_SNIFF = True
+
+# The pkgs referenced by each pkginfo file are kept in an in-memory index.
+# Before each lookup the index is checked against the modification times
+# of the pkginfo files; to check at most every N seconds, set
+# PKGINFO_INDEX_SYNC_INTERVAL.
+#PKGINFO_INDEX_SYNC_INTERVAL = 0
+
+# Progress messages for long-running operations (listing pkgsinfo and
+# manifests) are stored at most once every PROCESS_STATUS_UPDATE_INTERVAL
+# seconds per operation. They are kept in the cache named by
+# PROCESS_STATUS_CACHE if that cache is shared between processes. The
+# default local-memory cache is not, so by default they are kept in the
+# database instead. To keep them out of the database, configure a shared
+# cache, for example:
+#CACHES = {
+#    'default': {
+#        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#        'LOCATION': '127.0.0.1:11211',
+#    }
+#}
+#PROCESS_STATUS_CACHE = 'default'
+#PROCESS_STATUS_UPDATE_INTERVAL = 0.2
+# Pages follow these messages over Server-Sent Events streams, which fall
+# back to polling in older browsers. An open stream holds a server worker,
+# so streams end when the operation finishes, after 10 seconds without a
+# new message or after 30 seconds, and browsers reconnect as needed.
+
+# API clients can authenticate with an API token (created in the admin
+# site) by sending an "Authorization: Token <key>" header. Token requests
+# don't hash a password or create a session. A verified token is trusted
+# for API_TOKEN_CACHE_TTL seconds. Users are read on every request, so
+# deactivating a user applies at once; a token deleted while MunkiWebAdmin
+# runs in several processes can keep working in the others for up to
+# API_TOKEN_CACHE_TTL seconds.
+#API_TOKEN_CACHE_TTL = 60
+
+# Set BASIC_AUTH_CACHE_TTL to remember verified Basic auth credentials for
+# that many seconds, so the password isn't hashed on every API request.
+# Deactivations apply at once. With several processes, an old password
+# can keep working in the other processes for up to that long after a
+# change.
+#BASIC_AUTH_CACHE_TTL = 0
+
+# Files uploaded through the API get the permissions in
+# FILE_UPLOAD_PERMISSIONS, or if that isn't set, the usual permissions for
+# new files under the server's umask.
+#FILE_UPLOAD_PERMISSIONS = 0644
+
+# Files downloaded through the API (/api/pkgs/..., /api/icons/...) are sent
+# by Django, which supports resuming with Range requests. To have the
+# front-end web server send them instead, set FILE_API_SENDFILE to
+# 'X-Sendfile' (Apache with mod_xsendfile) or 'X-Accel-Redirect' (nginx).
+# For nginx, FILE_API_ACCEL_REDIRECT_PREFIX is an internal location that
+# serves MUNKI_REPO_DIR, for example:
+#     location /munki_repo_internal/ {
+#         internal;
+#         alias /Users/Shared/munki_repo/;
+#     }
+#FILE_API_SENDFILE = 'X-Accel-Redirect'
+#FILE_API_ACCEL_REDIRECT_PREFIX = '/munki_repo_internal/'
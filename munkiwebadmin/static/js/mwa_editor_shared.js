@@ -96,6 +96,57 @@ function detectUnsavedChanges() {
 
 
 var poll_loop;
+var status_stream;
+var status_modal_timer;
+function monitor_status(stream_url, poll_url) {
+    // show status messages as they are pushed from stream_url (as
+    // Server-Sent Events); fall back to polling poll_url every second if
+    // the browser doesn't support EventSource or the stream fails
+    var poll = function() {
+        poll_loop = setInterval(function() {
+                update_status(poll_url);
+            }, 1000);
+    };
+    if (!window.EventSource) {
+        poll();
+        return;
+    }
+    // like polling, only show the progress modal after a second
+    status_modal_timer = setTimeout(function() {
+            $('#process_progress').modal('show');
+        }, 1000);
+    status_stream = new EventSource(stream_url);
+    status_stream.onmessage = function(event) {
+        var data = JSON.parse(event.data);
+        if (data.statustext) {
+            $('#process_progress_status_text').text(data.statustext);
+        }
+        if (data.exited) {
+            // don't reconnect once the process is done
+            status_stream.close();
+            status_stream = null;
+        }
+    };
+    status_stream.onerror = function(event) {
+        // the browser reconnects by itself unless the stream is closed
+        if (status_stream && status_stream.readyState == EventSource.CLOSED) {
+            status_stream = null;
+            poll();
+        }
+    };
+}
+
+
+function stop_status_monitor() {
+    window.clearInterval(poll_loop);
+    window.clearTimeout(status_modal_timer);
+    if (status_stream) {
+        status_stream.close();
+        status_stream = null;
+    }
+}
+
+
 function update_status(from_url) {
     $('#process_progress').modal('show');
     $.ajax({
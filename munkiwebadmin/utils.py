@@ -3,10 +3,19 @@ munkiwebadmin/utils.py
 
 utilities used by other apps
 """
+import atexit
+import hashlib
 import logging
 import os
-import subprocess
+import re
+import threading
+import time
+from contextlib import contextmanager
 from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, \
+                             parse_etags, quote_etag
+from munkiwebadmin.git_backends import GIT_BACKEND, GitError
 
 APPNAME = settings.APPNAME
 REPO_DIR = settings.MUNKI_REPO_DIR
@@ -14,112 +23,411 @@ REPO_DIR = settings.MUNKI_REPO_DIR
 LOGGER = logging.getLogger('munkiwebadmin')
 
 try:
-    GIT = settings.GIT_PATH
+    GIT_COMMIT_DELAY = settings.GIT_COMMIT_DELAY
 except AttributeError:
-    GIT = None
-
-class MunkiGit(object):
-    """A simple interface for some common interactions with the git binary"""
-    cmd = GIT
-    git_repo_dir = os.getcwd()
-    args = []
-    results = {}
-
-    def run_git(self, custom_args=None):
-        """Executes the git command with the current set of arguments and
-        returns a dictionary with the keys 'output', 'error', and
-        'returncode'. You can optionally pass an array into customArgs to
-        override the self.args value without overwriting them."""
-        custom_args = self.args if custom_args is None else custom_args
-        proc = subprocess.Popen([self.cmd] + custom_args,
-                                shell=False,
-                                bufsize=-1,
-                                cwd=self.git_repo_dir,
-                                stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        (output, error) = proc.communicate()
-        self.results = {"output": output,
-                        "error": error, "returncode": proc.returncode}
-        return self.results
-
-    def path_is_gitignored(self, a_path):
-        """Returns True if path will be ignored by Git (usually due to being
-        in a .gitignore file)"""
-        self.git_repo_dir = os.path.dirname(a_path)
-        self.run_git(['check-ignore', a_path])
-        return self.results['returncode'] == 0
-
-    def path_is_in_git_repo(self, a_path):
-        """Returns True if the path is in a Git repo, false otherwise."""
-        self.git_repo_dir = os.path.dirname(a_path)
-        self.run_git(['status', a_path])
-        return self.results['returncode'] == 0
-
-    def commit_file_at_path(self, a_path, committer):
-        """Commits the file at 'a_path'. This method will also automatically
-        generate the commit log appropriate for the status of a_path where
-        status would be 'modified', 'new file', or 'deleted'"""
-
-        # get the author information
-        author_name = committer.first_name + ' ' + committer.last_name
-        author_name = author_name if author_name != ' ' else committer.username
-        author_email = (committer.email or
-                        "%s@%s" % (committer.username, APPNAME))
-        author_info = '%s <%s>' % (author_name, author_email)
-
-        # get the status of the file at a_path
-        self.git_repo_dir = os.path.dirname(a_path)
-        status_results = self.run_git(['status', a_path])
-        status_output = status_results['output']
-        if status_output.find("new file:") != -1:
-            action = 'created'
-        elif status_output.find("modified:") != -1:
-            action = 'modified'
-        elif status_output.find("deleted:") != -1:
-            action = 'deleted'
+    GIT_COMMIT_DELAY = 2
+
+# the mode open() gives new files. Files created by tempfile.mkstemp (and
+# Django's temporary uploads) are 0600 regardless of the umask, so they are
+# set to this before being moved into the repo
+UMASK = os.umask(0)
+os.umask(UMASK)
+DEFAULT_FILE_MODE = 0666 & ~UMASK
+
+# how LooseVersion splits a version string into components
+VERSION_COMPONENT_RE = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
+VERSION_KEY_CACHE = {}
+VERSION_KEY_CACHE_MAX = 100000
+
+def version_key(version):
+    """Returns a key for sorting version strings the way Munki compares
+    them: like LooseVersion, but with missing components treated as 0 (so
+    '1.0' == '1') and numbers sorting before strings (so mixed components
+    never raise). Keys are memoized"""
+    try:
+        return VERSION_KEY_CACHE[version]
+    except (KeyError, TypeError):
+        pass
+    if isinstance(version, unicode):
+        vstring = version.encode('UTF-8')
+    else:
+        vstring = str(version)
+    key = []
+    for component in VERSION_COMPONENT_RE.split(vstring):
+        if component and component != '.':
+            try:
+                key.append((0, int(component)))
+            except ValueError:
+                key.append((1, component))
+    # padding with zeros doesn't change the comparison; stripping them does
+    # the same without needing to know the other version's length
+    while key and key[-1] == (0, 0):
+        key.pop()
+    key = tuple(key)
+    if len(VERSION_KEY_CACHE) >= VERSION_KEY_CACHE_MAX:
+        VERSION_KEY_CACHE.clear()
+    try:
+        VERSION_KEY_CACHE[version] = key
+    except TypeError:
+        # not hashable
+        pass
+    return key
+
+
+def stat_etag(stat_result, variant=''):
+    """Returns a strong ETag (without quotes) for a file based on its
+    modification time and size. variant distinguishes different
+    representations of the same file"""
+    mtime_ns = getattr(stat_result, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat_result.st_mtime * 1000000000)
+    etag = '%x-%x' % (mtime_ns, stat_result.st_size)
+    if variant:
+        etag += '-' + variant
+    return etag
+
+
+def paths_validators(paths, variant=''):
+    """Returns an (ETag, Last-Modified) tuple for a response built from all
+    the files in paths. The ETag (without quotes) is a hash of their names,
+    modification times and sizes; missing files are included as such, so
+    adding or removing a file changes the ETag. Last-Modified is the newest
+    modification time, or None if none of the files exist. Note that
+    Last-Modified only reflects removals if the containing directories are
+    part of paths"""
+    digest = hashlib.sha1(variant.encode('utf-8'))
+    last_modified = None
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            etag = 'missing'
         else:
-            action = 'did something with'
+            etag = stat_etag(stat_result)
+            last_modified = max(last_modified, stat_result.st_mtime)
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        digest.update('%s\0%s\0' % (path, etag))
+    return digest.hexdigest(), last_modified
 
-        # determine the path relative to REPO_DIR for the file at a_path
-        itempath = a_path
-        if a_path.startswith(REPO_DIR):
-            itempath = a_path[len(REPO_DIR)+1:]
 
-        # generate the log message
-        log_msg = ('%s %s \'%s\' via %s'
-                   % (author_name, action, itempath, APPNAME))
-        LOGGER.info("Doing git commit for %s", itempath)
-        LOGGER.debug(log_msg)
-        self.run_git(['commit', '-m', log_msg, '--author', author_info])
-        if self.results['returncode'] != 0:
-            LOGGER.info("Failed to commit changes to %s", a_path)
-            LOGGER.info(self.results['error'])
-            return -1
-        return 0
-
-    def add_file_at_path(self, a_path, committer):
-        """Commits a file to the Git repo."""
-        if self.path_is_in_git_repo(a_path):
-            if not self.path_is_gitignored(a_path):
-                self.git_repo_dir = os.path.dirname(a_path)
-                self.run_git(['add', a_path])
-                if self.results['returncode'] == 0:
-                    self.commit_file_at_path(a_path, committer)
+def names_etag(names, variant=''):
+    """Returns a strong ETag (without quotes) for a response that depends
+    only on a list of names"""
+    digest = hashlib.sha1(variant.encode('utf-8'))
+    for name in names:
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        digest.update(name + '\0')
+    return digest.hexdigest()
+
+
+def not_modified_response(request, etag, last_modified=None):
+    """Evaluates the If-None-Match and If-Modified-Since headers of a GET
+    request. Returns an HttpResponseNotModified if the client's copy is
+    current, otherwise None. If-None-Match takes precedence"""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if '*' in etags or etag in etags:
+            response = HttpResponseNotModified()
+            set_validators(response, etag, last_modified)
+            return response
+        return None
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since)
+        if since is not None and int(last_modified) <= since:
+            response = HttpResponseNotModified()
+            set_validators(response, etag, last_modified)
+            return response
+    return None
+
+
+def set_validators(response, etag, last_modified=None):
+    """Adds ETag and (if known) Last-Modified headers to response. Unless
+    the response sets its own Cache-Control, browsers are told to keep it
+    private and revalidate it before each use, since the repo can change at
+    any time"""
+    if not response.has_header('Cache-Control'):
+        response['Cache-Control'] = 'private, no-cache'
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+# a single byte range: first-last, first- or -suffix_length
+BYTE_RANGE_RE = re.compile(r'^bytes=\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_byte_range(range_header, size):
+    """Parses the Range header of a request for a file of size bytes.
+    Returns a (first, last) tuple of the (inclusive) byte positions
+    requested, or None if the header is malformed or asks for more than one
+    range, in which case the whole file should be sent. Raises ValueError
+    if the range can't be satisfied"""
+    match = BYTE_RANGE_RE.match(range_header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # the last suffix_length bytes
+        suffix_length = int(last)
+        if not suffix_length or not size:
+            raise ValueError('Range not satisfiable')
+        return max(size - suffix_length, 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError('Range not satisfiable')
+    last = int(last) if last else size - 1
+    return first, min(last, size - 1)
+
+
+def if_range_matches(request, etag, last_modified=None):
+    """Evaluates the If-Range header of a GET request. Returns True if
+    there is none, or if it names the current (strong) ETag or the exact
+    Last-Modified date; otherwise the Range header must be ignored"""
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"'):
+        return if_range == quote_etag(etag)
+    if if_range.startswith('W/'):
+        # weak ETags never match
+        return False
+    since = parse_http_date_safe(if_range)
+    return (since is not None and last_modified is not None and
+            int(last_modified) == since)
+
+
+def git_author(committer):
+    """Returns a tuple of the name and the git author string (name and
+    email) for a Django user"""
+    author_name = committer.first_name + ' ' + committer.last_name
+    author_name = author_name if author_name != ' ' else committer.username
+    author_email = (committer.email or
+                    "%s@%s" % (committer.username, APPNAME))
+    return author_name, '%s <%s>' % (author_name, author_email)
+
+
+class HeldChanges(object):
+    """The changes held back by a GitCommitQueue.hold() block"""
+    def __init__(self, queue):
+        self.queue = queue
+        # list of (path, author name, author info, time queued) tuples
+        self.changes = []
+
+    def wrap(self, function):
+        """Returns a function that calls function with the changes it
+        queues held here too, for functions run in worker threads"""
+        def wrapper(*args, **kwargs):
+            """Calls function within the hold"""
+            with self.queue.holding(self):
+                return function(*args, **kwargs)
+        return wrapper
+
+
+class GitCommitQueue(object):
+    """Collects paths that were created, modified or deleted and commits
+    them to git from a background thread, so requests don't wait on git.
+    Changes queued within `delay` seconds of the first pending change, or
+    within a single hold() block, are committed together: one commit per
+    git repo and author"""
+    def __init__(self, delay=GIT_COMMIT_DELAY):
+        self.delay = delay or 0
+        # list of (path, author name, author info, time queued) tuples
+        self.pending = []
+        self.in_progress = []
+        # number of hold() blocks in progress
+        self.holds = 0
+        self.flush_requested = False
+        # the HeldChanges of the hold() block the thread is in, if any
+        self.local = threading.local()
+        self.condition = threading.Condition()
+        # only one batch is committed at a time
+        self.commit_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.commits = 0
+        self.failures = 0
+
+    def enqueue(self, a_path, committer):
+        """Queues the file at a_path to be committed. Whether it is added or
+        removed is decided by whether it exists at commit time"""
+        author_name, author_info = git_author(committer)
+        change = (a_path, author_name, author_info, time.time())
+        held = getattr(self.local, 'held', None)
+        with self.condition:
+            if held is not None:
+                # committed when the hold ends
+                held.changes.append(change)
+                return
+            self.pending.append(change)
+            self._start_thread()
+            self.condition.notify()
+
+    @contextmanager
+    def holding(self, held):
+        """Context manager that adds the changes the calling thread queues
+        to held"""
+        saved = getattr(self.local, 'held', None)
+        self.local.held = held
+        try:
+            yield
+        finally:
+            self.local.held = saved
+
+    @contextmanager
+    def hold(self):
+        """Context manager that holds back the changes queued by the
+        calling thread until the block exits, so a mass operation results
+        in a single commit. It yields a HeldChanges object, whose wrap()
+        method holds back the changes of functions run in worker threads
+        as well. Changes queued elsewhere are committed as usual. A hold
+        within a hold joins the outer one"""
+        held = getattr(self.local, 'held', None)
+        if held is not None:
+            yield held
+            return
+        held = HeldChanges(self)
+        with self.condition:
+            self.holds += 1
+        try:
+            with self.holding(held):
+                yield held
+        finally:
+            with self.condition:
+                self.holds -= 1
+                if held.changes:
+                    self.pending.extend(held.changes)
+                    # no need to wait out the delay for held changes
+                    self.flush_requested = True
+                    self._start_thread()
+                    self.condition.notify()
+
+    def flush(self):
+        """Commits everything pending in the calling thread"""
+        with self.condition:
+            batch, self.pending = self.pending, []
+            self.flush_requested = False
+        if batch:
+            self._commit_batch(batch)
+
+    def stats(self):
+        """Returns a dictionary with the queue depth and lag: the number of
+        changes not yet committed and the age in seconds of the oldest"""
+        with self.condition:
+            waiting = self.in_progress + self.pending
+            return {'depth': len(waiting),
+                    'lag': (time.time() - waiting[0][3] if waiting else 0.0),
+                    'held': self.holds > 0,
+                    'commits': self.commits,
+                    'failures': self.failures}
+
+    def _start_thread(self):
+        """Starts the background thread if needed. Threads don't survive a
+        fork, so check the pid as well"""
+        if self.thread is None or self.thread_pid != os.getpid():
+            self.thread = threading.Thread(
+                target=self._run, name='GitCommitQueue')
+            self.thread.daemon = True
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def _next_batch(self):
+        """Waits until pending changes are due to be committed and returns
+        them"""
+        with self.condition:
+            while True:
+                if self.pending:
+                    wait = self.pending[0][3] + self.delay - time.time()
+                    if wait <= 0 or self.flush_requested:
+                        break
+                    self.condition.wait(wait)
                 else:
-                    LOGGER.info("Git error: %s", self.results['error'])
-        else:
-            LOGGER.debug("%s is not in a git repo.", a_path)
-
-    def delete_file_at_path(self, a_path, committer):
-        """Deletes a file from the filesystem and Git repo."""
-        if self.path_is_in_git_repo(a_path):
-            if not self.path_is_gitignored(a_path):
-                self.git_repo_dir = os.path.dirname(a_path)
-                self.run_git(['rm', a_path])
-                if self.results['returncode'] == 0:
-                    self.commit_file_at_path(a_path, committer)
+                    self.condition.wait()
+            batch, self.pending = self.pending, []
+            self.in_progress = batch
+            self.flush_requested = False
+            return batch
+
+    def _run(self):
+        """Background thread loop"""
+        while True:
+            batch = self._next_batch()
+            try:
+                self._commit_batch(batch)
+            except Exception, err:
+                LOGGER.error('Git commit queue error: %s', err)
+            with self.condition:
+                self.in_progress = []
+
+    def _commit_batch(self, batch):
+        """Commits a batch of changes, grouped by git repo and author"""
+        groups = {}
+        for (a_path, author_name, author_info, _) in batch:
+            toplevel = GIT_BACKEND.toplevel(os.path.dirname(a_path))
+            if toplevel is None:
+                LOGGER.debug("%s is not in a git repo.", a_path)
+                continue
+            paths = groups.setdefault(
+                (toplevel, author_name, author_info), [])
+            if a_path not in paths:
+                paths.append(a_path)
+        with self.commit_lock:
+            for (toplevel, author_name, author_info), paths in sorted(
+                    groups.items()):
+                try:
+                    self._commit_paths(
+                        toplevel, paths, author_name, author_info)
+                except GitError, err:
+                    LOGGER.info("Failed to commit changes to %s",
+                                ', '.join(paths))
+                    LOGGER.info("Git error: %s", err)
+                    self.failures += 1
                 else:
-                    LOGGER.info("Git error: %s", self.results['error'])
+                    self.commits += 1
+
+    def _commit_paths(self, toplevel, paths, author_name, author_info):
+        """Stages and commits paths in the git repo at toplevel"""
+        ignored = GIT_BACKEND.ignored(toplevel, paths)
+        paths = [a_path for a_path in paths if a_path not in ignored]
+        if not paths:
+            return
+        GIT_BACKEND.stage(toplevel, paths)
+        actions = GIT_BACKEND.staged_changes(toplevel, paths)
+        changes = []
+        for a_path in paths:
+            if a_path in actions:
+                # determine the path relative to REPO_DIR
+                itempath = a_path
+                if a_path.startswith(REPO_DIR):
+                    itempath = a_path[len(REPO_DIR)+1:]
+                changes.append((a_path, actions[a_path], itempath))
+        if not changes:
+            return
+
+        # generate the log message
+        if len(changes) == 1:
+            log_msg = ('%s %s \'%s\' via %s'
+                       % (author_name, changes[0][1], changes[0][2], APPNAME))
+            LOGGER.info("Doing git commit for %s", changes[0][2])
         else:
-            LOGGER.debug("%s is not in a git repo.", a_path)
+            log_msg = ('%s changed %s items via %s\n\n'
+                       % (author_name, len(changes), APPNAME))
+            log_msg += '\n'.join('%s \'%s\'' % (action, itempath)
+                                 for (_, action, itempath) in changes)
+            LOGGER.info("Doing git commit for %s items", len(changes))
+        LOGGER.debug(log_msg)
+        GIT_BACKEND.commit(toplevel, log_msg, author_info,
+                           [a_path for (a_path, _, _) in changes])
+
+GIT_COMMIT_QUEUE = GitCommitQueue()
+# don't lose queued changes when the server shuts down
+atexit.register(GIT_COMMIT_QUEUE.flush)
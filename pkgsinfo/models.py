@@ -6,79 +6,56 @@ from django.db import models
 import os
 import logging
 import plistlib
+import threading
 from collections import defaultdict
-from distutils.version import LooseVersion
-from multiprocessing.pool import ThreadPool
-from xml.parsers.expat import ExpatError
 
 from django.conf import settings
 from process.utils import record_status
-from catalogs.models import Catalog
-from api.models import Plist, MunkiFile, \
-                       FileReadError, FileWriteError, FileDeleteError
+from munkiwebadmin.executor import WRITE_EXECUTOR
+from munkiwebadmin.utils import GIT_COMMIT_QUEUE, version_key
+from api.pkginfo_index import PKGINFO_INDEX
+from api.models import Plist, MunkiFile, FileError, \
+                       FileWriteError, FileDeleteError
 
 
 REPO_DIR = settings.MUNKI_REPO_DIR
 CATALOGS_PATH = os.path.join(REPO_DIR, 'catalogs')
 PKGSINFO_PATH = os.path.join(REPO_DIR, 'pkgsinfo')
 PKGSINFO_PATH_PREFIX_LEN = len(PKGSINFO_PATH) + 1
-PKGSINFO_STATUS_TAG = 'pkgsinfo_list_process'
+PKGSINFO_STATUS_TAG = 'pkgsinfo_process'
 
 LOGGER = logging.getLogger('munkiwebadmin')
 
 
-def pkg_ref_count(pkginfo_path, catalog_items):
-    '''Returns the number of pkginfo items containing a reference to
-    the installer_item_location in pkginfo_path and the relative path to
-    the installer_item_location'''
-    filepath = os.path.join(PKGSINFO_PATH, os.path.normpath(pkginfo_path))
-    try:
-        plistdata = plistlib.readPlist(filepath)
-    except (ExpatError, IOError):
-        return 0, ''
-    pkg_path = plistdata.get('installer_item_location')
-    if not pkg_path:
-        return 0, ''
-    matching_count = 0
-    if catalog_items:
-        matches = [item for item in catalog_items
-                   if item.get('installer_item_location') == pkg_path]
-        matching_count = len(matches)
-    return matching_count, pkg_path
-
-
-def process_file(pkginfo_path):
-    '''Worker function called by our multiprocessing pool. Reads a pkginfo
-    file and returns a tuple of name, version, catalogs, and relative path'''
-    filepath = os.path.join(PKGSINFO_PATH, os.path.normpath(pkginfo_path))
-    try:
-        pkginfo = plistlib.readPlist(filepath)
-    except (ExpatError, IOError):
-        return ()
-    return (pkginfo.get('name', 'NO_NAME'),
-            pkginfo.get('version', 'NO_VERSION'),
-            pkginfo.get('catalogs', []),
-            pkginfo_path)
-
-
-def any_files_in_list_newer_than(files, filepath):
-    '''Returns true if any file in the list of files
-    is newer that filepath'''
-    try:
-        mtime = os.stat(filepath).st_mtime
-    except OSError:
-        return True
-    for fname in files:
-        fullpath = os.path.join(PKGSINFO_PATH, fname)
-        if os.stat(fullpath).st_mtime > mtime:
-            return True
-    return False
-
-
-def record(message=None, percent_done=None):
+def record(message=None, percent_done=None, force=False, exited=False):
     '''Record a status message for a long-running process'''
     record_status(
-        PKGSINFO_STATUS_TAG, message=message, percent_done=percent_done)
+        PKGSINFO_STATUS_TAG, message=message, percent_done=percent_done,
+        force=force, exited=exited)
+
+
+class Progress(object):
+    '''Reports per-item progress of a mass operation, which may update
+    from several threads'''
+    def __init__(self, action, total):
+        self.action = action
+        self.total = total
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def update(self, pathname):
+        '''Records that work on pathname is starting'''
+        with self.lock:
+            self.count += 1
+            count = self.count
+        record(message='%s %s (%s of %s)' % (self.action, pathname,
+                                              count, self.total),
+               percent_done=count * 100 / max(self.total, 1))
+
+    def done(self):
+        '''Records that the operation is complete'''
+        record(message='%s complete' % self.action, percent_done=100,
+               force=True, exited=True)
 
 
 class PkginfoFile(models.Model):
@@ -89,48 +66,32 @@ class PkginfoFile(models.Model):
 class Pkginfo(Plist):
     '''Models pkginfo items'''
     @classmethod
-    def data(cls):
-        '''Returns a structure with itemnames, versions, and filepaths'''
-        def compare_versions(a, b):
-            """Internal comparison function for use in sorting"""
-            return cmp(LooseVersion(b[0]), LooseVersion(a[0]))
+    def validator(cls):
+        '''Brings the pkginfo index up to date and returns a digest of the
+        pkginfo files, usable as an ETag for data()'''
         record(message='Starting scan of pkgsinfo data')
-        files = cls.list('pkgsinfo')
-        record(message='Processing %s files' % len(files))
-        all_catalog = os.path.join(CATALOGS_PATH, 'all')
-        try:
-            all_items = plistlib.readPlist(all_catalog)
-        except (ExpatError, OSError, IOError):
-            all_items = []
-        use_slower_approach = False
-        if len(all_items) != len(files):
-            LOGGER.debug('number of files differ from all catalog')
-            use_slower_approach = True
-        elif any_files_in_list_newer_than(files, all_catalog):
-            LOGGER.debug('files newer than all catalog')
-            use_slower_approach = True
+        # only pkginfo files that changed since the last call are read
+        return PKGINFO_INDEX.validator(
+            status_callback=lambda message: record(message=message))
+
+    @classmethod
+    def data(cls, synced=False):
+        '''Returns a structure with itemnames, versions, and filepaths.
+        Pass synced=True if validator() was just called'''
+        if not synced:
+            record(message='Starting scan of pkgsinfo data')
+        summaries = PKGINFO_INDEX.summaries(
+            status_callback=lambda message: record(message=message),
+            sync=not synced)
+        record(message='Processing %s files' % len(summaries))
         pkginfo_dict = defaultdict(list)
         record(message='Assembling pkgsinfo data')
-        if use_slower_approach:
-            LOGGER.debug("using slower approach")
-            # read the individual pkgsinfo files but use four threads
-            # to speed things up a bit since we wait a lot for I/O
-            pool = ThreadPool(processes=4)
-            tuples = pool.map(process_file, files)
-            for name, version, catalogs, pathname in tuples:
-                pkginfo_dict[name].append((version, catalogs, pathname))
-        else:
-            LOGGER.debug("using faster approach")
-            # use the data in the all catalog; one file read instead
-            # of hundreds or thousands
-            for index, item in enumerate(all_items):
-                name = item.get('name', 'NO_NAME')
-                version = item.get('version', 'NO_VERSION')
-                catalogs = item.get('catalogs', [])
-                pathname = files[index]
-                pkginfo_dict[name].append((version, catalogs, pathname))
+        for pathname, (_, name, version, catalogs) in summaries:
+            pkginfo_dict[name].append((version, catalogs, pathname))
         for key in pkginfo_dict.keys():
-            pkginfo_dict[key].sort(compare_versions)
+            # newest versions first
+            pkginfo_dict[key].sort(
+                key=lambda item: version_key(item[0]), reverse=True)
         LOGGER.debug('Sorted pkgsinfo dict')
 
         # now convert to a list of lists
@@ -138,63 +99,102 @@ class Pkginfo(Plist):
         for key, value in pkginfo_dict.items():
             pkginfo_list.append([key, value])
         LOGGER.debug('Converted to tuple')
-        record(message='Completed assembly of pkgsinfo data')
+        record(message='Completed assembly of pkgsinfo data', force=True,
+               exited=True)
         return pkginfo_list
 
     @classmethod
-    def mass_delete(cls, pathname_list, user, delete_pkgs=False):
+    def mass_delete(cls, pathname_list, user, delete_pkgs=False,
+                    dry_run=False):
         '''Deletes pkginfo files from a list and optionally deletes the
-        associated installer items (pkgs)'''
-        errors = []
-        catalog_items = []
+        associated installer items (pkgs). Files are deleted in parallel and
+        all the deletions are committed together. Returns a dictionary with
+        the lists of pkgsinfo and pkgs deleted (or that would be deleted, if
+        dry_run is True)'''
+        # OK to delete a pkg if there is only one pkginfo file that refers
+        # to it: the one being deleted
+        pkg_referrers = {}
         if delete_pkgs:
-            # cache the catalog_items once; we don't want to incur the
-            # overhead of reading the 'all' catalog multiple times
-            catalog_items = Catalog.detail('all')
-
-        for pathname in pathname_list:
-            delete_this_pkg = False
-            if delete_pkgs:
-                ref_count, pkg_path = pkg_ref_count(pathname, catalog_items)
-                if ref_count == 1:
-                    # OK to delete the pkg if there is only one pkginfo
-                    # file that refers to it
-                    delete_this_pkg = True
+            # one sync for all the lookups
+            PKGINFO_INDEX.sync()
+            for pathname in pathname_list:
+                pkg_path = PKGINFO_INDEX.installer_item_location(
+                    pathname, sync=False)
+                if pkg_path and PKGINFO_INDEX.referrers(
+                        pkg_path, sync=False) == set([pathname]):
+                    pkg_referrers[pkg_path] = pathname
+        if dry_run:
+            return {'pkgsinfo': [pathname for pathname in pathname_list
+                                 if os.path.exists(cls.get_fullpath(
+                                     'pkgsinfo', pathname))],
+                    'pkgs': sorted(pkg_referrers)}
+
+        progress = Progress('Deleting', len(pathname_list))
+
+        def delete_pkginfo(pathname):
+            '''Deletes a single pkginfo file; returns an error or None'''
+            progress.update(pathname)
             try:
                 cls.delete('pkgsinfo', pathname, user)
-            except FileDeleteError, err:
-                errors.append('Error %s when removing %s' % (err, pathname))
-            else:
-                if delete_this_pkg:
-                    try:
-                        MunkiFile.delete('pkgs', pkg_path, user)
-                    except FileDeleteError, err:
-                        errors.append('Error %s when removing %s'
-                                      % (err, pkg_path))
+            except FileError, err:
+                return 'Error %s when removing %s' % (err, pathname)
+            return None
+
+        def delete_pkg(pkg_path):
+            '''Deletes a single pkg; returns an error or None'''
+            try:
+                MunkiFile.delete('pkgs', pkg_path, user)
+            except FileError, err:
+                return 'Error %s when removing %s' % (err, pkg_path)
+            return None
+
+        try:
+            # commit all the deletions together
+            with GIT_COMMIT_QUEUE.hold() as held:
+                errors = WRITE_EXECUTOR.map(
+                    held.wrap(delete_pkginfo), pathname_list)
+                failed = set(pathname for pathname, error
+                             in zip(pathname_list, errors) if error)
+                # keep the pkgs of pkginfo files that weren't deleted
+                pkgs = sorted(pkg_path for pkg_path, pathname
+                              in pkg_referrers.items()
+                              if pathname not in failed)
+                errors.extend(
+                    WRITE_EXECUTOR.map(held.wrap(delete_pkg), pkgs))
+        finally:
+            progress.done()
+        errors = [error for error in errors if error]
         if errors:
             raise FileDeleteError(errors)
+        return {'pkgsinfo': pathname_list, 'pkgs': pkgs}
 
     @classmethod
-    def mass_edit_catalogs(
-            cls, pathname_list, catalogs_to_add, catalogs_to_remove, user):
-        '''For all pkginfo items in the list, add and remove catalogs'''
-
-        errors = []
+    def mass_edit_catalogs(cls, pathname_list, catalogs_to_add,
+                           catalogs_to_remove, user, dry_run=False):
+        '''For all pkginfo items in the list, add and remove catalogs.
+        Items are updated in parallel and all the changes are committed
+        together. Returns a list of the changes made (or that would be made,
+        if dry_run is True): a dictionary for each changed item with its
+        pathname, the catalogs added and removed, and the new catalogs'''
         # normalize the catalog lists -- no duplicates; eliminate
         # any items that are in both lists
         normalized_catalogs_to_add = (
             set(catalogs_to_add) - set(catalogs_to_remove))
         normalized_catalogs_to_remove = (
             set(catalogs_to_remove)- set(catalogs_to_add))
-        catalogs_to_add = list(normalized_catalogs_to_add)
+        catalogs_to_add = sorted(normalized_catalogs_to_add)
         catalogs_to_remove = list(normalized_catalogs_to_remove)
+        progress = Progress(
+            'Checking' if dry_run else 'Updating', len(pathname_list))
 
-        for pathname in pathname_list:
+        def edit_catalogs(pathname):
+            '''Updates the catalogs of a single pkginfo item. Returns a
+            (change, error) tuple; either may be None'''
+            progress.update(pathname)
             try:
                 plist = cls.read('pkgsinfo', pathname)
-            except FileReadError:
-                errors.append('Could not read %s' % pathname)
-                continue
+            except FileError:
+                return None, 'Could not read %s' % pathname
             if not 'catalogs' in plist:
                 plist['catalogs'] = []
             # what will be added?
@@ -203,19 +203,35 @@ class Pkginfo(Plist):
             # what will be removed?
             removed_catalogs = [item for item in catalogs_to_remove
                                 if item in plist['catalogs']]
-            if new_catalogs or removed_catalogs:
-                # add the new ones
-                plist['catalogs'].extend(new_catalogs)
-                # remove catalogs to remove
-                plist['catalogs'] = [item for item in plist['catalogs']
-                                     if item not in catalogs_to_remove]
-                data = plistlib.writePlistToString(plist)
-                try:
-                    cls.write(data, 'pkgsinfo', pathname, user)
-                except FileWriteError, err:
-                    LOGGER.error('Update failed for %s: %s', pathname, err)
-                    errors.append('Error %s when updating %s' % (err, pathname))
-                    continue
+            if not new_catalogs and not removed_catalogs:
+                return None, None
+            # add the new ones
+            plist['catalogs'].extend(new_catalogs)
+            # remove catalogs to remove
+            plist['catalogs'] = [item for item in plist['catalogs']
+                                 if item not in catalogs_to_remove]
+            change = {'pathname': pathname,
+                      'added': new_catalogs,
+                      'removed': removed_catalogs,
+                      'catalogs': plist['catalogs']}
+            if dry_run:
+                return change, None
+            data = plistlib.writePlistToString(plist)
+            try:
+                cls.write(data, 'pkgsinfo', pathname, user, plist=plist)
+            except FileWriteError, err:
+                LOGGER.error('Update failed for %s: %s', pathname, err)
+                return None, 'Error %s when updating %s' % (err, pathname)
+            return change, None
 
+        try:
+            # commit all the edits together
+            with GIT_COMMIT_QUEUE.hold() as held:
+                results = WRITE_EXECUTOR.map(
+                    held.wrap(edit_catalogs), pathname_list)
+        finally:
+            progress.done()
+        errors = [error for _, error in results if error]
         if errors:
             raise FileWriteError(errors)
+        return [change for change, _ in results if change]
@@ -203,10 +203,9 @@ function initPkginfoTable() {
     $('#list_items').dataTable({
         ajax: {
             url: "/pkgsinfo/_json",
-            cache: false,
             dataSrc: "",
             complete: function(jqXHR, textStatus){
-                  window.clearInterval(poll_loop);
+                  stop_status_monitor();
                   $('#process_progress').modal('hide');
                 },
             global: false,
@@ -569,19 +568,78 @@ function rebuildCatalogs() {
     $('#process_progress_title_text').text('Rebuilding catalogs...')
     $('#process_progress_status_text').text('Processing...')
     $('#process_progress').modal('show');
-    poll_loop = setInterval(function() {
-            update_status('/makecatalogs/status');
-        }, 1000);
     $.ajax({
         type: 'POST',
         url: '/makecatalogs/run',
         data: '',
         dataType: 'json',
         global: false,
-        complete: function(jqXHR, textStatus){
-            window.clearInterval(poll_loop);
+        success: function(data) {
+            // makecatalogs runs in the background; wait for our job
+            monitor_makecatalogs(data.job);
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
+            $('#process_progress').modal('hide');
+        },
+    });
+}
+
+
+function makecatalogs_done() {
+    $('#process_progress').modal('hide');
+    $('#list_items').DataTable().ajax.reload();
+}
+
+
+function monitor_makecatalogs(job) {
+    // have the job's status pushed to us if the browser supports
+    // Server-Sent Events; otherwise poll for it
+    if (!window.EventSource) {
+        poll_makecatalogs(job);
+        return;
+    }
+    var source = new EventSource('/makecatalogs/stream?job=' + job);
+    source.onmessage = function(event) {
+        var data = JSON.parse(event.data);
+        if (data.exited) {
+            source.close();
+            makecatalogs_done();
+            return;
+        }
+        if (data.statustext) {
+            $('#process_progress_status_text').text(data.statustext);
+        }
+    };
+    source.onerror = function(event) {
+        // the browser reconnects by itself unless the stream is closed
+        if (source.readyState == EventSource.CLOSED) {
+            poll_makecatalogs(job);
+        }
+    };
+}
+
+
+function poll_makecatalogs(job) {
+    $.ajax({
+        type: 'GET',
+        url: '/makecatalogs/status',
+        data: {'job': job},
+        dataType: 'json',
+        global: false,
+        success: function(data) {
+            if (data.exited) {
+                makecatalogs_done();
+                return;
+            }
+            if (data.statustext) {
+                $('#process_progress_status_text').text(data.statustext);
+            }
+            setTimeout(function() {
+                poll_makecatalogs(job);
+            }, 1000);
+        },
+        error: function(jqXHR, textStatus, errorThrown) {
             $('#process_progress').modal('hide');
-            $('#list_items').DataTable().ajax.reload();
         },
     });
 }
@@ -590,9 +648,8 @@ function rebuildCatalogs() {
 function monitor_pkgsinfo_list() {
     $('#process_progress_title_text').text('Getting pkgsinfo data...')
     $('#process_progress_status_text').text('Processing...')
-    poll_loop = setInterval(function() {
-            update_status('/pkgsinfo/__get_process_status');
-        }, 1000);
+    monitor_status('/pkgsinfo/__process_status_stream',
+                   '/pkgsinfo/__get_process_status');
 }
 
 
@@ -654,7 +711,6 @@ function showDeleteConfirmationModal() {
             type: 'GET',
             url: '/catalogs/get_pkg_ref_count/' + installer_item_path,
             timeout: 10000,
-            cache: false,
             success: function(data) {
                 if (data == 1) {
                     // a single reference! we can enable the checkbox
@@ -683,6 +739,10 @@ function massEditCatalogs() {
     //alert(catalogs_to_add);
     //alert(catalogs_to_delete);
     //return;
+    $('#process_progress_title_text').text('Updating catalogs...')
+    $('#process_progress_status_text').text('Processing...')
+    monitor_status('/pkgsinfo/__process_status_stream',
+                   '/pkgsinfo/__get_process_status');
     $.ajax({
         type: 'POST',
         url: '/pkgsinfo/',
@@ -690,11 +750,14 @@ function massEditCatalogs() {
                               'catalogs_to_add': catalogs_to_add,
                               'catalogs_to_delete': catalogs_to_delete}),
         success: function(data) {
+            stop_status_monitor();
             rebuildCatalogs();
             window.location.hash = '';
             $('#pkginfo_item_detail').html('');
         },
         error: function(jqXHR, textStatus, errorThrown) {
+            stop_status_monitor();
+            $('#process_progress').modal('hide');
             $("#errorModalTitleText").text("Mass edit error");
             try {
                 var json_data = $.parseJSON(jqXHR.responseText)
@@ -717,6 +780,10 @@ function massEditCatalogs() {
 function deletePkginfoList() {
     var pkginfo_list = get_checked_items();
     var deletePkg = $('#mass_delete_pkg').is(':checked');
+    $('#process_progress_title_text').text('Deleting pkginfo items...')
+    $('#process_progress_status_text').text('Processing...')
+    monitor_status('/pkgsinfo/__process_status_stream',
+                   '/pkgsinfo/__get_process_status');
     $.ajax({
         type: 'POST',
         url: '/pkgsinfo/',
@@ -724,11 +791,14 @@ function deletePkginfoList() {
                               'deletePkg': deletePkg}),
         headers: {'X-METHODOVERRIDE': 'DELETE'},
         success: function(data) {
+            stop_status_monitor();
             rebuildCatalogs();
             window.location.hash = '';
             $('#pkginfo_item_detail').html('');
         },
         error: function(jqXHR, textStatus, errorThrown) {
+            stop_status_monitor();
+            $('#process_progress').modal('hide');
             $("#errorModalTitleText").text("Mass delete error");
             try {
                 var json_data = $.parseJSON(jqXHR.responseText)
@@ -1,3 +1,263 @@
-from django.test import TestCase
+import json
+import os
+import threading
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from api.models import FileDeleteError, FileWriteError, Plist
+from api.repo_index import REPO_INDEX
+from munkiwebadmin import executor, utils
+from munkiwebadmin.utils import version_key
+from pkgsinfo.models import PKGSINFO_STATUS_TAG, Pkginfo
+from process import utils as process_utils
+
+
+class VersionKeyTest(SimpleTestCase):
+    '''version_key orders versions the way Munki compares them'''
+    def test_trailing_zeros_are_padding(self):
+        self.assertEqual(version_key('1'), version_key('1.0'))
+        self.assertEqual(version_key('1.0'), version_key('1.0.0'))
+        self.assertEqual(version_key('0'), version_key(''))
+
+    def test_numeric_ordering(self):
+        versions = ['10.0', '1.10', '1.9', '1.0.1', '1', '0.9.9', '2.0']
+        self.assertEqual(
+            sorted(versions, key=version_key),
+            ['0.9.9', '1', '1.0.1', '1.9', '1.10', '2.0', '10.0'])
+
+    def test_inner_zeros_are_kept(self):
+        self.assertLess(version_key('1.0.0.1'), version_key('1.1'))
+        self.assertGreater(version_key('1.0.1'), version_key('1'))
+
+    def test_numbers_sort_before_strings(self):
+        self.assertLess(version_key('1.1'), version_key('1.a'))
+        self.assertLess(version_key('1.0'), version_key('1.0a'))
+        self.assertLess(version_key('1.0b1'), version_key('1.0b2'))
+
+    def test_unicode_and_str_match(self):
+        self.assertEqual(version_key(u'1.2.3'), version_key('1.2.3'))
+        self.assertEqual(version_key(u'1.0\xe9'),
+                         ((0, 1), (0, 0), (1, '\xc3\xa9')))
+
+    def test_non_string_versions(self):
+        self.assertEqual(version_key(5), version_key('5.0'))
+        self.assertEqual(version_key(['1']), version_key("['1']"))
+
+    def test_cache_is_bounded(self):
+        saved_max = utils.VERSION_KEY_CACHE_MAX
+        utils.VERSION_KEY_CACHE_MAX = 2
+        try:
+            utils.VERSION_KEY_CACHE.clear()
+            for version in ('1', '2', '3'):
+                version_key(version)
+            self.assertLessEqual(len(utils.VERSION_KEY_CACHE), 2)
+            self.assertEqual(version_key('3'), ((0, 3),))
+        finally:
+            utils.VERSION_KEY_CACHE_MAX = saved_max
+            utils.VERSION_KEY_CACHE.clear()
+
+
+class RecordingQueue(utils.GitCommitQueue):
+    '''A commit queue that records its batches instead of committing'''
+    def __init__(self, delay):
+        super(RecordingQueue, self).__init__(delay)
+        self.batches = []
+        self.committed = threading.Event()
+
+    def _commit_batch(self, batch):
+        self.batches.append(sorted(change[0] for change in batch))
+        self.committed.set()
+
+
+class GitCommitQueueTest(SimpleTestCase):
+    '''A hold only holds back the changes of its own operation'''
+    def setUp(self):
+        self.queue = RecordingQueue(delay=0)
+        self.user = User(username='editor')
+
+    def test_hold_commits_once(self):
+        with self.queue.hold() as held:
+            self.queue.enqueue('/repo/a', self.user)
+            worker = threading.Thread(target=held.wrap(
+                self.queue.enqueue), args=('/repo/b', self.user))
+            worker.start()
+            worker.join()
+            with self.queue.hold():
+                self.queue.enqueue('/repo/c', self.user)
+            self.assertFalse(self.queue.committed.wait(0.2))
+        self.assertTrue(self.queue.committed.wait(5))
+        self.assertEqual(self.queue.batches,
+                         [['/repo/a', '/repo/b', '/repo/c']])
+
+    def test_other_changes_are_not_held(self):
+        with self.queue.hold():
+            self.queue.enqueue('/repo/held', self.user)
+            other = threading.Thread(target=self.queue.enqueue,
+                                     args=('/repo/other', self.user))
+            other.start()
+            other.join()
+            self.assertTrue(self.queue.committed.wait(5))
+            self.assertEqual(self.queue.batches, [['/repo/other']])
+
+    def test_empty_hold_requests_no_flush(self):
+        with self.queue.hold():
+            pass
+        self.assertFalse(self.queue.flush_requested)
+
+    def test_flush_clears_flush_request(self):
+        self.queue.delay = 60
+        with self.queue.hold():
+            self.queue.enqueue('/repo/a', self.user)
+        self.queue.flush()
+        self.assertFalse(self.queue.flush_requested)
+
+
+class GetjsonStatusTest(TestCase):
+    '''The status stream shown while getjson runs only ends when the
+    pkgsinfo data is ready, even if a plain list request rescans pkgsinfo
+    meanwhile'''
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        self.statuses = []
+        self.saved = (process_utils.publish_status,
+                      process_utils.STREAM_POLL_INTERVAL)
+
+        def recording_publish_status(processname, status):
+            '''Records the statuses of the pkgsinfo stream'''
+            if processname == PKGSINFO_STATUS_TAG:
+                self.statuses.append(status)
+            self.saved[0](processname, status)
+        process_utils.publish_status = recording_publish_status
+        process_utils.STREAM_POLL_INTERVAL = 0
+
+    def tearDown(self):
+        (process_utils.publish_status,
+         process_utils.STREAM_POLL_INTERVAL) = self.saved
+
+    def test_stream_ends_when_data_is_ready(self):
+        # make the list request rescan pkgsinfo
+        REPO_INDEX.invalidate('pkgsinfo', 'status-test/item')
+        response = self.client.get('/api/pkgsinfo?api_fields=filename')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/pkgsinfo/_json')
+        self.assertEqual(response.status_code, 200)
+
+        # replay the statuses to a stream, one per poll
+        statuses = list(self.statuses)
+
+        def status_function():
+            '''Returns the next status'''
+            if len(statuses) > 1:
+                return statuses.pop(0)
+            return statuses[0]
+        events = [json.loads(event[len('data: '):])
+                  for event in process_utils.status_events(status_function)
+                  if event.startswith('data: ')]
+        self.assertTrue(events)
+        self.assertEqual(events[-1]['statustext'],
+                         'Completed assembly of pkgsinfo data')
+        self.assertEqual([event['exited'] for event in events],
+                         [False] * (len(events) - 1) + [True])
+
+
+class MassOperationTest(TestCase):
+    '''Mass deletes and catalog edits report what they did (or would do),
+    and go on past the items that fail'''
+    def setUp(self):
+        # the in-memory test database isn't shared with pool threads
+        self.saved_workers = executor.WRITE_EXECUTOR.workers
+        executor.WRITE_EXECUTOR.workers = 1
+        self.pkgsinfo = ['masstest/one', 'masstest/two', 'masstest/three']
+        # two and three share a pkg
+        for pathname, location in zip(
+                self.pkgsinfo, ['masstest/one.dmg', 'masstest/shared.dmg',
+                                'masstest/shared.dmg']):
+            Plist.new('pkgsinfo', pathname, None, plist_data={
+                'name': os.path.basename(pathname), 'version': '1.0',
+                'catalogs': ['testing'],
+                'installer_item_location': location})
+        os.makedirs(Plist.get_fullpath('pkgs', 'masstest'))
+        for pkg_path in ['masstest/one.dmg', 'masstest/shared.dmg']:
+            with open(Plist.get_fullpath('pkgs', pkg_path), 'w') as fileref:
+                fileref.write('pkg')
+            REPO_INDEX.invalidate('pkgs', pkg_path)
+
+    def tearDown(self):
+        executor.WRITE_EXECUTOR.workers = self.saved_workers
+        for pathname in self.pkgsinfo:
+            if os.path.exists(Plist.get_fullpath('pkgsinfo', pathname)):
+                Plist.delete('pkgsinfo', pathname, None)
+        for pkg_path in ['masstest/one.dmg', 'masstest/shared.dmg']:
+            if os.path.exists(Plist.get_fullpath('pkgs', pkg_path)):
+                os.unlink(Plist.get_fullpath('pkgs', pkg_path))
+                REPO_INDEX.invalidate('pkgs', pkg_path)
+        for kind in ['pkgs', 'pkgsinfo']:
+            os.rmdir(Plist.get_fullpath(kind, 'masstest'))
+            REPO_INDEX.invalidate(kind, 'masstest')
+
+    def exists(self, kind, pathname):
+        return os.path.exists(Plist.get_fullpath(kind, pathname))
+
+    def test_delete_dry_run(self):
+        result = Pkginfo.mass_delete(
+            self.pkgsinfo[:2], None, delete_pkgs=True, dry_run=True)
+        # shared.dmg is still used by three
+        self.assertEqual(result, {'pkgsinfo': self.pkgsinfo[:2],
+                                  'pkgs': ['masstest/one.dmg']})
+        self.assertTrue(all(self.exists('pkgsinfo', pathname)
+                            for pathname in self.pkgsinfo))
+
+    def test_delete(self):
+        result = Pkginfo.mass_delete(self.pkgsinfo, None, delete_pkgs=True)
+        self.assertEqual(result, {'pkgsinfo': self.pkgsinfo,
+                                  'pkgs': ['masstest/one.dmg']})
+        self.assertFalse(any(self.exists('pkgsinfo', pathname)
+                             for pathname in self.pkgsinfo))
+        self.assertFalse(self.exists('pkgs', 'masstest/one.dmg'))
+        # like before, a pkg referred to by more than one pkginfo file is
+        # kept, even if all of them are deleted
+        self.assertTrue(self.exists('pkgs', 'masstest/shared.dmg'))
+
+    def test_delete_partial_failure(self):
+        with self.assertRaises(FileDeleteError) as context:
+            Pkginfo.mass_delete(['masstest/missing', 'masstest/one'], None,
+                                delete_pkgs=True)
+        errors = context.exception.args[0]
+        self.assertEqual(len(errors), 1)
+        self.assertIn('masstest/missing', errors[0])
+        self.assertFalse(self.exists('pkgsinfo', 'masstest/one'))
+        self.assertFalse(self.exists('pkgs', 'masstest/one.dmg'))
+
+    def test_edit_catalogs_dry_run(self):
+        changes = Pkginfo.mass_edit_catalogs(
+            self.pkgsinfo[:2], ['production'], ['testing'], None,
+            dry_run=True)
+        self.assertEqual(changes, [
+            {'pathname': pathname, 'added': ['production'],
+             'removed': ['testing'], 'catalogs': ['production']}
+            for pathname in self.pkgsinfo[:2]])
+        self.assertEqual(Plist.read('pkgsinfo', 'masstest/one')['catalogs'],
+                         ['testing'])
+
+    def test_edit_catalogs(self):
+        changes = Pkginfo.mass_edit_catalogs(
+            self.pkgsinfo, ['testing', 'production'], [], None)
+        self.assertEqual(changes, [
+            {'pathname': pathname, 'added': ['production'], 'removed': [],
+             'catalogs': ['testing', 'production']}
+            for pathname in self.pkgsinfo])
+        for pathname in self.pkgsinfo:
+            self.assertEqual(Plist.read('pkgsinfo', pathname)['catalogs'],
+                             ['testing', 'production'])
+
+    def test_edit_catalogs_partial_failure(self):
+        with self.assertRaises(FileWriteError) as context:
+            Pkginfo.mass_edit_catalogs(
+                ['masstest/missing', 'masstest/one'], ['production'], [],
+                None)
+        self.assertEqual(context.exception.args[0],
+                         ['Could not read masstest/missing'])
+        self.assertEqual(Plist.read('pkgsinfo', 'masstest/one')['catalogs'],
+                         ['testing', 'production'])
@@ -4,6 +4,7 @@ import pkgsinfo.views
 urlpatterns = [
     url(r'^$', pkgsinfo.views.index),
     url(r'^__get_process_status$', pkgsinfo.views.status),
+    url(r'^__process_status_stream$', pkgsinfo.views.status_stream),
     url(r'^_json$', pkgsinfo.views.getjson),
     url(r'^(?P<pkginfo_path>^.*$)', pkgsinfo.views.detail)
 ]
\ No newline at end of file
@@ -8,9 +8,10 @@ from django.contrib.auth.decorators import login_required
 from django.conf import settings
 
 from pkgsinfo.models import Pkginfo, PKGSINFO_STATUS_TAG
-from process.models import Process
+from process.utils import get_status, status_stream_response
 from api.models import Plist, \
                        FileError, FileDoesNotExistError
+from munkiwebadmin.utils import not_modified_response, set_validators
 
 import json
 import logging
@@ -46,30 +47,42 @@ def get_icon_url(pkginfo_plist):
 def status(request):
     '''Get and return a status message for the process generating
     the pkgsinfo list'''
-    LOGGER.debug('got status request for pkgsinfo_list_process')
+    LOGGER.debug('got status request for pkgsinfo_process')
     status_response = {}
-    processes = Process.objects.filter(name=PKGSINFO_STATUS_TAG)
-    if processes:
-        # display status from one of the active processes
-        # (hopefully there is only one!)
-        process = processes[0]
-        status_response['statustext'] = process.statustext
+    process_status = get_status(PKGSINFO_STATUS_TAG)
+    if process_status:
+        status_response['statustext'] = process_status['statustext']
     else:
         status_response['statustext'] = 'Processing'
     return HttpResponse(json.dumps(status_response),
                         content_type='application/json')
 
 
+def status_stream(request):
+    '''Streams status messages for the process generating the pkgsinfo
+    list as Server-Sent Events'''
+    LOGGER.debug('got status stream request for pkgsinfo_process')
+    return status_stream_response(
+        lambda: get_status(PKGSINFO_STATUS_TAG), wait_for_change=True)
+
+
 @login_required
 def getjson(request):
     '''Return pkgsinfo as json data -- used by the DataTable that
     displays the list of pkginfo items. Perhaps could be moved into the
     index methods'''
     LOGGER.debug("Got json request for pkgsinfo")
-    pkginfo_list = Pkginfo.data()
+    # the data is built from the pkginfo index, so the ETag comes from the
+    # same sync of the index
+    etag = Pkginfo.validator()
+    not_modified = not_modified_response(request, etag)
+    if not_modified:
+        return not_modified
+    pkginfo_list = Pkginfo.data(synced=True)
     # send it back in JSON format
-    return HttpResponse(json.dumps(pkginfo_list),
-                        content_type='application/json')
+    response = HttpResponse(json.dumps(pkginfo_list),
+                            content_type='application/json')
+    return set_validators(response, etag)
 
 
 @login_required
@@ -96,10 +109,12 @@ def index(request):
                         content_type='application/json', status=403)
                 json_data = json.loads(request.body)
                 pkginfo_list = json_data.get('pkginfo_list', [])
+                dry_run = json_data.get('dry_run', False)
                 try:
-                    Pkginfo.mass_delete(
+                    deleted = Pkginfo.mass_delete(
                         pkginfo_list, request.user,
-                        delete_pkgs=json_data.get('deletePkg', False)
+                        delete_pkgs=json_data.get('deletePkg', False),
+                        dry_run=dry_run
                     )
                 except FileError, err:
                     return HttpResponse(
@@ -109,7 +124,9 @@ def index(request):
                         content_type='application/json', status=403)
                 else:
                     return HttpResponse(
-                        json.dumps({'result': 'success'}),
+                        json.dumps({'result': 'success',
+                                    'dry_run': dry_run,
+                                    'deleted': deleted}),
                         content_type='application/json')
         # regular POST (update/change)
         LOGGER.info("Got mass update request for pkginfos")
@@ -126,10 +143,11 @@ def index(request):
         LOGGER.debug('Adding catalogs: %s', catalogs_to_add)
         catalogs_to_delete = json_data.get('catalogs_to_delete', [])
         LOGGER.debug('Removing catalogs: %s', catalogs_to_delete)
+        dry_run = json_data.get('dry_run', False)
         try:
-            Pkginfo.mass_edit_catalogs(
+            changes = Pkginfo.mass_edit_catalogs(
                 pkginfo_list, catalogs_to_add, catalogs_to_delete,
-                request.user)
+                request.user, dry_run=dry_run)
         except FileError, err:
             return HttpResponse(
                 json.dumps({'result': 'failed',
@@ -138,7 +156,9 @@ def index(request):
                 content_type='application/json', status=403)
         else:
             return HttpResponse(
-                json.dumps({'result': 'success'}),
+                json.dumps({'result': 'success',
+                            'dry_run': dry_run,
+                            'changes': changes}),
                 content_type='application/json')
 
 
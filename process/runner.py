@@ -0,0 +1,252 @@
+"""
+process/runner.py
+
+Runs makecatalogs (or the built-in catalog builder) in a background thread
+so requests don't have to wait for it
+"""
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from catalogs.builder import CATALOG_BUILDER
+from process.models import Process
+from process.utils import cache_status, cached_status
+
+REPO_DIR = settings.MUNKI_REPO_DIR
+
+try:
+    MAKECATALOGS = settings.MAKECATALOGS_PATH
+except AttributeError:
+    MAKECATALOGS = None
+
+# build catalogs in-process instead of running the makecatalogs binary
+try:
+    USE_NATIVE_MAKECATALOGS = settings.USE_NATIVE_MAKECATALOGS
+except AttributeError:
+    USE_NATIVE_MAKECATALOGS = False
+
+LOGGER = logging.getLogger('munkiwebadmin')
+
+# minimum number of seconds between saves of a job's status text
+STATUS_INTERVAL = 0.5
+
+JOB_STATUS_TAG = 'makecatalogs_job_%s'
+
+
+def pid_exists(pid):
+    """Check whether pid exists in the current process table."""
+    # http://stackoverflow.com/questions/568271/how-to-check-if-there-exists-a-process-with-a-given-pid
+    if os.name == 'posix':
+        # OS X and Linux
+        import errno
+        if pid < 0:
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        else:
+            return True
+    else:
+        # Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        HANDLE = ctypes.c_void_p
+        DWORD = ctypes.c_ulong
+        LPDWORD = ctypes.POINTER(DWORD)
+        class ExitCodeProcess(ctypes.Structure):
+            _fields_ = [('hProcess', HANDLE),
+                        ('lpExitCode', LPDWORD)]
+
+        SYNCHRONIZE = 0x100000
+        process = kernel32.OpenProcess(SYNCHRONIZE, 0, pid)
+        if not process:
+            return False
+
+        ec = ExitCodeProcess()
+        out = kernel32.GetExitCodeProcess(process, ctypes.byref(ec))
+        if not out:
+            err = kernel32.GetLastError()
+            if kernel32.GetLastError() == 5:
+                # Access is denied.
+                logging.warning("Access is denied to get pid info.")
+            kernel32.CloseHandle(process)
+            return False
+        elif bool(ec.lpExitCode):
+            # print ec.lpExitCode.contents
+            # There is an exist code, it quit
+            kernel32.CloseHandle(process)
+            return False
+        # No exit code, it's running.
+        kernel32.CloseHandle(process)
+        return True
+
+
+def update_job(job, statustext, exited=False, exitcode=0, **fields):
+    '''Updates the Process record of a makecatalogs job and caches its
+    status, so status requests don't have to query the database when the
+    status cache is shared'''
+    statustext = statustext[:256]
+    Process.objects.filter(pk=job).update(
+        statustext=statustext, exited=exited, exitcode=exitcode, **fields)
+    cache_status(JOB_STATUS_TAG % job, {'statustext': statustext,
+                                        'exited': exited,
+                                        'exitcode': exitcode})
+
+
+def job_status(job):
+    '''Returns the status of a makecatalogs job as a dictionary with
+    statustext, exited and exitcode keys, or None if there is no such job.
+    The status is read from the Process record if it isn't in a shared
+    status cache'''
+    status = cached_status(JOB_STATUS_TAG % job)
+    if status is None:
+        processes = Process.objects.filter(name='makecatalogs', pk=job)
+        if processes:
+            status = {'statustext': processes[0].statustext,
+                      'exited': processes[0].exited,
+                      'exitcode': processes[0].exitcode}
+    return status
+
+
+class MakecatalogsRunner(object):
+    '''Runs makecatalogs jobs one at a time in a background thread. A job
+    requested while another is waiting to run is merged into the waiting
+    one, so any number of requests made during a run result in a single
+    follow-up run'''
+    def __init__(self):
+        self.condition = threading.Condition()
+        # id of the job waiting to run
+        self.waiting = None
+        self.thread = None
+        self.thread_pid = None
+
+    def request(self):
+        '''Queues a run (unless one is already waiting) and returns its job
+        id: the primary key of its Process record'''
+        with self.condition:
+            if self.waiting is None:
+                # remove records for exited processes
+                Process.objects.filter(
+                    name='makecatalogs', exited=True).delete()
+                record = Process(name='makecatalogs', statustext='Queued')
+                record.save()
+                cache_status(JOB_STATUS_TAG % record.pk,
+                             {'statustext': 'Queued',
+                              'exited': False,
+                              'exitcode': 0})
+                self.waiting = record.pk
+            self._start_thread()
+            self.condition.notify()
+            return self.waiting
+
+    def _start_thread(self):
+        '''Starts the background thread if needed. Threads don't survive a
+        fork, so check the pid as well'''
+        if self.thread is None or self.thread_pid != os.getpid():
+            self.thread = threading.Thread(
+                target=self._run, name='MakecatalogsRunner')
+            self.thread.daemon = True
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def _run(self):
+        '''Background thread loop'''
+        while True:
+            with self.condition:
+                while self.waiting is None:
+                    self.condition.wait()
+                job = self.waiting
+                self.waiting = None
+            try:
+                self._run_job(job)
+            except Exception, err:
+                LOGGER.error('makecatalogs job %s failed: %s', job, err)
+                update_job(job, 'Error: %s' % err, exited=True, exitcode=-1)
+            finally:
+                # don't hold a database connection while idle
+                connection.close()
+
+    def _wait_for_other_processes(self, job):
+        '''Waits until makecatalogs runs started by other server processes
+        have finished'''
+        while True:
+            # jobs that haven't started yet have no pid
+            processes = Process.objects.filter(
+                name='makecatalogs', exited=False).exclude(
+                    pid=0).exclude(pk=job)
+            # clean up any processes no longer in the process table
+            running = False
+            for process in processes:
+                if pid_exists(process.pid):
+                    running = True
+                else:
+                    process.delete()
+            if not running:
+                return
+            time.sleep(1)
+
+    def _run_native_job(self, job):
+        '''Builds the catalogs in-process, recording progress as the job's
+        status'''
+        update_job(job, 'Running', pid=os.getpid())
+        status = {'last_save': 0}
+
+        def record(message):
+            '''Saves a progress message, at most every STATUS_INTERVAL'''
+            if time.time() - status['last_save'] >= STATUS_INTERVAL:
+                update_job(job, message)
+                status['last_save'] = time.time()
+
+        errors = CATALOG_BUILDER.build(status_callback=record)
+        # makecatalogs exits with -1 if there were errors or warnings
+        update_job(job, 'Done', exited=True, exitcode=-1 if errors else 0)
+
+    def _run_job(self, job):
+        '''Runs makecatalogs, recording its output as the job's status'''
+        self._wait_for_other_processes(job)
+        if USE_NATIVE_MAKECATALOGS:
+            self._run_native_job(job)
+            return
+        if not MAKECATALOGS:
+            LOGGER.error('MAKECATALOGS_PATH is not set')
+            update_job(job, 'Error: MAKECATALOGS_PATH is not set',
+                       exited=True, exitcode=-1)
+            return
+        try:
+            proc = subprocess.Popen([MAKECATALOGS, REPO_DIR],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError, err:
+            LOGGER.error('Could not run %s: %s', MAKECATALOGS, err)
+            update_job(job, 'Error: %s' % err, exited=True, exitcode=-1)
+            return
+        update_job(job, 'Running', pid=proc.pid)
+        last_save = 0
+        output = ''
+        for line in iter(proc.stdout.readline, ''):
+            output = line.decode('utf-8').rstrip('\n')
+            if output and time.time() - last_save >= STATUS_INTERVAL:
+                update_job(job, output)
+                last_save = time.time()
+        proc.wait()
+        if proc.returncode:
+            LOGGER.error('makecatalogs exited with code %s: %s',
+                         proc.returncode, output)
+        update_job(job, 'Done', exited=True, exitcode=proc.returncode)
+
+
+MAKECATALOGS_RUNNER = MakecatalogsRunner()
+
+
+def pkginfo_changed():
+    '''Queues an incremental catalog rebuild after a pkginfo file was
+    written or deleted, if the built-in catalog builder is used. Changes
+    made while a rebuild is waiting to run are merged into it'''
+    if USE_NATIVE_MAKECATALOGS:
+        MAKECATALOGS_RUNNER.request()
@@ -1,3 +1,94 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase
+
+from process import utils
+from process.models import Process
+
+
+class RecordStatusTest(TestCase):
+    '''Status updates are rate limited, and kept in the database when the
+    status cache is local to each process'''
+    def setUp(self):
+        utils._LAST_UPDATES.clear()
+        self.saved_interval = utils.STATUS_UPDATE_INTERVAL
+        utils.STATUS_UPDATE_INTERVAL = 60
+
+    def tearDown(self):
+        utils.STATUS_UPDATE_INTERVAL = self.saved_interval
+        utils._LAST_UPDATES.clear()
+
+    def test_locmem_cache_is_not_shared(self):
+        self.assertIsNone(utils.shared_status_cache())
+        self.assertFalse(utils.cache_status('test', {'statustext': 'x'}))
+
+    def test_status_is_kept_in_database(self):
+        utils.record_status('test', message='Starting', percent_done=5)
+        self.assertEqual(utils.get_status('test'),
+                         {'statustext': 'Starting', 'percentdone': 5,
+                          'exited': False})
+        self.assertEqual(Process.objects.filter(name='test').count(), 1)
+
+    def test_updates_are_rate_limited(self):
+        utils.record_status('test', message='one')
+        utils.record_status('test', message='two')
+        self.assertEqual(utils.get_status('test')['statustext'], 'one')
+
+    def test_forced_update_is_stored(self):
+        utils.record_status('test', message='one')
+        utils.record_status('test', percent_done=50)
+        utils.record_status('test', message='done', force=True,
+                            exited=True)
+        self.assertEqual(utils.get_status('test'),
+                         {'statustext': 'done', 'percentdone': 50,
+                          'exited': True})
+
+    def test_new_run_resets_exited(self):
+        utils.record_status('test', message='done', exited=True)
+        utils.record_status('test', message='again', force=True)
+        self.assertFalse(utils.get_status('test')['exited'])
+
+
+class StatusEventsTest(SimpleTestCase):
+    '''Status streams end when the process exits or goes idle'''
+    def setUp(self):
+        self.saved = (utils.STREAM_POLL_INTERVAL, utils.STREAM_IDLE_TIMEOUT)
+        utils.STREAM_POLL_INTERVAL = 0
+
+    def tearDown(self):
+        utils.STREAM_POLL_INTERVAL, utils.STREAM_IDLE_TIMEOUT = self.saved
+
+    def events(self, statuses, wait_for_change=False):
+        '''Returns the statuses sent for a sequence of statuses; the last
+        one repeats'''
+        statuses = list(statuses)
+
+        def status_function():
+            '''Returns the next status'''
+            if len(statuses) > 1:
+                return statuses.pop(0)
+            return statuses[0]
+
+        return [json.loads(event[len('data: '):])
+                for event in utils.status_events(
+                    status_function, wait_for_change)
+                if event.startswith('data: ')]
+
+    def test_ends_when_exited(self):
+        statuses = [{'statustext': 'one'}, {'statustext': 'one'},
+                    {'statustext': 'two', 'exited': True}]
+        self.assertEqual(self.events(statuses),
+                         [{'statustext': 'one'},
+                          {'statustext': 'two', 'exited': True}])
+
+    def test_skips_status_of_earlier_run(self):
+        statuses = [{'statustext': 'old', 'exited': True},
+                    {'statustext': 'new', 'exited': True}]
+        self.assertEqual(self.events(statuses, wait_for_change=True),
+                         [{'statustext': 'new', 'exited': True}])
+
+    def test_ends_when_idle(self):
+        utils.STREAM_IDLE_TIMEOUT = 0.05
+        self.assertEqual(self.events([None]), [])
+        self.assertEqual(self.events([{'statustext': 'stuck'}]),
+                         [{'statustext': 'stuck'}])
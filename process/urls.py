@@ -5,5 +5,6 @@ urlpatterns = [
     url(r'^$', process.views.index),
     url(r'^run$', process.views.run),
     url(r'^status$', process.views.status),
+    url(r'^stream$', process.views.stream),
     url(r'^delete$', process.views.delete)
 ]
\ No newline at end of file
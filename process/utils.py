@@ -1,15 +1,159 @@
 ''' process/utils.py '''
-from models import Process
+import json
+import threading
+import time
 
-def record_status(processname, message=None, percent_done=None):
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import StreamingHttpResponse
+
+from process.models import Process
+
+# status messages are kept in this cache (see CACHES in settings.py) if it
+# is shared between processes. Local-memory (the default) and dummy caches
+# are not, so then status messages are kept in the database
+try:
+    STATUS_CACHE = settings.PROCESS_STATUS_CACHE
+except AttributeError:
+    STATUS_CACHE = 'default'
+
+# minimum time (in seconds) between stored updates for the same process
+try:
+    STATUS_UPDATE_INTERVAL = settings.PROCESS_STATUS_UPDATE_INTERVAL
+except AttributeError:
+    STATUS_UPDATE_INTERVAL = 0.2
+
+# status of processes that stop reporting expires after this many seconds
+STATUS_TIMEOUT = 300
+
+STATUS_KEY = 'munkiwebadmin.process_status.%s'
+
+# how often (in seconds) status streams check for changes
+STREAM_POLL_INTERVAL = 0.5
+# each open stream holds a server worker, so streams end after this many
+# seconds, or once the status hasn't changed for STREAM_IDLE_TIMEOUT
+# seconds; browsers reconnect automatically
+STREAM_DURATION = 30
+STREAM_IDLE_TIMEOUT = 10
+
+_LOCK = threading.Lock()
+# processname -> (time of last stored update, last status dictionary,
+#                 whether that status has been stored)
+_LAST_UPDATES = {}
+
+
+def record_status(processname, message=None, percent_done=None,
+                  force=False, exited=False):
     '''Record process feedback so we can display it during long-running
-    operations'''
-    try:
-        proc_rec = Process.objects.get(name=processname)
-    except Process.DoesNotExist:
-        proc_rec = Process(name=processname)
-    if message:
-        proc_rec.statustext = message
-    if percent_done:
-        proc_rec.percentdone = percent_done
-    proc_rec.save()
+    operations. The final update of an operation should set exited, which
+    ends status streams. Unless force is True, updates for the same process
+    are stored at most once every STATUS_UPDATE_INTERVAL seconds; the
+    others are held back until the next stored update, so the final update
+    should use force=True as well'''
+    now = time.time()
+    with _LOCK:
+        last_update, status, _ = _LAST_UPDATES.get(
+            processname, (0, {'statustext': '', 'percentdone': 0}, True))
+        status = dict(status, exited=exited)
+        if message:
+            status['statustext'] = message
+        if percent_done:
+            status['percentdone'] = percent_done
+        if not force and now - last_update < STATUS_UPDATE_INTERVAL:
+            _LAST_UPDATES[processname] = (last_update, status, False)
+            return
+        _LAST_UPDATES[processname] = (now, status, True)
+    publish_status(processname, status)
+
+
+def shared_status_cache():
+    '''Returns the status cache, or None if it isn't shared between
+    processes'''
+    cache = caches[STATUS_CACHE]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def cache_status(processname, status):
+    '''Stores a status dictionary for a process in the status cache if it
+    is shared. Returns True if it was stored'''
+    cache = shared_status_cache()
+    if cache is None:
+        return False
+    cache.set(STATUS_KEY % processname, status, STATUS_TIMEOUT)
+    return True
+
+
+def cached_status(processname):
+    '''Returns the status dictionary stored by cache_status, or None'''
+    cache = shared_status_cache()
+    if cache is None:
+        return None
+    return cache.get(STATUS_KEY % processname)
+
+
+def publish_status(processname, status):
+    '''Stores a status dictionary for a process: in the status cache if it
+    is shared, otherwise in the Process record named processname'''
+    if cache_status(processname, status):
+        return
+    fields = {'statustext': status.get('statustext', '')[:256],
+              'percentdone': status.get('percentdone') or 0,
+              'exited': status.get('exited', False)}
+    if not Process.objects.filter(name=processname).update(**fields):
+        Process.objects.create(name=processname, **fields)
+
+
+def get_status(processname):
+    '''Returns the last recorded status of a process as a dictionary with
+    statustext, percentdone and exited keys, or None'''
+    if shared_status_cache() is not None:
+        return cached_status(processname)
+    processes = Process.objects.filter(name=processname)
+    if not processes:
+        return None
+    return {'statustext': processes[0].statustext,
+            'percentdone': processes[0].percentdone,
+            'exited': processes[0].exited}
+
+
+def status_events(status_function, wait_for_change=False):
+    '''Generator of Server-Sent Events. Calls status_function every
+    STREAM_POLL_INTERVAL seconds and sends the status dictionary it returns
+    (as JSON) whenever it changes. Ends once the status says the process
+    has exited, once it hasn't changed for STREAM_IDLE_TIMEOUT seconds, or
+    after STREAM_DURATION seconds. If wait_for_change is True, the status
+    at the start is left over from an earlier run of the process, so it is
+    not sent'''
+    # ask the browser to reconnect after a second when the stream ends
+    yield 'retry: 1000\n\n'
+    last_status = status_function() if wait_for_change else None
+    started = last_change = time.time()
+    while True:
+        now = time.time()
+        if (now - started >= STREAM_DURATION
+                or now - last_change >= STREAM_IDLE_TIMEOUT):
+            return
+        status = status_function()
+        if status is not None and status != last_status:
+            yield 'data: %s\n\n' % json.dumps(status)
+            if status.get('exited'):
+                return
+            last_status = status
+            last_change = now
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
+def status_stream_response(status_function, wait_for_change=False):
+    '''Returns a streaming text/event-stream response; see
+    status_events'''
+    response = StreamingHttpResponse(
+        status_events(status_function, wait_for_change),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # don't let nginx buffer the events
+    response['X-Accel-Buffering'] = 'no'
+    return response
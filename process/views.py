@@ -4,115 +4,27 @@ process/views.py
 
 from django.http import HttpResponse
 from process.models import Process
+from process.runner import MAKECATALOGS_RUNNER, job_status
+from process.utils import status_stream_response
 
 import json
 import logging
-import os
-import subprocess
-import time
-
-from django.conf import settings
-
-REPO_DIR = settings.MUNKI_REPO_DIR
-MAKECATALOGS = settings.MAKECATALOGS_PATH
 
 LOGGER = logging.getLogger('munkiwebadmin')
 
 
-def pid_exists(pid):
-    """Check whether pid exists in the current process table."""
-    # http://stackoverflow.com/questions/568271/how-to-check-if-there-exists-a-process-with-a-given-pid
-    if os.name == 'posix':
-        # OS X and Linux
-        import errno
-        if pid < 0:
-            return False
-        try:
-            os.kill(pid, 0)
-        except OSError as e:
-            return e.errno == errno.EPERM
-        else:
-            return True
-    else:
-        # Windows
-        import ctypes
-        kernel32 = ctypes.windll.kernel32
-        HANDLE = ctypes.c_void_p
-        DWORD = ctypes.c_ulong
-        LPDWORD = ctypes.POINTER(DWORD)
-        class ExitCodeProcess(ctypes.Structure):
-            _fields_ = [('hProcess', HANDLE),
-                        ('lpExitCode', LPDWORD)]
-
-        SYNCHRONIZE = 0x100000
-        process = kernel32.OpenProcess(SYNCHRONIZE, 0, pid)
-        if not process:
-            return False
-
-        ec = ExitCodeProcess()
-        out = kernel32.GetExitCodeProcess(process, ctypes.byref(ec))
-        if not out:
-            err = kernel32.GetLastError()
-            if kernel32.GetLastError() == 5:
-                # Access is denied.
-                logging.warning("Access is denied to get pid info.")
-            kernel32.CloseHandle(process)
-            return False
-        elif bool(ec.lpExitCode):
-            # print ec.lpExitCode.contents
-            # There is an exist code, it quit
-            kernel32.CloseHandle(process)
-            return False
-        # No exit code, it's running.
-        kernel32.CloseHandle(process)
-        return True
-
 def index(request):
     '''Not implemented'''
     return HttpResponse(json.dumps('view not implemented'),
                         content_type='application/json')
 
 def run(request):
-    '''Start running our lengthy process'''
+    '''Queue a makecatalogs run and return its job id'''
     if request.method == 'POST':
         LOGGER.debug('got run request for makecatalogs')
-        # remove records for exited processes
-        Process.objects.filter(name='makecatalogs', exited=True).delete()
-        while True:
-            # Loop until there are no more running processes
-            processes = Process.objects.filter(name='makecatalogs',
-                                               exited=False)
-            if not processes:
-                break
-            # clean up any processes no longer in the process table
-            for process in processes:
-                if not pid_exists(process.pid):
-                    process.delete()
-            processes = Process.objects.filter(name='makecatalogs',
-                                               exited=False)
-            if not processes:
-                break
-            time.sleep(1)
-
-        proc = subprocess.Popen([MAKECATALOGS, REPO_DIR],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        record = Process(name='makecatalogs')
-        record.pid = proc.pid
-        record.save()
-        while True:
-            output = proc.stdout.readline().decode('utf-8').rstrip('\n')
-            if output:
-                record.statustext = output.rstrip('\n')
-                record.save()
-            if proc.poll() != None:
-                break
-
-        record.statustext = 'Done'
-        record.exited = True
-        record.exitcode = proc.returncode
-        record.save()
-        return HttpResponse(json.dumps('done'),
-                            content_type='application/json')
+        job = MAKECATALOGS_RUNNER.request()
+        return HttpResponse(json.dumps({'job': job}),
+                            content_type='application/json', status=202)
     return HttpResponse(json.dumps('must be a POST request'),
                         content_type='application/json')
 
@@ -121,6 +33,19 @@ def status(request):
     '''Get status of our lengthy process'''
     LOGGER.debug('got status request for makecatalogs')
     status_response = {}
+    job = request.GET.get('job')
+    if job:
+        # status of a specific job, whether queued, running or exited
+        try:
+            status_response = job_status(int(job))
+        except ValueError:
+            status_response = None
+        if status_response is None:
+            status_response = {'exited': True,
+                               'statustext': 'no such process',
+                               'exitcode': -1}
+        return HttpResponse(json.dumps(status_response),
+                            content_type='application/json')
     processes = Process.objects.filter(name='makecatalogs', exited=False)
     if processes:
         # display status from one of the active processes
@@ -137,13 +62,28 @@ def status(request):
                         content_type='application/json')
 
 
+def stream(request):
+    '''Stream the status of a makecatalogs job as Server-Sent Events'''
+    LOGGER.debug('got status stream request for makecatalogs')
+    try:
+        job = int(request.GET.get('job'))
+    except (TypeError, ValueError):
+        return HttpResponse(json.dumps('a job id is required'),
+                            content_type='application/json', status=400)
+
+    def status_function():
+        '''Returns the job's status, or an exited status if it is gone'''
+        return job_status(job) or {'exited': True,
+                                   'statustext': 'no such process',
+                                   'exitcode': -1}
+
+    return status_stream_response(status_function)
+
+
 def delete(request):
     '''Remove record for our process'''
     LOGGER.debug('got delete request for makecatalogs')
-    try:
-        record = Process.objects.get(name='makecatalogs')
-        record.delete()
-    except Process.DoesNotExist:
-        pass
+    # records of queued and running jobs are still needed by the runner
+    Process.objects.filter(name='makecatalogs', exited=True).delete()
     return HttpResponse(json.dumps('done'),
                         content_type='application/json')